@@ -3,19 +3,48 @@ import logging
 import vtk, qt, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
-import SegmentEditorEffects
 import functools
 import importlib
 import os
+import re
+import threading
 
 import MRUSLandmarkingLib
 
 import MRUSLandmarkingLib.utils
+import MRUSLandmarkingLib.utils_batch
+import MRUSLandmarkingLib.utils_intersection
+import MRUSLandmarkingLib.utils_landmark_index
+import MRUSLandmarkingLib.utils_landmark_review
 import MRUSLandmarkingLib.utils_landmarks
+import MRUSLandmarkingLib.utils_latency
+import MRUSLandmarkingLib.utils_lru
+import MRUSLandmarkingLib.utils_mask_store
+import MRUSLandmarkingLib.utils_masks
+import MRUSLandmarkingLib.utils_outline
+import MRUSLandmarkingLib.utils_parallel
+import MRUSLandmarkingLib.utils_prefetch
+import MRUSLandmarkingLib.utils_row_sync
+import MRUSLandmarkingLib.utils_slice_cache
+import MRUSLandmarkingLib.utils_tasks
 import MRUSLandmarkingLib.utils_views
 importlib.reload(MRUSLandmarkingLib.utils)
+importlib.reload(MRUSLandmarkingLib.utils_lru)
+importlib.reload(MRUSLandmarkingLib.utils_masks)  # before the modules that import PackedMask from it
+importlib.reload(MRUSLandmarkingLib.utils_intersection)
+importlib.reload(MRUSLandmarkingLib.utils_landmark_review)  # before utils_landmark_index
+importlib.reload(MRUSLandmarkingLib.utils_landmark_index)  # before utils_landmarks
 importlib.reload(MRUSLandmarkingLib.utils_landmarks)
+importlib.reload(MRUSLandmarkingLib.utils_latency)
+importlib.reload(MRUSLandmarkingLib.utils_mask_store)
+importlib.reload(MRUSLandmarkingLib.utils_outline)
+importlib.reload(MRUSLandmarkingLib.utils_parallel)
+importlib.reload(MRUSLandmarkingLib.utils_batch)  # after the modules it uses
+importlib.reload(MRUSLandmarkingLib.utils_tasks)
 importlib.reload(MRUSLandmarkingLib.utils_views)
+importlib.reload(MRUSLandmarkingLib.utils_slice_cache)  # after utils_views
+importlib.reload(MRUSLandmarkingLib.utils_prefetch)  # after utils_slice_cache
+importlib.reload(MRUSLandmarkingLib.utils_row_sync)  # after utils_views
 
 
 #
@@ -79,6 +108,23 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.views_normal = ["Red", "Green", "Yellow"]
         self.views_plus = ["Red+", "Green+", "Yellow+"]
 
+        # slice widgets, logics and nodes of the views (cached for the shortcuts)
+        self.view_registry = MRUSLandmarkingLib.utils_views.ViewRegistry()
+
+        # collects the opacity changes of the auto-repeated 'q'/'w' shortcuts into one change per frame
+        self.opacity_accumulator = MRUSLandmarkingLib.utils_tasks.FrameAccumulator(
+            functools.partial(MRUSLandmarkingLib.utils_views.apply_foreground_opacity_change, self))
+
+        # live synchronisation of the bottom row with the top row in 3-over-3
+        self.row_sync = MRUSLandmarkingLib.utils_row_sync.RowSynchronizer(self.views_normal, self.views_plus,
+                                                                          self.view_registry)
+
+        # optional cache of resliced slices for flicking between volumes
+        self.slice_cache = MRUSLandmarkingLib.utils_slice_cache.SliceImageCache(registry=self.view_registry)
+
+        # caches the slices of the next volume switch in idle time (only while the slice cache is enabled)
+        self.volume_prefetcher = MRUSLandmarkingLib.utils_prefetch.VolumePrefetcher(self.slice_cache)
+
         self.labelVisCheck = True
 
         self.switch = False
@@ -95,16 +141,30 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.landmark_dict = {}
 
+        # parsed labels, positions and statuses of the landmark lists (kept up to date from their point events)
+        self.landmark_indices = MRUSLandmarkingLib.utils_landmark_index.LandmarkIndexRegistry()
+
+        # volume tag of a landmark label -> chosen volume (for jumping between landmarks)
+        self.landmark_volume_map = MRUSLandmarkingLib.utils_landmarks.LandmarkVolumeMap()
+
+        # visible control points of the current landmark list (only changed points are updated)
+        self.control_point_visibility = MRUSLandmarkingLib.utils_landmarks.ControlPointVisibility()
+
+        # opt-in measurement of the shortcut latencies (the shortcuts are wrapped by it)
+        self.latency_recorder = MRUSLandmarkingLib.utils_latency.ShortcutLatencyRecorder()
+
         self.__initialiseShortcuts()
 
-        self.nodes_circle_normal = None
-        self.nodes_circle_plus = None
-        self.nodes_circle = None
+        # the chosen volumes in the order in which they are cycled through
+        self.volume_ring = MRUSLandmarkingLib.utils.VolumeRing()
         self.old_volume_ids = []
 
         # AMIGO
         self.main_directory_path = None
 
+        # intersection that is computed in the background
+        self.intersection_task = None
+
     def setup(self):
         """
         Called when the user opens the module the first time and the widget is initialized.
@@ -126,19 +186,9 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # in batch mode, without a graphical user interface.
         self.logic = MRUSLandmarkingLogic()
 
-        # enable none option for input selectors
-        self.ui.inputSelector0.noneEnabled = True
-        self.ui.inputSelector1.noneEnabled = True
-        self.ui.inputSelector2.noneEnabled = True
-        self.ui.inputSelector3.noneEnabled = True
-        self.ui.inputSelector4.noneEnabled = True
-
-        # set node type for input selectors
-        self.ui.inputSelector0.nodeTypes = ["vtkMRMLScalarVolumeNode"]
-        self.ui.inputSelector1.nodeTypes = ["vtkMRMLScalarVolumeNode"]
-        self.ui.inputSelector2.nodeTypes = ["vtkMRMLScalarVolumeNode"]
-        self.ui.inputSelector3.nodeTypes = ["vtkMRMLScalarVolumeNode"]
-        self.ui.inputSelector4.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        # input selectors - there is always one empty selector after the chosen volumes (see update_input_selectors())
+        self.input_selectors = []
+        self.update_input_selectors([])
         # self.ui.landmarksSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
 
         # Connections
@@ -150,25 +200,20 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
         # (in the selected parameter node).
 
-        self.ui.inputSelector0.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-        self.ui.inputSelector1.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-        self.ui.inputSelector2.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-        self.ui.inputSelector3.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-        self.ui.inputSelector4.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.thresholdRangeWidget.connect("valuesChanged(double,double)", self.updateParameterNodeFromGUI)
+        self.ui.minCoverageSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+        self.ui.minCoverageSpinBox.connect("valueChanged(int)", self.onMinCoverageChanged)
+        self.ui.outlinePerSliceCheck.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.outlinePerSliceCheck.connect("toggled(bool)", self.onOutlinePerSliceCheck)
         self.ui.SimpleMarkupsWidget.connect("markupsFiducialNodeChanged()", self.update_landmark_list_from_gui)
 
-        self.input_selectors = [self.ui.inputSelector4,
-                                self.ui.inputSelector3,
-                                self.ui.inputSelector2,
-                                self.ui.inputSelector1,
-                                self.ui.inputSelector0]
-
         # Buttons
         # reset views
         self.ui.resetViewsButton.setStyleSheet('background-color: red;')
         self.ui.resetViewsButton.connect('clicked(bool)', self.onResetViewsButton)
         # create intersection outline
         self.ui.intersectionButton.connect('clicked(bool)', self.onIntersectionButton)
+        self.ui.intersectionProgressBar.visible = False
         # set foreground threshold to 1 for all chosen volumes
         self.ui.thresholdButton.connect('clicked(bool)', self.onThresholdButton)
         # change to standard view
@@ -177,8 +222,11 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.view3o3Button.connect('clicked(bool)', self.onView3o3Button)
         # switch order of displaying volumes
         self.ui.switchOrderButton.connect('clicked(bool)', self.onSwitchOrderButton)
-        # sync all views
-        self.ui.syncViewsButton.connect('clicked(bool)', self.onSyncViewsButton)
+        # sync the bottom row to the top row
+        self.ui.liveSyncCheck.connect('clicked(bool)', self.onLiveSyncCheck)
+        self.ui.syncVolumesCheck.connect('clicked(bool)', functools.partial(self.onSyncPropertyCheck, "volumes"))
+        self.ui.syncOpacityCheck.connect('clicked(bool)', functools.partial(self.onSyncPropertyCheck, "opacity"))
+        self.ui.syncOffsetCheck.connect('clicked(bool)', functools.partial(self.onSyncPropertyCheck, "offset"))
         # update landmark flow
         self.ui.updateFlow.connect('clicked(bool)', self.onUpdateFlow)
         # sort landmartks
@@ -198,6 +246,13 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # label visibility
         self.ui.labelVisCheck.connect('clicked(bool)', self.onLabelVisCheck)
 
+        # slice cache
+        self.ui.sliceCacheCheck.connect('clicked(bool)', self.onSliceCacheCheck)
+
+        # shortcut latency
+        self.ui.latencyCheck.connect('clicked(bool)', self.onLatencyCheck)
+        self.ui.exportLatencyButton.connect('clicked(bool)', self.onExportLatencyButton)
+
         # landmark status
         self.ui.acceptedLandmarkCheck.connect('clicked(bool)', self.onAcceptedLandmarkCheck)
         self.ui.modifyLandmarkCheck.connect('clicked(bool)', self.onModifyLandmarkCheck)
@@ -219,6 +274,17 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called when the application closes and the module widget is destroyed.
     """
         self.removeObservers()
+        self.cancel_intersection_task()
+        self.row_sync.stop()
+        self.landmark_indices.cleanup()
+        self.landmark_volume_map.cleanup()
+        self.control_point_visibility.cleanup()
+        self.view_registry.cleanup()
+        self.volume_prefetcher.cancel()
+        self.slice_cache.disable()
+        self.opacity_accumulator.cancel()
+        self.latency_recorder.disable()
+        MRUSLandmarkingLib.utils_parallel.shutdown_executor()
 
     def enter(self):
         """
@@ -241,6 +307,16 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
 
+        # the volumes of a running intersection are about to be removed
+        self.cancel_intersection_task()
+        self.volume_prefetcher.cancel()
+        self.slice_cache.apply_pending()
+        self.slice_cache.cache.clear()
+        self.landmark_volume_map.cleanup()
+        self.control_point_visibility.cleanup()
+        self.logic.cancel_refinement()
+        self.logic.remove_intersection_display()
+
     def onSceneEndClose(self, caller, event):
         """
     Called just after the scene is closed.
@@ -258,38 +334,26 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.setParameterNode(self.logic.getParameterNode())
 
-        # Select default input nodes if nothing is selected yet to save a few clicks for the user
-        input_volumes = ["InputVolume0", "InputVolume1", "InputVolume2", "InputVolume3", "InputVolume4"]
-        us_volumes = [["pre-op", "preop"], ["us1", "us1"], ["us2", "us2"], ["us3", "us3"], ["intra-op", "intraop"]]
-
-        # only select default nodes when nothing is selected (otherwise changing modules back and forth triggers this)
-        chosen_nodes = [selector.currentNode() for selector in self.input_selectors]
-
-        # nothing is selected means that we have only None in the list
-        volumeNode = None
-        if not any(chosen_nodes):
-            for input_volume, volume_name in zip(input_volumes, us_volumes):
-                if not self._parameterNode.GetNodeReference(input_volume):
+        # parameter nodes of older scenes store the volumes as InputVolume0, ..., InputVolume4
+        self.logic.migrate_input_volume_references(self._parameterNode)
 
-                    # try to get a volume node that contains one of the names
-                    for node in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
-                        if volume_name[0] in node.GetName().lower() or volume_name[1] in node.GetName().lower():
-                            volumeNode = node
-                            break
+        # Select default input nodes if nothing is selected yet to save a few clicks for the user (only when nothing is
+        # selected, otherwise changing modules back and forth triggers this)
+        if not self.get_input_volumes() and \
+                not self._parameterNode.GetNumberOfNodeReferences(MRUSLandmarkingLogic.INPUT_VOLUME_ROLE):
+            default_volumes = self.logic.get_default_input_volumes(
+                slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"))
 
-                    if volumeNode:
-                        self._parameterNode.SetNodeReferenceID(input_volume, volumeNode.GetID())
+            self.logic.set_input_volumes(self._parameterNode, default_volumes)
 
         # if not self._parameterNode.GetNodeReference("Landmarks"):
         #     if self.ui.SimpleMarkupsWidget.currentNode() is not None:
         #         self._parameterNode.SetNodeReferenceID("Landmarks", self.ui.SimpleMarkupsWidget.currentNode().GetID())
 
         # update chosen volumes
-        self.volumes_ids = []
+        self.volumes_ids = self.get_chosen_volume_ids()
 
-        for selector in self.input_selectors:
-            if selector.currentNode():
-                self.volumes_ids.append(selector.currentNode().GetID())
+        self.volume_ring.set_volume_ids(self.volumes_ids)
 
         self.ui.topRowCheck.toolTip = "Switch to 3-over-3 view to disable top row"
         self.ui.bottomRowCheck.toolTip = "Switch to 3-over-3 view to enable bottom row"
@@ -325,19 +389,16 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._updatingGUIFromParameterNode = True
 
         # Update node selectors
-        self.ui.inputSelector0.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume0"))
-        self.ui.inputSelector1.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume1"))
-        self.ui.inputSelector2.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume2"))
-        self.ui.inputSelector3.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume3"))
-        self.ui.inputSelector4.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume4"))
+        input_volumes = self.logic.get_input_volumes(self._parameterNode)
+        self.update_input_selectors(input_volumes)
+        self.ui.thresholdRangeWidget.minimumValue = float(self._parameterNode.GetParameter("MinimumThreshold") or 1)
+        self.ui.thresholdRangeWidget.maximumValue = float(self._parameterNode.GetParameter("MaximumThreshold") or 255)
+        self.ui.minCoverageSpinBox.value = int(self._parameterNode.GetParameter("MinimumCoverage") or 0)
+        self.ui.outlinePerSliceCheck.checked = self._parameterNode.GetParameter("OutlinePerSlice") == "true"
         # self.ui.SimpleMarkupsWidget.setCurrentNode(self._parameterNode.GetNodeReference("Landmarks"))
 
         # update button states and tooltips - only if volumes are chosen, enable buttons
-        if self._parameterNode.GetNodeReference("InputVolume0") or \
-            self._parameterNode.GetNodeReference("InputVolume1") or \
-            self._parameterNode.GetNodeReference("InputVolume2") or \
-            self._parameterNode.GetNodeReference("InputVolume3") or \
-            self._parameterNode.GetNodeReference("InputVolume4"):
+        if input_volumes:
             self.ui.intersectionButton.toolTip = "Compute intersection"
             self.ui.intersectionButton.enabled = True
 
@@ -364,11 +425,11 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
 
-        self._parameterNode.SetNodeReferenceID("InputVolume0", self.ui.inputSelector0.currentNodeID)
-        self._parameterNode.SetNodeReferenceID("InputVolume1", self.ui.inputSelector1.currentNodeID)
-        self._parameterNode.SetNodeReferenceID("InputVolume2", self.ui.inputSelector2.currentNodeID)
-        self._parameterNode.SetNodeReferenceID("InputVolume3", self.ui.inputSelector3.currentNodeID)
-        self._parameterNode.SetNodeReferenceID("InputVolume4", self.ui.inputSelector4.currentNodeID)
+        self.logic.set_input_volumes(self._parameterNode, self.get_input_volumes())
+        self._parameterNode.SetParameter("MinimumThreshold", str(self.ui.thresholdRangeWidget.minimumValue))
+        self._parameterNode.SetParameter("MaximumThreshold", str(self.ui.thresholdRangeWidget.maximumValue))
+        self._parameterNode.SetParameter("MinimumCoverage", str(self.ui.minCoverageSpinBox.value))
+        self._parameterNode.SetParameter("OutlinePerSlice", "true" if self.ui.outlinePerSliceCheck.checked else "false")
 
         # if self.ui.SimpleMarkupsWidget.currentNode():
         #     self._parameterNode.SetNodeReferenceID("Landmarks", self.ui.SimpleMarkupsWidget.currentNode().GetID())
@@ -379,25 +440,59 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # update volumes
         self.old_volume_ids = self.volumes_ids
-        self.volumes_ids = []
+        self.volumes_ids = self.get_chosen_volume_ids()
 
-        for selector in self.input_selectors:
-            if selector.currentNode():
-                self.volumes_ids.append(selector.currentNode().GetID())
-
-        # if the newly selected volume ids are different from the old, the update the circular data structure used for
-        # changing views
+        # if the newly selected volume ids are different from the old, the update the ring used for changing views
         if self.old_volume_ids != self.volumes_ids:
 
-            self.nodes_circle_normal = MRUSLandmarkingLib.utils.VolumeCircle(max_length=len(self.volumes_ids))
-            self.nodes_circle_plus = MRUSLandmarkingLib.utils.VolumeCircle(max_length=len(self.volumes_ids))
-            self.nodes_circle = MRUSLandmarkingLib.utils.VolumeCircle(max_length=len(self.volumes_ids))
+            self.volume_ring.set_volume_ids(self.volumes_ids)
+
+            # keep a displayed intersection up to date with the chosen volumes
+            self.update_intersection()
+
+    def update_input_selectors(self, volumes):
+        """
+    Shows the chosen volumes in the input selectors followed by one empty selector (selectors are added or removed as
+    needed)
+    :param volumes: The chosen volume nodes
+    """
+        volumes = list(volumes) + [None]
+
+        while len(self.input_selectors) < len(volumes):
+            selector = slicer.qMRMLNodeComboBox()
+            selector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+            selector.noneEnabled = True
+            selector.addEnabled = False
+            selector.removeEnabled = False
+            selector.showChildNodeTypes = False
+            selector.setMRMLScene(slicer.mrmlScene)
+            selector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+
+            self.ui.inputSelectorsLayout.addRow(f"V{len(self.input_selectors) + 1} ", selector)
+            self.input_selectors.append(selector)
+
+        while len(self.input_selectors) > len(volumes):
+            self.ui.inputSelectorsLayout.removeRow(len(self.input_selectors) - 1)  # also deletes the selector
+            self.input_selectors.pop()
+
+        for selector, volume in zip(self.input_selectors, volumes):
+            if selector.currentNode() is not volume:
+                wasBlocked = selector.blockSignals(True)
+                selector.setCurrentNode(volume)
+                selector.blockSignals(wasBlocked)
+
+    def get_input_volumes(self):
+        """
+    Returns the volume nodes chosen in the input selectors (in the order of the selectors)
+    """
+        return [selector.currentNode() for selector in self.input_selectors if selector.currentNode()]
 
-            for volume_id in self.volumes_ids:
-                new_node = MRUSLandmarkingLib.utils.VolumeNode(volume_id)
-                self.nodes_circle_normal.add_volume_node(new_node)
-                self.nodes_circle_plus.add_volume_node(new_node)
-                self.nodes_circle.add_volume_node(new_node)
+    def get_chosen_volume_ids(self):
+        """
+    Returns the IDs of the chosen volumes in the order in which they are cycled through (from the last to the first
+    selector)
+    """
+        return list(reversed([volume.GetID() for volume in self.get_input_volumes()]))
 
     def update_landmark_list_from_gui(self):
         self.current_landmarks_list = self.ui.SimpleMarkupsWidget.currentNode()
@@ -440,7 +535,7 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         for (shortcutKey, callback) in self.shortcuts:
             shortcut = qt.QShortcut(slicer.util.mainWindow())
             shortcut.setKey(qt.QKeySequence(shortcutKey))
-            shortcut.connect('activated()', callback)
+            shortcut.connect('activated()', self.latency_recorder.wrap(shortcutKey, callback))
 
     def onResetViewsButton(self):
         """
@@ -449,9 +544,7 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         try:
 
             # try to select nodes from selectors
-            for selector in self.input_selectors:
-                if selector.currentNode():
-                    self.volumes_ids.append(selector.currentNode().GetID())
+            self.volumes_ids = self.get_chosen_volume_ids()
 
             # decide on slices to be updated depending on the view chosen
             current_views = MRUSLandmarkingLib.utils_views.get_current_views(self)
@@ -490,18 +583,116 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onIntersectionButton(self):
         """
-    Run processing when user clicks "Create intersection" button.
+    Run processing when user clicks "Create intersection" button. The intersection is computed in the background, while
+    it is running the button cancels it.
     """
-        try:
-            # Compute output
-            self.logic.process([selector.currentNode() for selector in self.input_selectors if selector.currentNode()],
-                               MRUSLandmarkingLib.utils_views.get_current_views(self))
+        if self.intersection_task is not None and self.intersection_task.is_running():
+            self.intersection_task.cancel()
+            self.ui.intersectionButton.text = "Cancelling..."
+            self.ui.intersectionButton.enabled = False
+            return
 
-            MRUSLandmarkingLib.utils_views.initialise_views(self)
+        try:
+            self.start_intersection(self.onIntersectionDone)
 
         except Exception as e:
             slicer.util.errorDisplay("Failed to create intersection. " + str(e))
 
+    def start_intersection(self, on_done):
+        """
+    Starts computing the intersection of the chosen volumes in the background (with the chosen threshold and coverage)
+    :param on_done: Called with the segmentation node once the intersection is displayed
+    """
+        threshold_range = (self.ui.thresholdRangeWidget.minimumValue, self.ui.thresholdRangeWidget.maximumValue)
+
+        # Compute output
+        self.intersection_task = self.logic.process_in_background(
+            self.get_input_volumes(),
+            threshold_range,
+            self.ui.minCoverageSpinBox.value,
+            on_progress=self.onIntersectionProgress,
+            on_done=on_done,
+            on_error=self.onIntersectionError,
+            on_cancelled=self.onIntersectionFinished)
+
+        # a cached intersection is displayed right away
+        if self.intersection_task is not None:
+            self.ui.intersectionButton.text = "Cancel intersection"
+            self.ui.intersectionProgressBar.value = 0
+            self.ui.intersectionProgressBar.visible = True
+
+    def onIntersectionProgress(self, done, total):
+        self.ui.intersectionProgressBar.maximum = total
+        self.ui.intersectionProgressBar.value = done
+
+    def onIntersectionDone(self, segmentationNode):
+        self.onIntersectionFinished()
+        MRUSLandmarkingLib.utils_views.initialise_views(self)
+
+    def onIntersectionError(self, error):
+        self.onIntersectionFinished()
+        slicer.util.errorDisplay("Failed to create intersection. " + str(error))
+
+    def onIntersectionFinished(self):
+        """
+    Resets the intersection controls once the background computation is over (done, failed or cancelled)
+    """
+        self.ui.intersectionProgressBar.visible = False
+        self.ui.intersectionButton.text = "Create intersection"
+        self.ui.intersectionButton.enabled = True
+
+    def onMinCoverageChanged(self, min_coverage):
+        """
+    Shows the voxels covered by at least the chosen number of US volumes (read from the counts of the last
+    intersection, so nothing is recomputed - unless fewer volumes than before are enough, as the counts are cropped to
+    the voxels that the previous coverage could contain)
+    """
+        if self.logic.coverage is None or not self.logic.is_intersection_displayed() or \
+                (self.intersection_task is not None and self.intersection_task.is_running()):
+            return
+
+        try:
+            if self.logic.coverage_serves(min_coverage):
+                self.logic.show_coverage(min_coverage)
+            else:
+                self.start_intersection(lambda segmentationNode: self.onIntersectionFinished())
+
+        except Exception as e:
+            slicer.util.errorDisplay("Failed to update intersection. " + str(e))
+
+    def onOutlinePerSliceCheck(self, activate=False):
+        """
+    Switches the displayed intersection between a segmentation and outlines that are computed per displayed slice
+    """
+        try:
+            self.logic.set_outline_per_slice(activate)
+
+        except Exception as e:
+            slicer.util.errorDisplay("Failed to switch the intersection display. " + str(e))
+
+    def update_intersection(self):
+        """
+    Updates a displayed intersection after the chosen volumes changed (only the changed volumes are recomputed)
+    """
+        if not self.logic.is_intersection_displayed() or \
+                (self.intersection_task is not None and self.intersection_task.is_running()):
+            return
+
+        try:
+            threshold_range = (self.ui.thresholdRangeWidget.minimumValue, self.ui.thresholdRangeWidget.maximumValue)
+
+            self.logic.update_intersection(
+                self.get_input_volumes(),
+                threshold_range,
+                self.ui.minCoverageSpinBox.value)
+
+        except Exception as e:
+            slicer.util.errorDisplay("Failed to update intersection. " + str(e))
+
+    def cancel_intersection_task(self):
+        if self.intersection_task is not None and self.intersection_task.is_running():
+            self.intersection_task.cancel()
+
     def onThresholdButton(self):
         """
     Sets all lower thresholds of the US volumes to 1, so the black border disappears
@@ -511,11 +702,7 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             threshold = 1
 
             # loop through all selected volumes
-            for volume in [self.ui.inputSelector0.currentNode(),
-                           self.ui.inputSelector1.currentNode(),
-                           self.ui.inputSelector2.currentNode(),
-                           self.ui.inputSelector3.currentNode(),
-                           self.ui.inputSelector4.currentNode()]:
+            for volume in self.get_input_volumes():
 
                 if volume:  # we need to check if it is not none - nothing selected means the current node is none
                     current_name = volume.GetName()
@@ -553,8 +740,10 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             self.view = 'normal'
 
-            # set sync views button to disabled
-            self.ui.syncViewsButton.enabled = False
+            # the bottom row does not exist in the standard view
+            self.row_sync.stop()
+            self.ui.liveSyncCheck.checked = False
+            self.ui.liveSyncCheck.enabled = False
 
             # disable the button and enable 3o3 button
             self.ui.view3o3Button.enabled = True
@@ -591,8 +780,8 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             self.view = '3on3'
 
-            # set sync views button to enabled
-            self.ui.syncViewsButton.enabled = True
+            # enable syncing the bottom row
+            self.ui.liveSyncCheck.enabled = True
 
             # disable the button and enable normal button
             self.ui.view3o3Button.enabled = False
@@ -615,55 +804,41 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             # switch views
             current_views = MRUSLandmarkingLib.utils_views.get_current_views(self)
 
-            for view in current_views:
-                layoutManager = slicer.app.layoutManager()
-                view_logic = layoutManager.sliceWidget(view).sliceLogic()
-                self.compositeNode = view_logic.GetSliceCompositeNode()
-
-                current_background_id = self.compositeNode.GetBackgroundVolumeID()
-                current_foreground_id = self.compositeNode.GetForegroundVolumeID()
+            with MRUSLandmarkingLib.utils_views.view_transaction(current_views, self.view_registry) as views:
+                for _, self.compositeNode, _ in views:
+                    current_background_id = self.compositeNode.GetBackgroundVolumeID()
+                    current_foreground_id = self.compositeNode.GetForegroundVolumeID()
 
-                self.compositeNode.SetBackgroundVolumeID(current_foreground_id)
-                self.compositeNode.SetForegroundVolumeID(current_background_id)
+                    self.compositeNode.SetBackgroundVolumeID(current_foreground_id)
+                    self.compositeNode.SetForegroundVolumeID(current_background_id)
 
             # Resources.utils_views.initialise_views(self)
 
         except Exception as e:
             slicer.util.errorDisplay("Failed to change the display order. " + str(e))
 
-    def onSyncViewsButton(self):
+    def onLiveSyncCheck(self, activate=False):
         """
-    Sync all views in the 3o3 view
+    Starts or stops keeping the bottom row in sync with the top row in the 3o3 view
     """
+        try:
+            if activate:
+                self.row_sync.start()
+            else:
+                self.row_sync.stop()
 
-        # set lower row volumes to those of the upper view
-        if self.view == '3on3':  # if it is 3on3, we want it to update all slices
-
-            layoutManager = slicer.app.layoutManager()
-
-            for i in range(3):
-                view_logic_normal = layoutManager.sliceWidget(self.views_normal[i]).sliceLogic()
-                compositeNode_normal = view_logic_normal.GetSliceCompositeNode()
-                view_logic_plus = layoutManager.sliceWidget(self.views_plus[i]).sliceLogic()
-                compositeNode_plus = view_logic_plus.GetSliceCompositeNode()
-
-                # change volumes to those from the top row
-                background_normal_id = compositeNode_normal.GetBackgroundVolumeID()
-                foreground_normal_id = compositeNode_normal.GetForegroundVolumeID()
-
-                compositeNode_plus.SetBackgroundVolumeID(background_normal_id)
-                compositeNode_plus.SetForegroundVolumeID(foreground_normal_id)
-
-                # change foreground opacities to those from the top row
-                compositeNode_plus.SetForegroundOpacity(compositeNode_normal.GetForegroundOpacity())
+        except Exception as e:
+            slicer.util.errorDisplay("Failed to sync the views. " + str(e))
 
-                # update offset (sometimes when updating rows, they are updated to the wrong offset)
-                view_logic_plus.SetSliceOffset(view_logic_normal.GetSliceOffset())
+    def onSyncPropertyCheck(self, name, activate=True):
+        """
+    Switches the synchronisation of the volumes, the opacity or the slice offset of the rows on or off
+    """
+        try:
+            self.row_sync.set_property(name, activate)
 
-            # link rest of funcitonality
-            self.topRowActive = True
-            self.bottomRowActive = True
-            MRUSLandmarkingLib.utils_views.active_rows_update(self)
+        except Exception as e:
+            slicer.util.errorDisplay("Failed to sync the views. " + str(e))
 
     def onUpdateFlow(self):
 
@@ -675,7 +850,7 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.curve_nodes = {}
 
             fiducial_nodes = MRUSLandmarkingLib.utils_landmarks.divide_landmarks_by_volume(self)
-            max_len = max([len(i) for i in fiducial_nodes])
+            max_len = max([len(i) for i in fiducial_nodes], default=0)
 
             # create curve nodes
             for i in range(max_len):
@@ -684,20 +859,8 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             # loop through all curve nodes and add points
             for index, curve_node_id in self.curve_nodes.items():
 
-                all_points = []
-
-                if len(fiducial_nodes[0]) > 0:
-                    all_points.append(fiducial_nodes[0][index][0])
-                if len(fiducial_nodes[1]) > 0:
-                    all_points.append(fiducial_nodes[1][index][0])
-                if len(fiducial_nodes[2]) > 0:
-                    all_points.append(fiducial_nodes[2][index][0])
-                if len(fiducial_nodes[3]) > 0:
-                    all_points.append(fiducial_nodes[3][index][0])
-                if len(fiducial_nodes[4]) > 0:
-                    all_points.append(fiducial_nodes[4][index][0])
-
-                all_points = np.asarray(all_points)
+                # one point per volume, in the order pre-op, us1, us2, ..., intra-op
+                all_points = np.asarray([volume_landmarks[index][0] for volume_landmarks in fiducial_nodes])
 
                 slicer.util.updateMarkupsControlPointsFromArray(curve_node_id, all_points)
 
@@ -734,13 +897,53 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             previous_state = not self.ui.labelVisCheck.checked
             MRUSLandmarkingLib.utils_landmarks.check_if_landmark_list_is_selected(self)
 
-            for i in range(self.current_landmarks_list.GetNumberOfControlPoints()):
-                self.current_landmarks_list.SetNthControlPointVisibility(i, activate)
+            with self.landmark_indices.get(self.current_landmarks_list).unchanged():
+                self.control_point_visibility.set_all(self.current_landmarks_list, activate)
 
         except Exception as e:
             self.ui.labelVisCheck.checked = previous_state  # assign previous checked state
             slicer.util.errorDisplay("Could not change label visibility.\n" + str(e))
 
+    def onSliceCacheCheck(self, activate=False):
+        """
+    Switches the cache of resliced slices (for flicking between the same volumes at a fixed slice) on or off
+    """
+        if activate:
+            self.slice_cache.enable()
+        else:
+            self.volume_prefetcher.cancel()
+            self.slice_cache.disable()
+
+    def onLatencyCheck(self, activate=False):
+        """
+    Starts or stops measuring the time from a shortcut to the next rendered slice view
+    """
+        if activate:
+            self.latency_recorder.enable()
+        else:
+            self.latency_recorder.disable()
+
+    def onExportLatencyButton(self):
+        """
+    Writes the measured shortcut latencies (p50/p95/max per shortcut and layout) to a CSV or JSON file
+    """
+        try:
+            if not self.latency_recorder.samples:
+                raise Exception("No latencies measured - check 'Measure shortcut latency' and use the shortcuts first.")
+
+            path = qt.QFileDialog.getSaveFileName(None, "Export shortcut latencies", "shortcut_latencies.csv",
+                                                  "CSV (*.csv);;JSON (*.json)")
+            if not path:
+                return
+
+            if path.lower().endswith(".json"):
+                self.latency_recorder.export_json(path)
+            else:
+                self.latency_recorder.export_csv(path)
+
+        except Exception as e:
+            slicer.util.errorDisplay("Failed to export the shortcut latencies. " + str(e))
+
     def onAcceptedLandmarkCheck(self, activate=True):
         try:
             if activate is True:
@@ -865,6 +1068,7 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             # create folder structure and load nifti files into it
             folders = ["Preop-MR", "Intraop-US", "Intraop-MR", "Annotations"]
+            us_nodes = []
 
             for data_folder in folders:
                 data_folder_id = hierarchy_node.CreateFolderItem(hierarchy_node.GetSceneItemID(), data_folder)
@@ -874,20 +1078,8 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 files = os.listdir(data_folder_path)
                 files = [os.path.join(self.main_directory_path, f"Case{case_number}", data_folder, f) for f in files if f.endswith(".nrrd")]
 
-                if data_folder == "Intraop-US":
-                    files = []
-                    temp = os.path.join(self.main_directory_path, f"Case{case_number}", data_folder, f"Case{case_number}-intraop-US-pre_dura.nrrd")
-
-                    if os.path.exists(temp):
-                        files.append(temp)
-
-                    temp = os.path.join(self.main_directory_path, f"Case{case_number}", data_folder, f"Case{case_number}-intraop-US-post_dura.nrrd")
-                    if os.path.exists(temp):
-                        files.append(temp)
-
-                    temp = os.path.join(self.main_directory_path, f"Case{case_number}", data_folder, f"Case{case_number}-intraop-US-pre_imri.nrrd")
-                    if os.path.exists(temp):
-                        files.append(temp)
+                if data_folder == MRUSLandmarkingLib.utils_batch.US_FOLDER:
+                    files = MRUSLandmarkingLib.utils_batch.case_us_files(self.main_directory_path, case_number)
 
                 for file in files:
                     if "annotation" in file.lower():
@@ -919,11 +1111,33 @@ class MRUSLandmarkingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     else:
                         volume_node = slicer.util.loadVolume(file)
 
+                        if data_folder == MRUSLandmarkingLib.utils_batch.US_FOLDER:
+                            us_nodes.append(volume_node)
+
                     volume_hierarchy_id = hierarchy_node.GetItemByDataNode(volume_node)
                     hierarchy_node.SetItemParent(volume_hierarchy_id, data_folder_id)
 
         except Exception as e:
             slicer.util.errorDisplay("Could not load case.\n" + str(e))
+            return
+
+        # show the intersection of the US volumes right away if it was computed before (in an earlier session or by
+        # the batch script)
+        if len(us_nodes) > 1:
+            try:
+                threshold_range = (self.ui.thresholdRangeWidget.minimumValue,
+                                   self.ui.thresholdRangeWidget.maximumValue)
+                min_coverage = self.ui.minCoverageSpinBox.value
+
+                if not self.logic.load_stored_intersection(us_nodes, threshold_range, min_coverage) and \
+                        min_coverage == 0:
+                    self.logic.load_case_intersection(
+                        us_nodes, MRUSLandmarkingLib.utils_batch.case_intersection_file(self.main_directory_path,
+                                                                                        case_number),
+                        threshold_range)
+
+            except Exception as e:
+                logging.warning("Could not load the stored intersection: " + str(e))
 
 
 #
@@ -940,12 +1154,41 @@ class MRUSLandmarkingLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+    # multi-valued parameter node reference of the chosen volumes
+    INPUT_VOLUME_ROLE = "InputVolume"
+
+    # US volumes contain us1, us2, ... in their names
+    US_VOLUME_PATTERN = re.compile(r"us(\d+)")
+
     def __init__(self):
         """
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
         ScriptedLoadableModuleLogic.__init__(self)
 
+        # per-volume FOV masks and coverage counts of the last intersection (for incremental updates)
+        self.coverage = None
+        self.coverage_reference = None  # (ID, version) of the volume that defines the grid of the coverage
+        self.coverage_bounds = None  # the part of the reference grid that the coverage counts
+        self.coverage_level = None  # the lowest number of covering volumes whose voxels all lie inside of the bounds
+        self.intersection_node = None
+
+        # displayed intersection masks, keyed by the volumes, their versions, the threshold and the coverage
+        self.intersection_cache = MRUSLandmarkingLib.utils_lru.LRUCache(max_bytes=512 * 1024 ** 2)
+        self.intersection_node_key = None
+
+        # instead of a segmentation, the intersection can be shown as outlines computed only for the displayed slices
+        self.outline_per_slice = False
+        self.outline_display = None
+
+        # full resolution refinement of a coarse intersection preview (see process_coarse_to_fine())
+        self.refinement_task = None
+
+        # intersection masks stored on disk across sessions, keyed by a content hash of the US volumes
+        self.mask_store = MRUSLandmarkingLib.utils_mask_store.MaskStore(
+            os.path.join(slicer.app.cachePath, "MRUSLandmarking"), max_bytes=1024 ** 3)
+        self.volume_digests = {}  # volume ID -> (version, digest)
+
     @staticmethod
     def setup_segment_editor(segmentationNode=None, volumeNode=None):
         """
@@ -973,104 +1216,929 @@ class MRUSLandmarkingLogic(ScriptedLoadableModuleLogic):
 
         return segmentEditorWidget, segmentEditorNode, segmentationNode
 
-    def process(self, volumes=None, current_views=None):
+    def setDefaultParameters(self, parameterNode):
         """
-    Creates the intersection of the us volumes and displays it as an outline
+    Initialize parameter node with default settings.
     """
+        if not parameterNode.GetParameter("MinimumThreshold"):
+            parameterNode.SetParameter("MinimumThreshold", "1")
+        if not parameterNode.GetParameter("MaximumThreshold"):
+            parameterNode.SetParameter("MaximumThreshold", "255")
+        if not parameterNode.GetParameter("MinimumCoverage"):
+            parameterNode.SetParameter("MinimumCoverage", "0")
+        if not parameterNode.GetParameter("OutlinePerSlice"):
+            parameterNode.SetParameter("OutlinePerSlice", "false")
 
-        if volumes is None and current_views is None:
+    @staticmethod
+    def get_input_volumes(parameterNode):
+        """
+    Returns the chosen volume nodes stored in the parameter node (in the order in which they were chosen)
+    """
+        role = MRUSLandmarkingLogic.INPUT_VOLUME_ROLE
+
+        volumes = [parameterNode.GetNthNodeReference(role, n)
+                   for n in range(parameterNode.GetNumberOfNodeReferences(role))]
+
+        return [volume for volume in volumes if volume is not None]
+
+    @staticmethod
+    def set_input_volumes(parameterNode, volumes):
+        """
+    Stores the chosen volume nodes in the parameter node (as the multi-valued INPUT_VOLUME_ROLE reference)
+    """
+        role = MRUSLandmarkingLogic.INPUT_VOLUME_ROLE
+        volume_ids = [volume.GetID() for volume in volumes]
+
+        if volume_ids == [parameterNode.GetNthNodeReferenceID(role, n)
+                          for n in range(parameterNode.GetNumberOfNodeReferences(role))]:
             return
 
-        if current_views is None:
-            current_views = ["Red", "Green", "Yellow"]
+        wasModified = parameterNode.StartModify()
 
-        # save current background and foreground (because changing the master volume twice changes the back-/foregrounds
-        layoutManager = slicer.app.layoutManager()
-        view_logic = layoutManager.sliceWidget(current_views[0]).sliceLogic()
-        self.compositeNode = view_logic.GetSliceCompositeNode()
-        current_background_id = self.compositeNode.GetBackgroundVolumeID()
-        current_foreground_id = self.compositeNode.GetForegroundVolumeID()
+        parameterNode.RemoveNodeReferenceIDs(role)
+        for volume_id in volume_ids:
+            parameterNode.AddNodeReferenceID(role, volume_id)
 
-        import time
-        startTime = time.time()
-        logging.info('Processing started')
+        parameterNode.EndModify(wasModified)
 
-        usVolumes = []
-        for volume in volumes:
-            matches = ["us1", "us2", "us3", "us4", "us5", "us6", "us7", "us8", "us9", "us10"]
-            if any(x in volume.GetName().lower() for x in matches):
-                usVolumes.append(volume)
+    @staticmethod
+    def migrate_input_volume_references(parameterNode):
+        """
+    Moves the volumes of the single-valued InputVolume0, ..., InputVolume4 references (used by older scenes) to the
+    multi-valued INPUT_VOLUME_ROLE reference
+    """
+        legacy_roles = [f"{MRUSLandmarkingLogic.INPUT_VOLUME_ROLE}{n}" for n in range(5)]
+        legacy_volumes = [parameterNode.GetNodeReference(role) for role in legacy_roles]
 
-        if len(usVolumes) <= 1:
-            slicer.util.errorDisplay(
-                "Select at least two US volumes (intersection is only calculated for US volumes). (They"
-                "need to contain us1, us2, us3, us4, us5 or us6, us7, us8, us9, us10 in their names")
+        if not any(legacy_volumes):
             return
 
-        # initialise segment editor
-        segmentEditorWidget, segmentEditorNode, segmentationNode = self.setup_segment_editor()
+        wasModified = parameterNode.StartModify()
+
+        if not parameterNode.GetNumberOfNodeReferences(MRUSLandmarkingLogic.INPUT_VOLUME_ROLE):
+            MRUSLandmarkingLogic.set_input_volumes(parameterNode, [volume for volume in legacy_volumes if volume])
+
+        for role in legacy_roles:
+            parameterNode.RemoveNodeReferenceIDs(role)
+
+        parameterNode.EndModify(wasModified)
+
+    @staticmethod
+    def get_us_number(volume):
+        """
+    Returns the number of a US volume (usN in its name) or None if the volume is not a US volume
+    """
+        match = MRUSLandmarkingLogic.US_VOLUME_PATTERN.search(volume.GetName().lower())
+
+        return int(match.group(1)) if match else None
 
-        addedSegmentID = []
+    @staticmethod
+    def get_default_input_volumes(volumes):
+        """
+    Picks the volumes that are chosen by default: the pre-op volume, all US volumes ordered by their number and the
+    intra-op volume (recognised by their names)
+    :param volumes: A list of volume nodes
+    """
+        def first_named(names):
+            return next((volume for volume in volumes if any(name in volume.GetName().lower() for name in names)),
+                        None)
 
-        # for each volume create a threshold segmentation
-        for idx, volume in enumerate(usVolumes):
-            segmentEditorWidget.setMasterVolumeNode(volume)
+        us_volumes = {}
+        for volume in volumes:
+            us_number = MRUSLandmarkingLogic.get_us_number(volume)
+            if us_number is not None:
+                us_volumes.setdefault(us_number, volume)
 
-            # Create segment
-            addedSegmentID.append(segmentationNode.GetSegmentation().AddEmptySegment())
-            segmentEditorNode.SetSelectedSegmentID(addedSegmentID[idx])
+        default_volumes = [first_named(["pre-op", "preop"])] + [us_volumes[n] for n in sorted(us_volumes)] + \
+                          [first_named(["intra-op", "intraop"])]
 
-            # Fill by thresholding
-            segmentEditorWidget.setActiveEffectByName("Threshold")
-            effect = segmentEditorWidget.activeEffect()
-            effect.setParameter("MinimumThreshold", "1")
-            effect.setParameter("MaximumThreshold", "255")
-            effect.self().onApply()
+        return list(dict.fromkeys(volume for volume in default_volumes if volume is not None))
 
-        # set background and foreground in all views
-        for view in current_views:
-            layoutManager = slicer.app.layoutManager()
-            view_logic = layoutManager.sliceWidget(view).sliceLogic()
-            self.compositeNode = view_logic.GetSliceCompositeNode()
-            self.compositeNode.SetBackgroundVolumeID(current_background_id)
-            self.compositeNode.SetForegroundVolumeID(current_foreground_id)
+    @staticmethod
+    def get_us_volumes(volumes):
+        """
+    Returns the volumes that are US volumes (they contain us1, us2, ... in their names)
+    :param volumes: A list of volume nodes
+    """
+        return [volume for volume in volumes if MRUSLandmarkingLogic.get_us_number(volume) is not None]
 
-        # https://slicer.readthedocs.io/en/latest/developer_guide/modules/segmenteditor.html#effect-parameters
-        # https://discourse.slicer.org/t/how-to-programmatically-use-logical-operator-add-function-from-segment-editor/16581/2
-        # https://discourse.slicer.org/t/how-to-change-the-slice-fill-in-segmentations-in-a-python-script/20871/2
-        # Display settings are stored in the display node
-        intersection_segment_id = segmentationNode.GetSegmentation().AddEmptySegment()
-        segmentEditorNode.SetSelectedSegmentID(intersection_segment_id)
-        segmentEditorWidget.setActiveEffectByName("Logical operators")
-        effect = segmentEditorWidget.activeEffect()
+    @staticmethod
+    def get_ijk_to_world_matrix(volumeNode):
+        """
+    Returns the IJK-to-RAS matrix of a volume (including its parent transforms) as a numpy array
+    :param volumeNode: The volume node
+    """
+        ijk_to_ras = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijk_to_ras)
 
-        # add first segmentations
-        effect.setParameter("Operation", SegmentEditorEffects.LOGICAL_UNION)
+        transform_node = volumeNode.GetParentTransformNode()
+        if transform_node is not None:
+            if not transform_node.IsTransformToWorldLinear():
+                raise ValueError(f"{volumeNode.GetName()} is under a non-linear transform - harden it first.")
 
-        effect.setParameter("ModifierSegmentID", addedSegmentID[0])
-        effect.self().onApply()
+            to_world = vtk.vtkMatrix4x4()
+            transform_node.GetMatrixTransformToWorld(to_world)
+            vtk.vtkMatrix4x4.Multiply4x4(to_world, ijk_to_ras, ijk_to_ras)
 
-        # intersect with the next two segmentations
-        effect.setParameter("Operation", SegmentEditorEffects.LOGICAL_INTERSECT)
+        return slicer.util.arrayFromVTKMatrix(ijk_to_ras)
 
-        for id in addedSegmentID:
-            effect.setParameter("ModifierSegmentID", id)
-            effect.self().onApply()
+    def check_bounding_boxes(self, usVolumes):
+        """
+    Intersects the oriented bounding boxes of the US volumes pairwise. No voxels are touched, so this fails fast when
+    the volumes do not overlap at all.
+    :param usVolumes: A list of US volume nodes
+    return: A list of (shape, ijk_to_ras) tuples of the volumes
+    """
+        utils_intersection = MRUSLandmarkingLib.utils_intersection
 
-            # remove segments
-            segmentationNode.RemoveSegment(id)
+        boxes = [(slicer.util.arrayFromVolume(volume).shape, self.get_ijk_to_world_matrix(volume))
+                 for volume in usVolumes]
+        oriented_boxes = [utils_intersection.oriented_box(shape, ijk_to_ras) for shape, ijk_to_ras in boxes]
+
+        for idx_a in range(len(usVolumes)):
+            for idx_b in range(idx_a + 1, len(usVolumes)):
+                if not utils_intersection.oriented_boxes_overlap(oriented_boxes[idx_a], oriented_boxes[idx_b]):
+                    raise ValueError(f"The US volumes {usVolumes[idx_a].GetName()} and {usVolumes[idx_b].GetName()} "
+                                     f"do not overlap.")
+
+        return boxes
+
+    def get_intersection_grid(self, usVolumes):
+        """
+    Intersects the oriented bounding boxes of the US volumes and returns the grid of the first volume cropped to the
+    overlap
+    :param usVolumes: A list of US volume nodes
+    return: The (k, j, i) shape and the IJK-to-RAS matrix of the cropped grid
+    """
+        boxes = self.check_bounding_boxes(usVolumes)
+
+        grid = MRUSLandmarkingLib.utils_intersection.crop_grid(boxes[0][0], boxes[0][1], boxes)
+        if grid is None:
+            raise ValueError("The bounding boxes of the chosen US volumes do not have a common overlap.")
+
+        return grid
+
+    def get_intersection_inputs(self, usVolumes):
+        """
+    Collects everything the intersection needs from the scene, so that the voxel work can run without touching it
+    :param usVolumes: A list of US volume nodes
+    return: A list of (array, ijk_to_ras) tuples and the (k, j, i) shape and IJK-to-RAS matrix of the grid
+    """
+        grid_shape, grid_ijk_to_ras = self.get_intersection_grid(usVolumes)
+
+        volumes = [(slicer.util.arrayFromVolume(volume), self.get_ijk_to_world_matrix(volume)) for volume in usVolumes]
+
+        return volumes, grid_shape, grid_ijk_to_ras
+
+    @staticmethod
+    def compute_intersection_mask(volumes, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255),
+                                  progress_callback=None, cancel_event=None):
+        """
+    Computes the intersection mask from the inputs returned by get_intersection_inputs() (does not touch the scene)
+    :param volumes: A list of (array, ijk_to_ras) tuples
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param progress_callback: Optional function called with (finished volumes, all volumes)
+    :param cancel_event: Optional threading.Event that cancels the computation
+    return: The PackedMask and the IJK-to-RAS matrix of its grid
+    """
+        mask = MRUSLandmarkingLib.utils_parallel.parallel_intersection_mask(volumes, grid_shape, grid_ijk_to_ras,
+                                                                            threshold_range,
+                                                                            progress_callback=progress_callback,
+                                                                            cancel_event=cancel_event)
+
+        if not mask.any():
+            raise ValueError("The thresholded US volumes do not overlap - check the threshold range.")
+
+        return mask, grid_ijk_to_ras
+
+    def compute_intersection(self, usVolumes, threshold_range=(1, 255)):
+        """
+    Computes the intersection of the thresholded US volumes on the grid of the first volume (cropped to the overlap
+    of the volume bounding boxes)
+    :param usVolumes: A list of US volume nodes
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    return: The PackedMask and the IJK-to-RAS matrix of its grid
+    """
+        volumes, grid_shape, grid_ijk_to_ras = self.get_intersection_inputs(usVolumes)
+
+        return self.compute_intersection_mask(volumes, grid_shape, grid_ijk_to_ras, threshold_range)
+
+    @staticmethod
+    def show_intersection(mask, ijk_to_ras, name="US intersection", segmentationNode=None):
+        """
+    Displays an intersection mask as an outline in the slice views
+    :param mask: The PackedMask
+    :param ijk_to_ras: The IJK-to-RAS matrix of the mask
+    :param name: The name of the created segmentation node
+    :param segmentationNode: An existing segmentation node whose segments are replaced by the mask (optional)
+    return: The segmentation node and the ID of the intersection segment
+    """
+        # import the mask through a temporary labelmap, so that the segmentation gets the geometry of the mask
+        labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        slicer.util.updateVolumeFromArray(labelmapNode, mask.to_labelmap())
+        labelmapNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijk_to_ras))
+
+        if segmentationNode is None:
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", name)
+            segmentationNode.CreateDefaultDisplayNodes()
+        else:
+            segmentationNode.GetSegmentation().RemoveAllSegments()
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+
+        slicer.mrmlScene.RemoveNode(labelmapNode)
+
+        intersection_segment_id = segmentationNode.GetSegmentation().GetNthSegmentID(0)
 
         # display only outline
         # https://slicer.readthedocs.io/en/latest/developer_guide/script_repository.html#modify-segmentation-display-options
         # http://apidocs.slicer.org/master/classvtkMRMLSegmentationDisplayNode.html#afeca62a2a79513ab275db3840136709c
-        segmentation = slicer.mrmlScene.GetNodeByID(segmentationNode.GetID())
-        displayNode = segmentation.GetDisplayNode()
+        displayNode = segmentationNode.GetDisplayNode()
         displayNode.SetSegmentOpacity2DFill(intersection_segment_id, 0.0)  # Set fill opacity of a single segment
         displayNode.SetSegmentOpacity2DOutline(intersection_segment_id, 1.0)  # Set outline opacity of a single segment
 
+        return segmentationNode, intersection_segment_id
+
+    def get_checked_us_volumes(self, volumes):
+        """
+    Returns the US volumes among the chosen volumes and raises if there are not enough for an intersection
+    :param volumes: The chosen volumes
+    """
+        usVolumes = self.get_us_volumes(volumes)
+
+        if len(usVolumes) <= 1:
+            raise ValueError(
+                "Select at least two US volumes (intersection is only calculated for US volumes). (They "
+                "need to contain us1, us2, us3, ... in their names")
+
+        return usVolumes
+
+    def process(self, volumes=None, threshold_range=(1, 255), preview_factor=4, on_progress=None, on_done=None,
+                on_error=None):
+        """
+    Creates the intersection of the us volumes and displays it as an outline. If the intersection is neither cached nor
+    stored, a preview computed on a preview_factor times coarser grid is displayed first and refined to full resolution
+    in the background (see process_coarse_to_fine()).
+    :param volumes: The chosen volumes (only US volumes are used for the intersection)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param preview_factor: The downsampling factor of the preview (<= 1 computes the full resolution right away)
+    :param on_progress: Called with (finished coarse slices, all coarse slices to refine)
+    :param on_done: Called with the segmentation node once the full resolution intersection is displayed
+    :param on_error: Called with the exception if the refinement failed
+    return: The started refinement BackgroundTask or None if the full resolution intersection is already displayed
+    """
+
+        if volumes is None:
+            return None
+
+        import time
+        startTime = time.time()
+        logging.info('Processing started')
+
+        usVolumes = self.get_checked_us_volumes(volumes)
+
+        # a refinement of an earlier preview would overwrite this intersection
+        self.cancel_refinement()
+
+        key = self.get_intersection_key(usVolumes, threshold_range)
+        compute_mask = None
+
+        if key not in self.intersection_cache:
+            content_key = self.compute_content_key(self.get_digest_inputs(usVolumes), threshold_range)
+            stored = self.mask_store.load(content_key)
+
+            if stored is None and preview_factor > 1:
+                return self.process_coarse_to_fine(usVolumes, key, content_key, threshold_range, preview_factor,
+                                                   on_progress=on_progress, on_done=on_done, on_error=on_error)
+
+            def compute_mask():
+                if stored is not None:
+                    return stored
+
+                mask, ijk_to_ras = self.compute_intersection(usVolumes, threshold_range)
+                self.mask_store.save(content_key, mask, ijk_to_ras)
+
+                return mask, ijk_to_ras
+
+        segmentationNode = self.display_cached_intersection(key, compute_mask)
+
         stopTime = time.time()
         logging.info('Processing completed in {0:.2f} seconds'.format(stopTime - startTime))
 
+        if on_done is not None:
+            on_done(segmentationNode)
+
+        return None
+
+    def process_coarse_to_fine(self, usVolumes, key, content_key, threshold_range=(1, 255), factor=4,
+                               on_progress=None, on_done=None, on_error=None):
+        """
+    Displays a preview of the intersection computed on a factor times coarser grid right away and refines it to full
+    resolution in a worker thread - only the blocks on the border of the preview are sampled again. The full resolution
+    intersection replaces the preview once it is done.
+    :param usVolumes: A list of US volume nodes
+    :param key: The key returned by get_intersection_key()
+    :param content_key: The key returned by compute_content_key() (the refined mask is stored under it)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param factor: The downsampling factor of the preview
+    :param on_progress: Called with (finished coarse slices, all coarse slices to refine)
+    :param on_done: Called with the segmentation node once the full resolution intersection is displayed
+    :param on_error: Called with the exception if the refinement failed
+    return: The started BackgroundTask or None if the intersection had to be computed at full resolution right away
+    """
+        import time
+        startTime = time.time()
+
+        volumes, grid_shape, grid_ijk_to_ras = self.get_intersection_inputs(usVolumes)
+
+        coarse_mask = self.show_intersection_preview(key, volumes, grid_shape, grid_ijk_to_ras, threshold_range, factor)
+
+        # an overlap that is too small for the coarse grid has to be computed at full resolution
+        if coarse_mask is None:
+            def compute_mask():
+                entry = self.compute_intersection_mask(volumes, grid_shape, grid_ijk_to_ras, threshold_range)
+                self.mask_store.save(content_key, *entry)
+                return entry
+
+            segmentationNode = self.display_cached_intersection(key, compute_mask)
+
+            if on_done is not None:
+                on_done(segmentationNode)
+
+            return None
+
+        logging.info('Preview displayed after {0:.2f} seconds'.format(time.time() - startTime))
+
+        def refine(progress_callback, cancel_event):
+            mask = MRUSLandmarkingLib.utils_intersection.refine_mask(coarse_mask, factor, volumes, grid_shape,
+                                                                     grid_ijk_to_ras, threshold_range,
+                                                                     progress_callback=progress_callback,
+                                                                     cancel_event=cancel_event)
+            if not mask.any():
+                raise ValueError("The thresholded US volumes do not overlap - check the threshold range.")
+
+            self.mask_store.save(content_key, mask, grid_ijk_to_ras)
+
+            return mask, grid_ijk_to_ras
+
+        def show(entry):
+            try:
+                segmentationNode = self.display_cached_intersection(key, lambda: entry)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                return
+
+            logging.info('Processing completed in {0:.2f} seconds'.format(time.time() - startTime))
+
+            if on_done is not None:
+                on_done(segmentationNode)
+
+        self.refinement_task = MRUSLandmarkingLib.utils_tasks.BackgroundTask(refine, on_progress=on_progress,
+                                                                             on_done=show, on_error=on_error)
+        self.refinement_task.start()
+
+        return self.refinement_task
+
+    def show_intersection_preview(self, key, volumes, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255), factor=4):
+        """
+    Displays the intersection computed on a factor times coarser grid (cached under the key of the full resolution
+    intersection followed by ("preview", factor))
+    :param key: The key returned by get_intersection_key()
+    :param volumes: A list of (array, ijk_to_ras) tuples
+    :param grid_shape: The (k, j, i) shape of the full resolution grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the full resolution grid
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param factor: The downsampling factor of the preview
+    return: The coarse PackedMask or None if the overlap is too small for the coarse grid (nothing is displayed then)
+    """
+        coarse_shape, coarse_ijk_to_ras = MRUSLandmarkingLib.utils_intersection.downsample_grid(grid_shape,
+                                                                                                grid_ijk_to_ras, factor)
+        coarse_mask = MRUSLandmarkingLib.utils_intersection.intersection_mask(volumes, coarse_shape, coarse_ijk_to_ras,
+                                                                              threshold_range)
+        if not coarse_mask.any():
+            return None
+
+        self.display_cached_intersection(key + ("preview", factor), lambda: (coarse_mask, coarse_ijk_to_ras))
+
+        return coarse_mask
+
+    def cancel_refinement(self):
+        if self.refinement_task is not None and self.refinement_task.is_running():
+            self.refinement_task.cancel()
+
+    def get_volume_version(self, volumeNode):
+        """
+    Returns a token that changes whenever the voxels or the geometry of a volume change
+    """
+        return volumeNode.GetImageData().GetMTime(), self.get_ijk_to_world_matrix(volumeNode).tobytes()
+
+    def plan_coverage_update(self, usVolumes, threshold_range=(1, 255), min_coverage=0):
+        """
+    Brings self.coverage in line with the chosen US volumes as far as possible without touching voxels: volumes that
+    are no longer chosen are removed, and the coverage is reset when its reference volume or the threshold changed.
+    The coverage only counts the part of the reference grid in which at least min_coverage of the bounding boxes
+    overlap (like get_intersection_grid() for all volumes), so it is also reset when that part grows beyond the
+    counted one.
+    :param usVolumes: A list of US volume nodes (the first one defines the grid)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    return: A list of (ID, array, ijk_to_ras, version) tuples of the volumes that still have to be added
+    """
+        utils_intersection = MRUSLandmarkingLib.utils_intersection
+
+        reference = (usVolumes[0].GetID(), self.get_volume_version(usVolumes[0]))
+        level = len(usVolumes) if min_coverage <= 0 or min_coverage >= len(usVolumes) else min_coverage
+
+        boxes = [(slicer.util.arrayFromVolume(volume).shape, self.get_ijk_to_world_matrix(volume))
+                 for volume in usVolumes]
+        bounds = utils_intersection.crop_bounds(boxes[0][0], boxes[0][1], boxes, level)
+        if bounds is None:
+            raise ValueError("The bounding boxes of the chosen US volumes do not have a common overlap.")
+
+        if self.coverage is None or self.coverage_reference != reference or \
+                self.coverage.threshold_range != tuple(threshold_range) or \
+                not all(self.coverage_bounds[axis].start <= bounds[axis].start and
+                        bounds[axis].stop <= self.coverage_bounds[axis].stop for axis in range(3)):
+            self.coverage = utils_intersection.CoverageAccumulator(
+                tuple(s.stop - s.start for s in bounds), utils_intersection.sub_grid(boxes[0][1], bounds),
+                threshold_range)
+            self.coverage_reference = reference
+            self.coverage_bounds = bounds
+
+        self.coverage_level = level
+
+        volume_ids = [volume.GetID() for volume in usVolumes]
+        for key in self.coverage.keys():
+            if key not in volume_ids:
+                self.coverage.remove(key)
+
+        pending = []
+        for volume in usVolumes:
+            version = self.get_volume_version(volume)
+
+            if volume.GetID() in self.coverage and self.coverage.version(volume.GetID()) == version:
+                continue
+
+            pending.append((volume.GetID(), slicer.util.arrayFromVolume(volume), self.get_ijk_to_world_matrix(volume),
+                            version))
+
+        return pending
+
+    @staticmethod
+    def threshold_coverage_masks(coverage, pending, progress_callback=None, cancel_event=None):
+        """
+    Thresholds the volumes returned by plan_coverage_update() on the grid of a coverage in parallel worker processes
+    (neither the coverage nor the scene are changed, so this can run in a worker thread)
+    :param coverage: The CoverageAccumulator whose grid and threshold are used
+    :param pending: A list of (ID, array, ijk_to_ras, version) tuples
+    :param progress_callback: Optional function called with (finished volumes, all volumes)
+    :param cancel_event: Optional threading.Event that cancels the computation
+    return: A list of (ID, bounds, mask, version) tuples for CoverageAccumulator.add_mask()
+    """
+        jobs = []
+        bounds = []
+        for key, array, ijk_to_ras, version in pending:
+            volume_bounds = coverage.volume_bounds(array.shape, ijk_to_ras)
+            bounds.append(volume_bounds)
+
+            if volume_bounds is not None:
+                shape = tuple(s.stop - s.start for s in volume_bounds)
+                jobs.append((array, ijk_to_ras, shape,
+                             MRUSLandmarkingLib.utils_intersection.sub_grid(coverage.grid_ijk_to_ras, volume_bounds)))
+
+        masks = iter(MRUSLandmarkingLib.utils_parallel.threshold_volumes(jobs, coverage.threshold_range,
+                                                                         progress_callback=progress_callback,
+                                                                         cancel_event=cancel_event))
+
+        return [(key, volume_bounds, next(masks) if volume_bounds is not None else None, version)
+                for (key, _, _, version), volume_bounds in zip(pending, bounds)]
+
+    @staticmethod
+    def add_coverage_masks(coverage, masks):
+        """
+    Adds the masks returned by threshold_coverage_masks() to the counts of a coverage
+    """
+        for key, volume_bounds, mask, version in masks:
+            coverage.add_mask(key, volume_bounds, mask, version=version)
+
+    def apply_coverage_update(self, pending, progress_callback=None, cancel_event=None):
+        """
+    Adds the volumes returned by plan_coverage_update() to self.coverage (does not touch the scene). The volumes are
+    thresholded in parallel worker processes, only the coverage counts are updated here.
+    :param pending: A list of (ID, array, ijk_to_ras, version) tuples
+    :param progress_callback: Optional function called with (finished volumes, all volumes)
+    :param cancel_event: Optional threading.Event that cancels the computation
+    """
+        self.add_coverage_masks(self.coverage, self.threshold_coverage_masks(self.coverage, pending, progress_callback,
+                                                                             cancel_event))
+
+    def get_digest_inputs(self, usVolumes):
+        """
+    Collects what compute_content_key() needs from the scene
+    :param usVolumes: A list of US volume nodes (the first one defines the grid)
+    return: A list of (ID, version, array, ijk_to_ras) tuples
+    """
+        return [(volume.GetID(), self.get_volume_version(volume), slicer.util.arrayFromVolume(volume),
+                 self.get_ijk_to_world_matrix(volume)) for volume in usVolumes]
+
+    def compute_content_key(self, digest_inputs, threshold_range=(1, 255), min_coverage=0, volume_digests=None):
+        """
+    Returns the key of an intersection in the on-disk mask store (does not touch the scene). The voxel data of each
+    volume is only hashed again when its version changed.
+    :param digest_inputs: The list returned by get_digest_inputs()
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    :param volume_digests: The dict of volume ID -> (version, digest) that is read and updated (self.volume_digests by
+                           default - pass a copy when running in a worker thread)
+    """
+        if volume_digests is None:
+            volume_digests = self.volume_digests
+
+        digests = []
+
+        for volume_id, version, array, ijk_to_ras in digest_inputs:
+            cached = volume_digests.get(volume_id)
+
+            if cached is None or cached[0] != version:
+                cached = (version, MRUSLandmarkingLib.utils_mask_store.volume_digest(array, ijk_to_ras))
+                volume_digests[volume_id] = cached
+
+            digests.append(cached[1])
+
+        return MRUSLandmarkingLib.utils_mask_store.content_key(digests, threshold_range, min_coverage)
+
+    def load_stored_intersection(self, usVolumes, threshold_range=(1, 255), min_coverage=0):
+        """
+    Displays the intersection of the given volumes if it is in the on-disk mask store
+    :param usVolumes: A list of US volume nodes (the first one defines the grid)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    return: True if a stored intersection is displayed
+    """
+        content_key = self.compute_content_key(self.get_digest_inputs(usVolumes), threshold_range, min_coverage)
+
+        stored = self.mask_store.load(content_key)
+        if stored is None:
+            return False
+
+        self.display_cached_intersection(self.get_intersection_key(usVolumes, threshold_range, min_coverage),
+                                         lambda: stored)
+
+        return True
+
+    def load_case_intersection(self, usVolumes, path, threshold_range=(1, 255)):
+        """
+    Displays an intersection precomputed by process_dataset() if it was computed with the given threshold from the
+    given volumes
+    :param usVolumes: The US volume nodes of the case (the first one defines the grid)
+    :param path: The path returned by utils_batch.case_intersection_file()
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    return: True if the intersection is displayed
+    """
+        digests = [MRUSLandmarkingLib.utils_batch.input_digest(slicer.util.arrayFromVolume(volume),
+                                                               self.get_ijk_to_world_matrix(volume))
+                   for volume in usVolumes]
+
+        if not MRUSLandmarkingLib.utils_batch.is_case_intersection_current(path, threshold_range, digests=digests):
+            return False
+
+        mask, ijk_to_ras, _ = MRUSLandmarkingLib.utils_mask_store.read_mask_nrrd(path)
+
+        self.display_cached_intersection(self.get_intersection_key(usVolumes, threshold_range),
+                                         lambda: (mask, ijk_to_ras))
+
+        return True
+
+    @staticmethod
+    def process_dataset(main_directory, threshold_range=(1, 255), cases=None, max_workers=None, overwrite=False):
+        """
+    Computes the intersections of all cases of the AMIGO dataset (CaseNNN/Intraop-US) in parallel worker processes
+    without the scene - see MRUSLandmarkingLib/batch_intersection.py for running it with Slicer --no-main-window.
+    The intersection of each case is written next to its US volumes, and the per-case timings to
+    intersection_summary.csv in the dataset directory.
+    :param main_directory: The dataset directory (containing the CaseNNN folders)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param cases: Optional list of case numbers (all cases if None)
+    :param max_workers: The number of worker processes (defaults to the number of CPUs)
+    :param overwrite: If False, cases with an intersection computed with the same threshold from the same US volumes
+                      are skipped
+    return: The list of per-case summary rows (dicts)
+    """
+        import time
+        startTime = time.time()
+        logging.info('Batch processing started')
+
+        rows = MRUSLandmarkingLib.utils_batch.process_dataset(main_directory, threshold_range, cases=cases,
+                                                              max_workers=max_workers, overwrite=overwrite)
+
+        statuses = [row["status"] for row in rows]
+        stopTime = time.time()
+        logging.info('Batch processing completed in {0:.2f} seconds ({1} computed, {2} existing, {3} skipped, '
+                     '{4} failed)'.format(stopTime - startTime, statuses.count("computed"), statuses.count("existing"),
+                                          statuses.count("skipped"), statuses.count("failed")))
+
+        return rows
+
+    def get_intersection_key(self, usVolumes, threshold_range=(1, 255), min_coverage=0):
+        """
+    Returns the key under which the intersection of the given volumes is cached
+    :param usVolumes: A list of US volume nodes (the first one defines the grid)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    """
+        versions = {volume.GetID(): self.get_volume_version(volume) for volume in usVolumes}
+
+        return self.make_intersection_key(usVolumes[0].GetID(), versions, threshold_range, min_coverage)
+
+    @staticmethod
+    def make_intersection_key(reference_id, versions, threshold_range, min_coverage):
+        """
+    Builds a cache key from the reference volume ID, a dict of volume ID -> version, the threshold and the coverage
+    """
+        if min_coverage <= 0 or min_coverage >= len(versions):
+            min_coverage = 0  # all volumes
+
+        return (reference_id, tuple(sorted(versions.items())), tuple(float(t) for t in threshold_range),
+                min_coverage)
+
+    def display_cached_intersection(self, key, compute_mask):
+        """
+    Displays the intersection cached under the given key. On a cache miss the mask is computed and cached first. The
+    same segmentation node is reused for every intersection, and nothing is done if it already shows the key. With
+    outline_per_slice the mask is handed to the SliceOutlineDisplay instead (and no segmentation node is created).
+    :param key: The key returned by get_intersection_key()
+    :param compute_mask: A function returning the mask and its IJK-to-RAS matrix (only called on a cache miss)
+    return: The segmentation node (None for per-slice outlines)
+    """
+        entry = self.intersection_cache.get(key)
+
+        if entry is None:
+            entry = compute_mask()
+            self.intersection_cache.put(key, entry, entry[0].nbytes)
+
+        if self.outline_per_slice:
+            if self.outline_display is None:
+                self.outline_display = MRUSLandmarkingLib.utils_outline.SliceOutlineDisplay()
+
+            if self.outline_display.mask is None or self.intersection_node_key != key:
+                self.remove_intersection_node()
+                self.outline_display.set_mask(*entry)
+                self.intersection_node_key = key
+
+            return None
+
+        if self.outline_display is not None:
+            self.outline_display.clear()
+
+        segmentationNode = self.intersection_node
+        if segmentationNode is not None and not slicer.mrmlScene.IsNodePresent(segmentationNode):
+            segmentationNode = None
+
+        if segmentationNode is not None and self.intersection_node_key == key:
+            return segmentationNode
+
+        self.intersection_node, _ = self.show_intersection(*entry, segmentationNode=segmentationNode)
+        self.intersection_node_key = key
+
+        return self.intersection_node
+
+    def remove_intersection_node(self):
+        if self.intersection_node is not None and slicer.mrmlScene.IsNodePresent(self.intersection_node):
+            slicer.mrmlScene.RemoveNode(self.intersection_node)
+
+        self.intersection_node = None
+        self.intersection_node_key = None
+
+    def remove_intersection_display(self):
+        """
+    Removes the displayed intersection, no matter if it is shown as a segmentation or as per-slice outlines
+    """
+        self.remove_intersection_node()
+
+        if self.outline_display is not None:
+            self.outline_display.clear()
+
+    def is_intersection_displayed(self):
+        if self.outline_per_slice:
+            return self.outline_display is not None and self.outline_display.mask is not None
+
+        return self.intersection_node is not None and slicer.mrmlScene.IsNodePresent(self.intersection_node)
+
+    def set_outline_per_slice(self, enabled):
+        """
+    Chooses how intersections are displayed - a displayed intersection is shown again in the new way (from the cache)
+    :param enabled: If True, only the outlines of the displayed slices are computed, otherwise a segmentation is built
+    """
+        if enabled == self.outline_per_slice:
+            return
+
+        displayed = self.is_intersection_displayed()
+        key = self.intersection_node_key
+
+        self.remove_intersection_display()
+        self.outline_per_slice = enabled
+
+        if displayed and key in self.intersection_cache:
+            self.display_cached_intersection(key, None)
+
+    def show_coverage(self, min_coverage=0):
+        """
+    Displays the voxels that are covered by at least min_coverage of the US volumes in self.coverage, replacing the
+    previously displayed intersection
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    return: The segmentation node
+    """
+        return self.display_cached_intersection(self.get_coverage_key(min_coverage),
+                                                lambda: self.compute_coverage_mask(min_coverage))
+
+    def coverage_serves(self, min_coverage=0):
+        """
+    return: True if self.coverage counts all voxels that can be covered by at least min_coverage of its volumes (the
+            counts are cropped to the level they were last computed for)
+    """
+        if self.coverage is None:
+            return False
+
+        level = len(self.coverage) if min_coverage <= 0 or min_coverage >= len(self.coverage) else min_coverage
+
+        return level >= self.coverage_level
+
+    def get_coverage_key(self, min_coverage=0):
+        """
+    Returns the cache key of the voxels that are covered by at least min_coverage of the US volumes in self.coverage
+    """
+        if self.coverage is None:
+            raise ValueError("Create an intersection first.")
+
+        versions = {key: self.coverage.version(key) for key in self.coverage.keys()}
+
+        return self.make_intersection_key(self.coverage_reference[0], versions, self.coverage.threshold_range,
+                                          min_coverage)
+
+    def compute_coverage_mask(self, min_coverage=0):
+        """
+    Computes the voxels that are covered by at least min_coverage of the US volumes in self.coverage
+    return: The PackedMask (cropped to the covered voxels) and the IJK-to-RAS matrix of its grid
+    """
+        if self.coverage is None:
+            raise ValueError("Create an intersection first.")
+
+        if min_coverage <= 0 or min_coverage >= len(self.coverage):
+            mask = self.coverage.intersection()
+        else:
+            mask = self.coverage.at_least(min_coverage)
+
+        mask, ijk_to_ras = MRUSLandmarkingLib.utils_intersection.crop_to_mask(mask, self.coverage.grid_ijk_to_ras)
+
+        if mask is None:
+            raise ValueError("The thresholded US volumes do not overlap - check the threshold range.")
+
+        return mask, ijk_to_ras
+
+    def update_intersection(self, volumes, threshold_range=(1, 255), min_coverage=0):
+        """
+    Updates the displayed intersection after volumes were added or removed - only the masks of the new volumes are
+    computed, all others are reused from the previous intersection
+    :param volumes: The chosen volumes (only US volumes are used for the intersection)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    return: The segmentation node
+    """
+        usVolumes = self.get_checked_us_volumes(volumes)
+
+        if min_coverage <= 0 or min_coverage >= len(usVolumes):
+            self.check_bounding_boxes(usVolumes)
+
+        self.apply_coverage_update(self.plan_coverage_update(usVolumes, threshold_range, min_coverage))
+
+        return self.show_coverage(min_coverage)
+
+    def process_in_background(self, volumes, threshold_range=(1, 255), min_coverage=0, preview_factor=4,
+                              on_progress=None, on_done=None, on_error=None, on_cancelled=None):
+        """
+    Same as process(), but the voxel work runs in a worker thread. The per-volume masks are kept (see
+    update_intersection()), so only volumes that changed since the last intersection are thresholded again. The
+    bounding box check still runs immediately (and raises on failure), the intersection is displayed on the main thread
+    once the worker is done. Until then, an intersection of all volumes that has to be thresholded again is previewed
+    on a preview_factor times coarser grid (see show_intersection_preview()).
+    :param volumes: The chosen volumes (only US volumes are used for the intersection)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    :param preview_factor: The downsampling factor of the preview (<= 1 shows no preview)
+    :param on_progress: Called with (finished volumes, all volumes)
+    :param on_done: Called with the segmentation node after the intersection is displayed
+    :param on_error: Called with the exception if the computation failed
+    :param on_cancelled: Called when the computation was cancelled
+    return: The started BackgroundTask (call cancel() on it to stop the computation) or None if the intersection was
+            cached and is already displayed
+    """
+        import time
+        startTime = time.time()
+        logging.info('Processing started (in background)')
+
+        usVolumes = self.get_checked_us_volumes(volumes)
+
+        # nothing to compute if the intersection is still cached
+        key = self.get_intersection_key(usVolumes, threshold_range, min_coverage)
+        if key in self.intersection_cache:
+            segmentationNode = self.display_cached_intersection(key, None)
+
+            logging.info('Processing completed (cached intersection)')
+
+            if on_done is not None:
+                on_done(segmentationNode)
+
+            return None
+
+        all_volumes = min_coverage <= 0 or min_coverage >= len(usVolumes)
+        if all_volumes:
+            self.check_bounding_boxes(usVolumes)
+
+        pending = self.plan_coverage_update(usVolumes, threshold_range, min_coverage)
+        digest_inputs = self.get_digest_inputs(usVolumes)
+
+        preview_key = None
+        if pending and all_volumes and preview_factor > 1:
+            if self.show_intersection_preview(key, *self.get_intersection_inputs(usVolumes), threshold_range,
+                                              preview_factor) is not None:
+                preview_key = key + ("preview", preview_factor)
+
+        def remove_preview():
+            # a preview must not stay displayed if the full resolution intersection is not shown
+            if preview_key is not None and self.intersection_node_key == preview_key:
+                self.remove_intersection_display()
+
+        def failed(error):
+            remove_preview()
+            if on_error is not None:
+                on_error(error)
+
+        def cancelled():
+            remove_preview()
+            if on_cancelled is not None:
+                on_cancelled()
+
+        # the worker only reads these - the results are committed to self on the main thread in show()
+        coverage = self.coverage
+        volume_digests = dict(self.volume_digests)
+
+        def compute(progress_callback, cancel_event):
+            # an intersection stored in an earlier session does not need the per-volume masks
+            content_key = self.compute_content_key(digest_inputs, threshold_range, min_coverage, volume_digests)
+            stored = self.mask_store.load(content_key)
+
+            masks = None
+            if stored is None:
+                masks = self.threshold_coverage_masks(coverage, pending, progress_callback=progress_callback,
+                                                      cancel_event=cancel_event)
+
+            return content_key, stored, masks
+
+        def show(result):
+            content_key, stored, masks = result
+
+            self.volume_digests.update(volume_digests)
+
+            try:
+                if masks is not None:
+                    if self.coverage is not coverage:
+                        raise RuntimeError("The intersection was changed while it was computed - create it again.")
+
+                    self.add_coverage_masks(coverage, masks)
+
+                if stored is not None:
+                    segmentationNode = self.display_cached_intersection(key, lambda: stored)
+                else:
+                    # the mask is not in the cache if it was evicted or is larger than the cache budget
+                    coverage_key = self.get_coverage_key(min_coverage)
+                    entry = self.intersection_cache.get(coverage_key)
+                    if entry is None:
+                        entry = self.compute_coverage_mask(min_coverage)
+
+                    segmentationNode = self.display_cached_intersection(coverage_key, lambda: entry)
+
+                    # write the new mask to the store without blocking the GUI
+                    mask, ijk_to_ras = entry
+                    threading.Thread(target=self.mask_store.save, args=(content_key, mask, ijk_to_ras),
+                                     daemon=True).start()
+            except Exception as e:
+                failed(e)
+                return
+
+            stopTime = time.time()
+            logging.info('Processing completed in {0:.2f} seconds'.format(stopTime - startTime))
+
+            if on_done is not None:
+                on_done(segmentationNode)
+
+        task = MRUSLandmarkingLib.utils_tasks.BackgroundTask(compute, on_progress=on_progress, on_done=show,
+                                                             on_error=failed, on_cancelled=cancelled)
+        task.start()
+
+        return task
+
 
 #
 # MRUSLandmarkingTest
@@ -1110,6 +2178,6 @@ class MRUSLandmarkingTest(ScriptedLoadableModuleTest):
 
         logic = MRUSLandmarkingLogic()
 
-        logic.process(None, None)
+        logic.process(None)
 
         self.delayDisplay('Test passed')
@@ -0,0 +1,51 @@
+"""
+Precomputes the US FOV intersection of every case of the AMIGO dataset without the GUI:
+
+    Slicer --no-main-window --python-script batch_intersection.py <dataset directory> [--threshold 1 255]
+           [--cases 1 2 3] [--workers N] [--overwrite]
+
+The intersection of a case is written next to its US volumes (CaseNNN/Intraop-US) and is displayed by 'Load case'.
+The per-case timings are written to intersection_summary.csv in the dataset directory.
+
+Everything but the argument parsing happens under the __main__ guard, as the worker processes import this file again.
+"""
+import argparse
+import logging
+import sys
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Precompute the US FOV intersections of a dataset")
+    parser.add_argument("main_directory", help="The dataset directory (containing the CaseNNN folders)")
+    parser.add_argument("--threshold", nargs=2, type=float, default=(1, 255), metavar=("MINIMUM", "MAXIMUM"),
+                        help="Intensity range that counts as inside the FOV")
+    parser.add_argument("--cases", nargs="+", type=int, help="Case numbers (default: all cases)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--overwrite", action="store_true", help="Recompute intersections that are up to date")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_arguments(argv)
+
+    from MRUSLandmarking import MRUSLandmarkingLogic
+
+    rows = MRUSLandmarkingLogic.process_dataset(args.main_directory, tuple(args.threshold), cases=args.cases,
+                                                max_workers=args.workers, overwrite=args.overwrite)
+
+    return 1 if any(row["status"] == "failed" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    # Slicer keeps running after the script unless it is told to exit, so it has to exit on errors as well
+    exit_code = 1
+    try:
+        exit_code = main(sys.argv[1:])
+    except SystemExit as e:  # argparse exits on --help and on invalid arguments
+        exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        logging.exception("Precomputing the intersections failed")
+    finally:
+        import slicer
+        slicer.util.exit(exit_code)
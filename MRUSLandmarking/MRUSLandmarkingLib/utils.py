@@ -23,53 +23,94 @@ def markup_curve_adjustment(curve_node_id):
     dispNode.Modified()
 
 
-class VolumeNode:
-    def __init__(self, volume_id: str = ""):
-        self.volume_id = volume_id
-        self.next_node = None
-        self.previous_node = None
+class VolumeRing:
+    """
+    Ring of the chosen volume IDs for cycling through the volumes. The IDs are kept in a list together with an
+    ID -> index dict, so seeking to an ID and stepping to the next or previous ID are O(1) for any number of volumes.
+    """
 
+    def __init__(self, volume_ids=()):
+        self._volume_ids = []
+        self._indices = {}
+        self._current = 0
 
-class VolumeCircle:
-    def __init__(self, max_length=5):
-        self.current_volume_node = None
-        self.max_length = max_length
-        self.current_length = 0
+        self.set_volume_ids(volume_ids)
 
-        self.first_node = None
+    def __len__(self):
+        return len(self._volume_ids)
 
-    def add_volume_node(self, volume_node: 'VolumeNode'):
+    def __contains__(self, volume_id):
+        return volume_id in self._indices
 
-        if self.current_length == self.max_length:
-            print(f"Cannot add more than {self.max_length} nodes. Nothing added.")
-            return
+    def __iter__(self):
+        return iter(self._volume_ids)
 
-        if self.current_volume_node is None:
-            self.current_volume_node = volume_node
-            self.first_node = volume_node
-            self.current_length += 1
-            return
+    def set_volume_ids(self, volume_ids):
+        """
+        Replaces the volumes of the ring (duplicates are ignored). The ring stays at the current volume if it is still
+        part of it, otherwise it starts at the first volume.
+        """
+        current_id = self.get_current_id()
 
-        if self.current_volume_node is not None and self.current_length < self.max_length:
-            self.current_volume_node.next_node = volume_node
+        self._volume_ids = list(dict.fromkeys(volume_ids))
+        self._indices = {volume_id: idx for idx, volume_id in enumerate(self._volume_ids)}
+        self._current = self._indices.get(current_id, 0)
 
-            volume_node.previous_node = self.current_volume_node
+    def seek(self, volume_id):
+        """
+        Makes a volume the current one
+        return: False if the volume is not part of the ring (the current volume does not change then)
+        """
+        idx = self._indices.get(volume_id)
 
-            self.current_volume_node = volume_node
+        if idx is None:
+            return False
 
-            self.current_length += 1
+        self._current = idx
 
-            if self.current_length == self.max_length:
-                self.current_volume_node.next_node = self.first_node
-                self.first_node.previous_node = self.current_volume_node
+        return True
 
-    def get_next_node(self):
-        self.current_volume_node = self.current_volume_node.next_node
-        return self.current_volume_node.volume_id
+    def get_current_id(self):
+        """
+        Returns the current volume ID (None if the ring is empty)
+        """
+        if not self._volume_ids:
+            return None
 
-    def get_previous_node(self):
-        self.current_volume_node = self.current_volume_node.previous_node
-        return self.current_volume_node.volume_id
+        return self._volume_ids[self._current]
 
-    def get_current_node(self):
-        return self.current_volume_node.volume_id
+    def peek(self, offset=1, volume_id=None):
+        """
+        Returns the volume ID offset steps away from a volume without moving the ring
+        :param offset: The number of steps (negative for backward)
+        :param volume_id: The volume to start from (defaults to the current one)
+        return: The volume ID or None if the ring is empty or the volume is not part of it
+        """
+        idx = self._current if volume_id is None else self._indices.get(volume_id)
+
+        if not self._volume_ids or idx is None:
+            return None
+
+        return self._volume_ids[(idx + offset) % len(self._volume_ids)]
+
+    def get_next_id(self):
+        """
+        Steps forward and returns the new current volume ID (None if the ring is empty)
+        """
+        if not self._volume_ids:
+            return None
+
+        self._current = (self._current + 1) % len(self._volume_ids)
+
+        return self._volume_ids[self._current]
+
+    def get_previous_id(self):
+        """
+        Steps backward and returns the new current volume ID (None if the ring is empty)
+        """
+        if not self._volume_ids:
+            return None
+
+        self._current = (self._current - 1) % len(self._volume_ids)
+
+        return self._volume_ids[self._current]
@@ -0,0 +1,290 @@
+"""
+Batch computation of the US FOV intersections of the AMIGO dataset (CaseNNN/Intraop-US/...). Every case is processed
+in its own worker process, which reads the US volumes from disk with SimpleITK, so nothing in here needs the MRML
+scene. The intersection of a case is written next to its US volumes, where 'Load case' picks it up.
+"""
+import csv
+import logging
+import os
+import re
+import time
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import MRUSLandmarkingLib.utils_intersection
+import MRUSLandmarkingLib.utils_mask_store
+import MRUSLandmarkingLib.utils_parallel
+
+US_FOLDER = "Intraop-US"
+SUMMARY_FILE = "intersection_summary.csv"
+SUMMARY_COLUMNS = ["case", "us_volumes", "status", "voxels", "read_seconds", "compute_seconds", "total_seconds",
+                   "message"]
+
+
+def case_folder(main_directory, case_number):
+    """
+    Returns the folder of a case
+    :param main_directory: The dataset directory
+    :param case_number: The case number as int or zero-padded string
+    """
+    return os.path.join(main_directory, f"Case{str(case_number).zfill(3)}")
+
+
+def case_us_files(main_directory, case_number):
+    """
+    Returns the paths of the existing US volumes of a case (the first one defines the grid of the intersection)
+    :param main_directory: The dataset directory
+    :param case_number: The case number as int or zero-padded string
+    """
+    case_number = str(case_number).zfill(3)
+    folder = os.path.join(case_folder(main_directory, case_number), US_FOLDER)
+
+    paths = [os.path.join(folder, f"Case{case_number}-intraop-US-{stage}.nrrd")
+             for stage in ("pre_dura", "post_dura", "pre_imri")]
+
+    return [path for path in paths if os.path.exists(path)]
+
+
+def case_intersection_file(main_directory, case_number):
+    """
+    Returns the path of the precomputed intersection of a case
+    """
+    case_number = str(case_number).zfill(3)
+
+    return os.path.join(case_folder(main_directory, case_number), US_FOLDER,
+                        f"Case{case_number}-intraop-US-intersection.nrrd")
+
+
+def find_cases(main_directory):
+    """
+    Returns the sorted (zero-padded) numbers of all cases that have a US folder
+    """
+    cases = []
+
+    for name in os.listdir(main_directory):
+        match = re.fullmatch(r"Case(\d{3})", name)
+        if match and os.path.isdir(os.path.join(main_directory, name, US_FOLDER)):
+            cases.append(match.group(1))
+
+    return sorted(cases)
+
+
+def threshold_field(threshold_range):
+    return repr(tuple(float(t) for t in threshold_range))
+
+
+def input_digest(array, ijk_to_ras):
+    """
+    Hashes an input volume of a case intersection. The geometry is rounded, so that a volume read with SimpleITK and
+    the same volume loaded into Slicer get the same digest.
+    :param array: The (k, j, i) array of the volume
+    :param ijk_to_ras: The IJK-to-RAS matrix of the volume
+    return: The hex digest
+    """
+    # + 0.0 turns -0.0 into 0.0, which hashes differently
+    return MRUSLandmarkingLib.utils_mask_store.volume_digest(array, np.round(ijk_to_ras, 4) + 0.0)
+
+
+def file_stamp(path):
+    """
+    Returns the name, size and modification time of a file (to skip recomputing the digests of unchanged inputs)
+    """
+    stat = os.stat(path)
+
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def read_volume(path):
+    """
+    Reads a scalar volume with SimpleITK
+    :param path: The file path
+    return: The (k, j, i) array and the IJK-to-RAS matrix
+    """
+    import SimpleITK as sitk
+
+    image = sitk.ReadImage(path)
+    if image.GetNumberOfComponentsPerPixel() != 1:
+        raise ValueError(f"{path} is not a scalar volume.")
+
+    ijk_to_lps = np.eye(4)
+    ijk_to_lps[:3, :3] = np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing())
+    ijk_to_lps[:3, 3] = image.GetOrigin()
+
+    # ITK uses LPS coordinates, Slicer RAS
+    return sitk.GetArrayFromImage(image), np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijk_to_lps
+
+
+def compute_case_intersection(case_number, us_paths, output_path, threshold_range=(1, 255)):
+    """
+    Computes the intersection of the US volumes of one case and writes it to output_path (runs in a worker process)
+    :param case_number: The case number (only used in the summary)
+    :param us_paths: The paths of the US volumes (the first one defines the grid)
+    :param output_path: The path of the written mask
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    return: A summary row (dict with the SUMMARY_COLUMNS)
+    """
+    intersection = MRUSLandmarkingLib.utils_intersection
+
+    start_time = time.time()
+    file_stamps = [file_stamp(path) for path in us_paths]  # before reading, so that later changes are detected
+    volumes = [read_volume(path) for path in us_paths]
+    read_time = time.time()
+
+    boxes = [intersection.oriented_box(array.shape, ijk_to_ras) for array, ijk_to_ras in volumes]
+    for idx in range(1, len(boxes)):
+        if not intersection.oriented_boxes_overlap(boxes[0], boxes[idx]):
+            raise ValueError(f"The bounding box of {os.path.basename(us_paths[idx])} does not overlap with the one of "
+                             f"{os.path.basename(us_paths[0])}.")
+
+    grid = intersection.crop_grid(volumes[0][0].shape, volumes[0][1],
+                                  [(array.shape, ijk_to_ras) for array, ijk_to_ras in volumes])
+    if grid is None:
+        raise ValueError("The bounding boxes of the US volumes do not have a common overlap.")
+
+    mask = intersection.intersection_mask(volumes, grid[0], grid[1], threshold_range)
+    if not mask.any():
+        raise ValueError("The thresholded US volumes do not overlap - check the threshold range.")
+
+    MRUSLandmarkingLib.utils_mask_store.write_mask_nrrd(
+        output_path, mask, grid[1],
+        fields={"mrus_threshold": threshold_field(threshold_range),
+                "mrus_volumes": ";".join(os.path.basename(path) for path in us_paths),
+                "mrus_files": ";".join(file_stamps),
+                "mrus_digests": ";".join(sorted(input_digest(array, ijk_to_ras) for array, ijk_to_ras in volumes))})
+    stop_time = time.time()
+
+    return {"case": case_number, "us_volumes": len(us_paths), "status": "computed", "voxels": mask.count(),
+            "read_seconds": round(read_time - start_time, 3), "compute_seconds": round(stop_time - read_time, 3),
+            "total_seconds": round(stop_time - start_time, 3), "message": ""}
+
+
+def read_header_fields(path):
+    """
+    Returns the key-value pairs (key:=value) of the header of a mask written by write_mask_nrrd() without reading the
+    voxel data
+    """
+    with open(path, "rb") as file:
+        header = file.read(64 * 1024).partition(b"\n\n")[0].decode("ascii", errors="replace")
+
+    return dict(line.split(":=", 1) for line in header.splitlines() if ":=" in line)
+
+
+def is_case_intersection_current(path, threshold_range=(1, 255), us_paths=None, digests=None):
+    """
+    Checks if a precomputed intersection exists and was computed with the given threshold from the same US volumes
+    (only reads the header, and the volumes if their files changed since the intersection was computed)
+    :param path: The path returned by case_intersection_file()
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param us_paths: The paths of the US volumes of the case (if digests is None)
+    :param digests: The input_digest() of every US volume of the case (e.g. of the volumes loaded into Slicer)
+    """
+    if not os.path.exists(path):
+        return False
+
+    fields = read_header_fields(path)
+
+    if fields.get("mrus_threshold") != threshold_field(threshold_range) or "mrus_digests" not in fields:
+        return False
+
+    if digests is None:
+        if fields.get("mrus_files") == ";".join(file_stamp(us_path) for us_path in us_paths):
+            return True
+
+        try:
+            digests = [input_digest(*read_volume(us_path)) for us_path in us_paths]
+        except Exception as e:  # recomputing the case reports the error
+            logging.warning(f"Could not check {path}: {e}")
+            return False
+
+    # the mask has its own grid, so the order of the volumes does not matter
+    return fields["mrus_digests"] == ";".join(sorted(digests))
+
+
+def process_dataset(main_directory, threshold_range=(1, 255), cases=None, max_workers=None, overwrite=False):
+    """
+    Computes the intersections of all cases of a dataset in parallel worker processes (the cases that are left when
+    the pool cannot be used are computed serially) and writes a summary of the per-case timings to SUMMARY_FILE in the
+    dataset directory
+    :param main_directory: The dataset directory (containing the CaseNNN folders)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param cases: Optional list of case numbers (all cases if None)
+    :param max_workers: The number of worker processes (defaults to the number of CPUs)
+    :param overwrite: If False, cases with an intersection computed with the same threshold from the same US volumes
+                      are skipped
+    return: The list of summary rows (dicts with the SUMMARY_COLUMNS), sorted by case
+    """
+    if not os.path.isdir(main_directory):
+        raise FileNotFoundError(f"{main_directory} does not exist.")
+
+    if cases is None:
+        cases = find_cases(main_directory)
+    cases = [str(case).zfill(3) for case in cases]
+
+    def row(case, us_volumes, status, message=""):
+        return {"case": case, "us_volumes": us_volumes, "status": status, "voxels": "", "read_seconds": "",
+                "compute_seconds": "", "total_seconds": "", "message": message}
+
+    rows = []
+    jobs = []
+    for case in cases:
+        us_paths = case_us_files(main_directory, case)
+        output_path = case_intersection_file(main_directory, case)
+
+        if len(us_paths) <= 1:
+            rows.append(row(case, len(us_paths), "skipped", "less than two US volumes"))
+        elif not overwrite and is_case_intersection_current(output_path, threshold_range, us_paths=us_paths):
+            rows.append(row(case, len(us_paths), "existing"))
+        else:
+            jobs.append((case, us_paths, output_path))
+
+    def record(case, us_paths, compute):
+        try:
+            rows.append(compute())
+            logging.info(f"Case {case}: intersection computed in {rows[-1]['total_seconds']} seconds")
+        except Exception as e:
+            rows.append(row(case, len(us_paths), "failed", str(e)))
+            logging.error(f"Case {case}: {e}")
+
+    finished = set()
+    if jobs:
+        max_workers = max_workers or min(len(jobs), os.cpu_count() or 1)
+
+        try:
+            futures = {}
+            for case, us_paths, output_path in jobs:
+                future = MRUSLandmarkingLib.utils_parallel.submit(compute_case_intersection, case, us_paths,
+                                                                  output_path, tuple(threshold_range),
+                                                                  max_workers=max_workers)
+                futures[future] = (case, us_paths)
+
+            for future in as_completed(futures):
+                case, us_paths = futures[future]
+
+                # a broken pool fails all remaining jobs, not only this case
+                if isinstance(future.exception(), BrokenProcessPool):
+                    raise future.exception()
+
+                record(case, us_paths, future.result)
+                finished.add(case)
+
+        except (BrokenProcessPool, OSError) as e:
+            logging.warning(f"Computing the intersections in worker processes failed, computing the remaining cases "
+                            f"serially instead: {e}")
+            MRUSLandmarkingLib.utils_parallel.shutdown_executor()
+
+    for case, us_paths, output_path in jobs:
+        if case not in finished:
+            record(case, us_paths, lambda: compute_case_intersection(case, us_paths, output_path,
+                                                                     tuple(threshold_range)))
+
+    rows.sort(key=lambda r: r["case"])
+
+    with open(os.path.join(main_directory, SUMMARY_FILE), "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return rows
+
@@ -0,0 +1,490 @@
+"""
+Numpy kernels for the US field-of-view (FOV) intersection. Nothing in here touches the MRML scene, so the functions can
+be used from the logic, from worker threads and from batch scripts alike.
+
+Volumes are passed as numpy arrays in the (k, j, i) order returned by slicer.util.arrayFromVolume together with their
+4x4 IJK-to-RAS matrix. A 'grid' is a (shape, ijk_to_ras) pair describing the voxels on which a mask is computed.
+"""
+from concurrent.futures import CancelledError
+
+import numpy as np
+
+from MRUSLandmarkingLib.utils_masks import PackedMask
+
+
+def threshold_mask(array, threshold_range=(1, 255)):
+    """
+    Thresholds an array (inclusive on both ends)
+    :param array: The array to threshold
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    return: A boolean mask
+    """
+    minimum, maximum = threshold_range
+
+    return (array >= minimum) & (array <= maximum)
+
+
+def sample_nearest(array, array_ijk_to_ras, grid_shape, grid_ijk_to_ras, slices=None):
+    """
+    Samples an array at the voxel centres of a grid with nearest neighbour interpolation
+    :param array: The (k, j, i) array to sample
+    :param array_ijk_to_ras: The IJK-to-RAS matrix of the array
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param slices: Optional range of grid k-indices to sample (defaults to all)
+    return: The sampled array with the shape of the grid (or of the requested k-range) and a boolean array that is
+            False where the grid voxel falls outside of the array (the sampled value is 0 there)
+    """
+    grid_to_array = np.linalg.inv(array_ijk_to_ras) @ grid_ijk_to_ras
+
+    if slices is None:
+        slices = range(grid_shape[0])
+
+    # identical sampling grids (e.g. the reference volume itself) do not need any resampling
+    if np.allclose(grid_to_array, np.eye(4)) and tuple(grid_shape) == array.shape:
+        sampled = array[slices.start:slices.stop]
+        return sampled, np.ones(sampled.shape, dtype=bool)
+
+    nj, ni = grid_shape[1], grid_shape[2]
+    j, i = np.meshgrid(np.arange(nj), np.arange(ni), indexing='ij')
+    k = np.arange(slices.start, slices.stop).reshape(-1, 1, 1)
+
+    # array index along each axis as an in-plane part plus an offset per grid slice
+    array_indices = []
+    for axis in range(3):
+        in_plane = grid_to_array[axis, 0] * i + grid_to_array[axis, 1] * j + grid_to_array[axis, 3]
+        array_indices.append(np.rint(in_plane + grid_to_array[axis, 2] * k).astype(np.intp))
+    ai, aj, ak = array_indices
+
+    inside = (ai >= 0) & (ai < array.shape[2]) & (aj >= 0) & (aj < array.shape[1]) & (ak >= 0) & (ak < array.shape[0])
+
+    sampled = np.zeros(inside.shape, dtype=array.dtype)
+    sampled[inside] = array[ak[inside], aj[inside], ai[inside]]
+
+    return sampled, inside
+
+
+def sample_nearest_points(array, array_ijk_to_ras, grid_ijk, grid_ijk_to_ras):
+    """
+    Samples an array at single grid voxels with nearest neighbour interpolation
+    :param array: The (k, j, i) array to sample
+    :param array_ijk_to_ras: The IJK-to-RAS matrix of the array
+    :param grid_ijk: The (3, n) array of the (i, j, k) indices of the grid voxels
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    return: The (n,) sampled values and a boolean array that is False where the voxel falls outside of the array
+    """
+    grid_to_array = np.linalg.inv(array_ijk_to_ras) @ grid_ijk_to_ras
+
+    ai, aj, ak = np.rint(grid_to_array[:3, :3] @ grid_ijk + grid_to_array[:3, 3:]).astype(np.intp)
+
+    inside = (ai >= 0) & (ai < array.shape[2]) & (aj >= 0) & (aj < array.shape[1]) & (ak >= 0) & (ak < array.shape[0])
+
+    sampled = np.zeros(inside.shape, dtype=array.dtype)
+    sampled[inside] = array[ak[inside], aj[inside], ai[inside]]
+
+    return sampled, inside
+
+
+def intersection_mask(volumes, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255), chunk_size=16,
+                      progress_callback=None, cancel_event=None):
+    """
+    Computes the N-way AND of the thresholded volumes on a common grid. Each volume is sampled in chunks of slices so
+    that the coordinate arrays stay small, and chunks that are already empty are skipped for the following volumes.
+    :param volumes: A list of (array, ijk_to_ras) tuples
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param chunk_size: Number of grid slices that are processed at once
+    :param progress_callback: Optional function called with (finished volumes, all volumes) after each volume
+    :param cancel_event: Optional threading.Event - when it is set the computation stops with a CancelledError
+    return: The intersection mask on the grid as a PackedMask (only one chunk is unpacked at a time)
+    """
+    mask = PackedMask.full(grid_shape, True)
+
+    for idx, (array, array_ijk_to_ras) in enumerate(volumes):
+        slice_any = mask.slice_any()
+
+        for start in range(0, grid_shape[0], chunk_size):
+            if cancel_event is not None and cancel_event.is_set():
+                raise CancelledError("The intersection computation was cancelled.")
+
+            slices = range(start, min(start + chunk_size, grid_shape[0]))
+
+            if not slice_any[slices.start:slices.stop].any():
+                continue
+
+            chunk = mask.unpack(slices)
+            sampled, inside = sample_nearest(array, array_ijk_to_ras, grid_shape, grid_ijk_to_ras, slices=slices)
+            chunk &= inside & threshold_mask(sampled, threshold_range)
+            mask.pack(slices, chunk)
+
+        if progress_callback is not None:
+            progress_callback(idx + 1, len(volumes))
+
+    return mask
+
+
+def downsample_grid(grid_shape, grid_ijk_to_ras, factor=4):
+    """
+    Returns a grid with factor times larger voxels that covers the same region. Coarse voxel c covers the grid voxels
+    c * factor to (c + 1) * factor - 1 along each axis (the last coarse voxels may stick out of the grid).
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param factor: The downsampling factor
+    return: The (k, j, i) shape and the IJK-to-RAS matrix of the coarse grid
+    """
+    shape = tuple(-(-int(n) // factor) for n in grid_shape)
+
+    coarse_to_grid = np.diag([float(factor)] * 3 + [1.0])
+    coarse_to_grid[:3, 3] = (factor - 1) / 2
+
+    return shape, grid_ijk_to_ras @ coarse_to_grid
+
+
+def boundary_blocks(coarse):
+    """
+    Finds the voxels of a coarse mask whose 3x3x3 neighbourhood is not uniform - only there the full resolution mask can
+    differ from the coarse one (assuming that the mask has no structures smaller than a coarse voxel)
+    :param coarse: The boolean (k, j, i) coarse mask
+    return: The boolean (k, j, i) array of the boundary voxels
+    """
+    padded = np.pad(coarse, 1, mode='edge')
+    nk, nj, ni = coarse.shape
+
+    any_set = np.zeros(coarse.shape, dtype=bool)
+    all_set = np.ones(coarse.shape, dtype=bool)
+    for dk in range(3):
+        for dj in range(3):
+            for di in range(3):
+                neighbours = padded[dk:dk + nk, dj:dj + nj, di:di + ni]
+                any_set |= neighbours
+                all_set &= neighbours
+
+    return any_set & ~all_set
+
+
+def refine_mask(coarse_mask, factor, volumes, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255),
+                progress_callback=None, cancel_event=None):
+    """
+    Computes the full resolution intersection from a mask on the grid returned by downsample_grid(). Blocks that are
+    completely inside or outside of the coarse mask keep their coarse value, only the voxels of the boundary blocks
+    are sampled from the volumes.
+    :param coarse_mask: The PackedMask on the coarse grid
+    :param factor: The downsampling factor of the coarse grid
+    :param volumes: A list of (array, ijk_to_ras) tuples
+    :param grid_shape: The (k, j, i) shape of the full resolution grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the full resolution grid
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param progress_callback: Optional function called with (finished coarse slices, all coarse slices to refine)
+    :param cancel_event: Optional threading.Event - when it is set the computation stops with a CancelledError
+    return: The intersection mask on the full resolution grid as a PackedMask
+    """
+    coarse = coarse_mask.to_array()
+    boundary = boundary_blocks(coarse)
+
+    mask = PackedMask.full(grid_shape)
+
+    # coarse slices without set or boundary voxels stay empty
+    coarse_slices = np.flatnonzero(coarse.any(axis=(1, 2)) | boundary.any(axis=(1, 2)))
+
+    for n, ck in enumerate(coarse_slices):
+        if cancel_event is not None and cancel_event.is_set():
+            raise CancelledError("The intersection computation was cancelled.")
+
+        slices = range(ck * factor, min((ck + 1) * factor, grid_shape[0]))
+
+        slab = coarse[ck].repeat(factor, axis=0).repeat(factor, axis=1)[:grid_shape[1], :grid_shape[2]]
+        slab = np.repeat(slab[np.newaxis], len(slices), axis=0)
+
+        blocks = boundary[ck].repeat(factor, axis=0).repeat(factor, axis=1)[:grid_shape[1], :grid_shape[2]]
+        j, i = np.nonzero(blocks)
+
+        if len(j) > 0:
+            k = np.repeat(np.arange(slices.start, slices.stop), len(j))
+            grid_ijk = np.stack([np.tile(i, len(slices)), np.tile(j, len(slices)), k])
+
+            values = np.ones(grid_ijk.shape[1], dtype=bool)
+            for array, array_ijk_to_ras in volumes:
+                sampled, inside = sample_nearest_points(array, array_ijk_to_ras, grid_ijk, grid_ijk_to_ras)
+                values &= inside & threshold_mask(sampled, threshold_range)
+
+                if not values.any():
+                    break
+
+            slab[:, j, i] = values.reshape(len(slices), -1)
+
+        mask.pack(slices, slab)
+
+        if progress_callback is not None:
+            progress_callback(n + 1, len(coarse_slices))
+
+    return mask
+
+
+def oriented_box(shape, ijk_to_ras):
+    """
+    Returns the world-space oriented bounding box of a volume (the box spans the voxel edges, not the voxel centres)
+    :param shape: The (k, j, i) shape of the volume
+    :param ijk_to_ras: The IJK-to-RAS matrix of the volume
+    return: The centre (3,), the unit axes as rows (3, 3) and the half extents (3,) of the box
+    """
+    size_ijk = np.array([shape[2], shape[1], shape[0]], dtype=float)
+
+    centre = (ijk_to_ras @ np.append((size_ijk - 1) / 2, 1))[:3]
+
+    # the columns of the IJK-to-RAS matrix are the (scaled) directions of the i, j and k axes
+    spacing = np.linalg.norm(ijk_to_ras[:3, :3], axis=0)
+    axes = (ijk_to_ras[:3, :3] / spacing).T
+    half_extents = size_ijk * spacing / 2
+
+    return centre, axes, half_extents
+
+
+def oriented_boxes_overlap(box_a, box_b, tolerance=1e-6):
+    """
+    Separating axis test of two oriented bounding boxes
+    :param box_a: (centre, axes, half_extents) as returned by oriented_box()
+    :param box_b: (centre, axes, half_extents) as returned by oriented_box()
+    return: True if the boxes overlap
+    """
+    centre_a, axes_a, extents_a = box_a
+    centre_b, axes_b, extents_b = box_b
+
+    candidate_axes = list(axes_a) + list(axes_b)
+    for axis_a in axes_a:
+        for axis_b in axes_b:
+            cross = np.cross(axis_a, axis_b)
+            norm = np.linalg.norm(cross)
+            if norm > tolerance:  # parallel axes are already covered by the face normals
+                candidate_axes.append(cross / norm)
+
+    distance = centre_b - centre_a
+    for axis in candidate_axes:
+        radius_a = np.sum(extents_a * np.abs(axes_a @ axis))
+        radius_b = np.sum(extents_b * np.abs(axes_b @ axis))
+        if abs(distance @ axis) > radius_a + radius_b + tolerance:
+            return False
+
+    return True
+
+
+def crop_bounds(grid_shape, grid_ijk_to_ras, boxes, min_boxes=None):
+    """
+    Returns the index range of the grid voxels that lie inside of all (or at least min_boxes) of the given boxes. Each
+    box is bounded by its axis-aligned extent in the IJK space of the grid, and with min_boxes the range along each
+    axis is the one where at least min_boxes of these extents overlap, so the range is a conservative (slightly too
+    large) estimate of the real overlap.
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param boxes: A list of (shape, ijk_to_ras) tuples of the volumes that have to overlap
+    :param min_boxes: The number of boxes a voxel has to lie in (all of them if None)
+    return: The (k, j, i) slices of the range or None if it is empty
+    """
+    ras_to_grid = np.linalg.inv(grid_ijk_to_ras)
+
+    lower = np.zeros(3)
+    upper = np.array([grid_shape[2], grid_shape[1], grid_shape[0]], dtype=float) - 1
+
+    box_lowers = []
+    box_uppers = []
+    for shape, ijk_to_ras in boxes:
+        # the 8 voxel-edge corners of the box in the IJK space of the grid
+        edges = [(-0.5, size - 0.5) for size in (shape[2], shape[1], shape[0])]
+        corners = np.array([[i, j, k, 1] for i in edges[0] for j in edges[1] for k in edges[2]]).T
+        corners = (ras_to_grid @ ijk_to_ras @ corners)[:3]
+
+        box_lowers.append(np.ceil(corners.min(axis=1) - 1e-6))
+        box_uppers.append(np.floor(corners.max(axis=1) + 1e-6))
+
+    if boxes and (min_boxes is None or min_boxes >= len(boxes)):
+        lower = np.maximum(lower, np.max(box_lowers, axis=0))
+        upper = np.minimum(upper, np.min(box_uppers, axis=0))
+
+    elif boxes:
+        box_lowers, box_uppers = np.array(box_lowers), np.array(box_uppers)
+
+        for axis in range(3):
+            # the overlap of the extents starts at the lower end of one of them and stops at the upper end of one
+            def overlapping(x):
+                return np.count_nonzero((box_lowers[:, axis] <= x) & (x <= box_uppers[:, axis])) >= min_boxes
+
+            starts = [x for x in box_lowers[:, axis] if overlapping(x)]
+            stops = [x for x in box_uppers[:, axis] if overlapping(x)]
+            if not starts:
+                return None
+
+            lower[axis] = max(lower[axis], min(starts))
+            upper[axis] = min(upper[axis], max(stops))
+
+    if np.any(lower > upper):
+        return None
+
+    return tuple(slice(int(lower[axis]), int(upper[axis]) + 1) for axis in (2, 1, 0))
+
+
+def sub_grid(grid_ijk_to_ras, bounds):
+    """
+    Returns the IJK-to-RAS matrix of a part of a grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param bounds: The (k, j, i) slices of the part
+    """
+    offset = np.eye(4)
+    offset[:3, 3] = [bounds[2].start, bounds[1].start, bounds[0].start]
+
+    return grid_ijk_to_ras @ offset
+
+
+def crop_grid(grid_shape, grid_ijk_to_ras, boxes, min_boxes=None):
+    """
+    Crops a grid to the voxels that lie inside of all (or at least min_boxes) of the given boxes (see crop_bounds())
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param boxes: A list of (shape, ijk_to_ras) tuples of the volumes that have to overlap
+    :param min_boxes: The number of boxes a voxel has to lie in (all of them if None)
+    return: The (k, j, i) shape and the IJK-to-RAS matrix of the cropped grid or None if the crop is empty
+    """
+    bounds = crop_bounds(grid_shape, grid_ijk_to_ras, boxes, min_boxes)
+
+    if bounds is None:
+        return None
+
+    return tuple(s.stop - s.start for s in bounds), sub_grid(grid_ijk_to_ras, bounds)
+
+
+def crop_to_mask(mask, ijk_to_ras):
+    """
+    Crops a mask to the bounding box of its set voxels
+    :param mask: The PackedMask
+    :param ijk_to_ras: The IJK-to-RAS matrix of the mask
+    return: The cropped PackedMask and its IJK-to-RAS matrix or (None, None) if the mask is empty
+    """
+    bounds = mask.bounding_box()
+
+    if bounds is None:
+        return None, None
+
+    return mask.crop(bounds), sub_grid(ijk_to_ras, bounds)
+
+
+class CoverageAccumulator:
+    """
+    Keeps the thresholded FOV mask of every volume (bit-packed) on a common reference grid together with a per-voxel
+    count of the volumes that cover it. Adding or removing a volume only touches the voxels of that volume, and the intersection
+    (or any 'covered by at least k volumes' mask) is read directly from the counts.
+    Each mask is only stored for the part of the reference grid that lies inside of the bounding box of its volume.
+    """
+
+    def __init__(self, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255)):
+        """
+        :param grid_shape: The (k, j, i) shape of the reference grid
+        :param grid_ijk_to_ras: The IJK-to-RAS matrix of the reference grid
+        :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+        """
+        self.grid_shape = tuple(grid_shape)
+        self.grid_ijk_to_ras = grid_ijk_to_ras
+        self.threshold_range = tuple(threshold_range)
+
+        self.counts = np.zeros(self.grid_shape, dtype=np.uint8)
+
+        # key -> (version, bounds, mask)
+        self._masks = {}
+
+    def __contains__(self, key):
+        return key in self._masks
+
+    def __len__(self):
+        return len(self._masks)
+
+    def keys(self):
+        return list(self._masks.keys())
+
+    def version(self, key):
+        """
+        Returns the version that was passed to add() for the given key
+        """
+        return self._masks[key][0]
+
+    def add(self, key, array, ijk_to_ras, version=None, cancel_event=None):
+        """
+        Thresholds a volume on the reference grid and adds it to the counts (a volume with the same key is replaced)
+        :param key: Any hashable identifying the volume (e.g. the node ID)
+        :param array: The (k, j, i) array of the volume
+        :param ijk_to_ras: The IJK-to-RAS matrix of the volume
+        :param version: Optional token stored with the mask (e.g. a modification time) to detect stale masks
+        :param cancel_event: Optional threading.Event that cancels the computation
+        """
+        bounds = self.volume_bounds(array.shape, ijk_to_ras)
+
+        mask = None
+        if bounds is not None:
+            shape = tuple(s.stop - s.start for s in bounds)
+            mask = intersection_mask([(array, ijk_to_ras)], shape, sub_grid(self.grid_ijk_to_ras, bounds),
+                                     self.threshold_range, cancel_event=cancel_event)
+
+        self.add_mask(key, bounds, mask, version=version)
+
+    def volume_bounds(self, shape, ijk_to_ras):
+        """
+        Returns the (k, j, i) slices of the part of the reference grid inside of the bounding box of a volume (or None)
+        """
+        return crop_bounds(self.grid_shape, self.grid_ijk_to_ras, [(shape, ijk_to_ras)])
+
+    def add_mask(self, key, bounds, mask, version=None):
+        """
+        Adds a mask that was already thresholded on the part of the reference grid returned by volume_bounds() (e.g.
+        in a worker process)
+        :param key: Any hashable identifying the volume (e.g. the node ID)
+        :param bounds: The slices returned by volume_bounds()
+        :param mask: The PackedMask on the sub-grid of the bounds (None if the bounds are None)
+        :param version: Optional token stored with the mask
+        """
+        if key in self._masks:
+            self.remove(key)
+
+        if len(self._masks) == np.iinfo(self.counts.dtype).max:
+            raise ValueError("Too many volumes for the coverage counts.")
+
+        if bounds is not None:
+            self._update_counts(bounds, mask, 1)
+
+        self._masks[key] = (version, bounds, mask)
+
+    def remove(self, key):
+        """
+        Removes a volume from the counts
+        :param key: The key that was used in add()
+        """
+        _, bounds, mask = self._masks.pop(key)
+
+        if bounds is not None:
+            self._update_counts(bounds, mask, -1)
+
+    def _update_counts(self, bounds, mask, sign):
+        # unpack one slice at a time
+        counts = self.counts[bounds]
+        for k in range(mask.shape[0]):
+            if sign > 0:
+                counts[k] += mask[k]
+            else:
+                counts[k] -= mask[k]
+
+    def at_least(self, k):
+        """
+        Returns the PackedMask of the voxels that are covered by at least k of the volumes
+        """
+        mask = PackedMask.full(self.grid_shape)
+
+        for start in range(0, self.grid_shape[0], 16):
+            slices = range(start, min(start + 16, self.grid_shape[0]))
+            mask.pack(slices, self.counts[slices.start:slices.stop] >= k)
+
+        return mask
+
+    def intersection(self):
+        """
+        Returns the PackedMask of the voxels that are covered by all volumes
+        """
+        if len(self._masks) == 0:
+            return PackedMask.full(self.grid_shape)
+
+        return self.at_least(len(self._masks))
@@ -0,0 +1,313 @@
+import contextlib
+import re
+
+import numpy as np
+import vtk
+import slicer
+
+import MRUSLandmarkingLib.utils_landmark_review
+
+# first token of a landmark label, e.g. "F3" of "F3 us2"
+LABEL_PATTERN = re.compile(r"\s*([^\d\s]*)(\d*)")
+
+
+def parse_label(label):
+    """
+    Parses a landmark label like "F3 us2"
+    :param label: The control point label
+    return: (prefix, landmark number, volume tag) - e.g. ("F", 3, "us2"); the number is -1 and the tag None if the
+            label does not contain them
+    """
+    tokens = label.split(' ')
+    match = LABEL_PATTERN.match(tokens[0])
+
+    prefix = match.group(1)
+    number = int(match.group(2)) if match.group(2) else -1
+    tag = tokens[1].lower() if len(tokens) > 1 and tokens[1] else None
+
+    return prefix, number, tag
+
+
+def tag_sort_key(tag):
+    """
+    Orders volume tags as pre-op, us1, us2, ..., intra-op (other tags come last, alphabetically)
+    """
+    if tag is None:
+        return 4, 0, ""
+    if "pre-op" in tag:
+        return 0, 0, tag
+
+    us_match = re.fullmatch(r"us(\d+)", tag)
+    if us_match:
+        return 1, int(us_match.group(1)), tag
+    if "intra-op" in tag:
+        return 2, 0, tag
+
+    return 3, 0, tag
+
+
+class LandmarkIndex:
+    """
+    Column-wise copy of the control points of a landmark list: IDs, labels, parsed label parts (prefix, landmark number,
+    volume tag), positions, descriptions and review records (status, comment, reviewer, timestamp). Each label is parsed
+    once; the index is updated point by point from the PointAdded/Modified/RemovedEvents of the list, so the landmark
+    utilities do not have to read all control points through the MRML getters on every call.
+
+    Review records are stored as node attributes and mirrored to the descriptions (see utils_landmark_review) and must be
+    changed through set_review. Descriptions in the "Status; comment" format without a record are migrated when the
+    index is created.
+    """
+
+    def __init__(self, markups_node):
+        self.markups_node = markups_node
+
+        self.ids = []
+        self.labels = []
+        self.prefixes = []
+        self.numbers = []
+        self.tags = []
+        self.descriptions = []
+        self.statuses = []
+        self.comments = []
+        self.reviewers = []
+        self.timestamps = []
+        self._positions = []
+
+        self._arrays = None  # cached numpy arrays of the columns
+        self._unchanged_batches = 0  # > 0 while batches are sent that do not change the indexed properties
+
+        MRUSLandmarkingLib.utils_landmark_review.migrate_descriptions(markups_node)
+
+        self._observations = [
+            markups_node.AddObserver(slicer.vtkMRMLMarkupsNode.PointAddedEvent, self._on_point_added),
+            markups_node.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self._on_point_modified),
+            markups_node.AddObserver(slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self._on_point_removed)]
+
+        self.rebuild()
+
+    def cleanup(self):
+        for tag in self._observations:
+            self.markups_node.RemoveObserver(tag)
+        self._observations = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _columns(self):
+        return (self.ids, self.labels, self.prefixes, self.numbers, self.tags, self.descriptions, self.statuses,
+                self.comments, self.reviewers, self.timestamps, self._positions)
+
+    def _read_point(self, idx):
+        control_point_id = self.markups_node.GetNthControlPointID(idx)
+        label = self.markups_node.GetNthControlPointLabel(idx)
+        prefix, number, tag = parse_label(label)
+        description = self.markups_node.GetNthControlPointDescription(idx)
+
+        review = MRUSLandmarkingLib.utils_landmark_review.read_review(self.markups_node, control_point_id)
+        if review == MRUSLandmarkingLib.utils_landmark_review.EMPTY_REVIEW:  # e.g. added from a markups file
+            review = MRUSLandmarkingLib.utils_landmark_review.review_from_description(description) or review
+
+        return (control_point_id, label, prefix, number, tag, description, *review,
+                tuple(self.markups_node.GetNthControlPointPosition(idx)))
+
+    def rebuild(self):
+        """
+        Reads all control points of the list again
+        """
+        rows = [self._read_point(idx) for idx in range(self.markups_node.GetNumberOfControlPoints())]
+        columns = self._columns()
+
+        for column, values in zip(columns, list(zip(*rows)) or [()] * len(columns)):
+            column[:] = values
+
+        self._arrays = None
+
+    def refresh(self):
+        """
+        Updates the control points whose label, description or position changed (used for batched modifications, whose
+        PointModifiedEvent does not say which control points changed)
+        """
+        node = self.markups_node
+        if node.GetNumberOfControlPoints() != len(self):
+            self.rebuild()
+            return
+
+        positions = slicer.util.arrayFromMarkupsControlPoints(node) if len(self) else np.zeros((0, 3))
+        moved = np.any(np.asarray(positions).reshape(-1, 3) != self.positions, axis=1)
+
+        changed = [idx for idx in range(len(self))
+                   if moved[idx] or node.GetNthControlPointLabel(idx) != self.labels[idx]
+                   or node.GetNthControlPointDescription(idx) != self.descriptions[idx]]
+
+        for idx in changed:
+            for column, value in zip(self._columns(), self._read_point(idx)):
+                column[idx] = value
+
+        if changed:
+            self._arrays = None
+
+    @contextlib.contextmanager
+    def unchanged(self):
+        """
+        Marks modifications of the list that only change properties the index does not hold (e.g. the visibility), so
+        their batched PointModifiedEvent does not make the index compare all control points
+        """
+        self._unchanged_batches += 1
+        try:
+            yield
+        finally:
+            self._unchanged_batches -= 1
+
+    @staticmethod
+    def _is_valid_index(idx, length):
+        return idx is not None and 0 <= idx < length
+
+    @vtk.calldata_type(vtk.VTK_INT)
+    def _on_point_added(self, caller, event, idx):
+        if not self._is_valid_index(idx, len(self) + 1) or caller.GetNumberOfControlPoints() != len(self) + 1:
+            self.rebuild()
+            return
+
+        for column, value in zip(self._columns(), self._read_point(idx)):
+            column.insert(idx, value)
+
+        self._arrays = None
+
+    @vtk.calldata_type(vtk.VTK_INT)
+    def _on_point_modified(self, caller, event, idx):
+        if idx is None:  # sent by EndModify after a batch of modifications
+            if not self._unchanged_batches:
+                self.refresh()
+            return
+
+        if not self._is_valid_index(idx, len(self)) or caller.GetNumberOfControlPoints() != len(self):
+            self.rebuild()
+            return
+
+        for column, value in zip(self._columns(), self._read_point(idx)):
+            column[idx] = value
+
+        self._arrays = None
+
+    @vtk.calldata_type(vtk.VTK_INT)
+    def _on_point_removed(self, caller, event, idx):
+        if not self._is_valid_index(idx, len(self)) or caller.GetNumberOfControlPoints() != len(self) - 1:
+            self.rebuild()
+            return
+
+        # the review record of the removed control point is not needed anymore
+        MRUSLandmarkingLib.utils_landmark_review.remove_review(caller, self.ids[idx])
+
+        for column in self._columns():
+            del column[idx]
+
+        self._arrays = None
+
+    def get_review(self, idx):
+        """
+        return: The ReviewRecord of a control point
+        """
+        return MRUSLandmarkingLib.utils_landmark_review.ReviewRecord(self.statuses[idx], self.comments[idx],
+                                                                     self.reviewers[idx], self.timestamps[idx])
+
+    def set_review(self, idx, status=None, comment=None):
+        """
+        Changes the review status and/or comment of a control point (the current user and time are recorded)
+        :param idx: The index of the control point
+        :param status: The new status (one of REVIEW_STATUSES) or None to keep it
+        :param comment: The new comment or None to keep it
+        """
+        review = MRUSLandmarkingLib.utils_landmark_review.create_review(self.get_review(idx), status, comment)
+        if not review.status and not review.comment:
+            review = MRUSLandmarkingLib.utils_landmark_review.EMPTY_REVIEW
+
+        MRUSLandmarkingLib.utils_landmark_review.write_review(self.markups_node, self.ids[idx], review)
+
+        self.statuses[idx], self.comments[idx], self.reviewers[idx], self.timestamps[idx] = review
+        self._arrays = None
+
+        # the description keeps status and comment when the list is exported (updates the description column)
+        self.markups_node.SetNthControlPointDescription(
+            idx, MRUSLandmarkingLib.utils_landmark_review.format_description(review))
+
+    def get_status_counts(self):
+        """
+        return: A dict with the number of control points per review status
+        """
+        counts = np.bincount(self.get_arrays()["status_codes"],
+                             minlength=len(MRUSLandmarkingLib.utils_landmark_review.REVIEW_STATUSES))
+
+        return dict(zip(MRUSLandmarkingLib.utils_landmark_review.REVIEW_STATUSES, counts.tolist()))
+
+    def get_arrays(self):
+        """
+        return: A dict of numpy arrays of the columns ("ids", "labels", "prefixes", "numbers", "tags", "descriptions",
+                "statuses", "status_codes", "comments", "reviewers", "timestamps" and the (n, 3) "positions")
+        """
+        if self._arrays is None:
+            self._arrays = {"ids": np.array(self.ids, dtype=object),
+                            "labels": np.array(self.labels, dtype=object),
+                            "prefixes": np.array(self.prefixes, dtype=object),
+                            "numbers": np.array(self.numbers, dtype=np.int64),
+                            "tags": np.array(self.tags, dtype=object),
+                            "descriptions": np.array(self.descriptions, dtype=object),
+                            "statuses": np.array(self.statuses, dtype=object),
+                            "status_codes": np.array(
+                                [MRUSLandmarkingLib.utils_landmark_review.REVIEW_STATUSES.index(status)
+                                 for status in self.statuses], dtype=np.int64),
+                            "comments": np.array(self.comments, dtype=object),
+                            "reviewers": np.array(self.reviewers, dtype=object),
+                            "timestamps": np.array(self.timestamps, dtype=np.float64),
+                            "positions": np.array(self._positions, dtype=np.float64).reshape(-1, 3)}
+
+        return self._arrays
+
+    @property
+    def positions(self):
+        return self.get_arrays()["positions"]
+
+    def get_position(self, idx):
+        return np.array(self._positions[idx])
+
+
+class LandmarkIndexRegistry:
+    """
+    Creates the LandmarkIndex of a landmark list on first use and keeps it until the list is removed from the scene
+    """
+
+    def __init__(self):
+        self._indices = {}
+
+        self._observations = [
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self._on_node_removed),
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.clear)]
+
+    def cleanup(self):
+        for tag in self._observations:
+            slicer.mrmlScene.RemoveObserver(tag)
+        self._observations = []
+
+        self.clear()
+
+    def clear(self, *args):
+        for index in self._indices.values():
+            index.cleanup()
+
+        self._indices = {}
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def _on_node_removed(self, caller, event, node):
+        if node is not None and node.GetID() in self._indices:
+            self._indices.pop(node.GetID()).cleanup()
+
+    def get(self, markups_node):
+        """
+        return: The LandmarkIndex of a landmark list
+        """
+        index = self._indices.get(markups_node.GetID())
+
+        if index is None or index.markups_node is not markups_node:
+            index = LandmarkIndex(markups_node)
+            self._indices[markups_node.GetID()] = index
+
+        return index
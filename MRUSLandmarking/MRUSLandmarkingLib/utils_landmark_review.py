@@ -0,0 +1,152 @@
+import collections
+import getpass
+import json
+import logging
+import time
+
+# the review statuses of a landmark, their index is the status code ("" means not checked)
+REVIEW_STATUSES = ("", "Accepted", "Modify", "Rejected")
+
+# the review record of a control point is stored as JSON in the node attribute <prefix><control point ID>; status and
+# comment are also written to the control point description ("Status; comment"), so they are kept when the list is
+# saved or exported on its own (markups JSON/FCSV files do not contain node attributes)
+REVIEW_ATTRIBUTE_PREFIX = "MRUSLandmarking.Review."
+
+ReviewRecord = collections.namedtuple("ReviewRecord", ["status", "comment", "reviewer", "timestamp"])
+
+EMPTY_REVIEW = ReviewRecord("", "", "", 0.0)
+
+
+def get_status_code(status):
+    """
+    return: The code (index into REVIEW_STATUSES) of a review status
+    """
+    if status not in REVIEW_STATUSES:
+        raise ValueError(f"Unknown landmark status '{status}' - choose one of {', '.join(REVIEW_STATUSES[1:])}.")
+
+    return REVIEW_STATUSES.index(status)
+
+
+def get_reviewer():
+    """
+    return: The name of the current user (empty if it cannot be determined)
+    """
+    try:
+        return getpass.getuser()
+    except Exception:
+        return ""
+
+
+def read_review(markups_node, control_point_id):
+    """
+    Reads the review record of a control point
+    :param markups_node: The landmark list
+    :param control_point_id: The ID of the control point
+    return: The ReviewRecord (EMPTY_REVIEW if the control point was not reviewed)
+    """
+    value = markups_node.GetAttribute(REVIEW_ATTRIBUTE_PREFIX + control_point_id)
+    if not value:
+        return EMPTY_REVIEW
+
+    try:
+        data = json.loads(value)
+        record = ReviewRecord(str(data.get("status", "")), str(data.get("comment", "")),
+                              str(data.get("reviewer", "")), float(data.get("timestamp", 0.0)))
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.warning(f"Invalid review record of control point {control_point_id}: {e}")
+        return EMPTY_REVIEW
+
+    return record if record.status in REVIEW_STATUSES else record._replace(status="")
+
+
+def write_review(markups_node, control_point_id, record):
+    """
+    Stores the review record of a control point (a record without status and comment is removed)
+    """
+    name = REVIEW_ATTRIBUTE_PREFIX + control_point_id
+
+    if not record.status and not record.comment:
+        if markups_node.GetAttribute(name) is not None:
+            markups_node.RemoveAttribute(name)
+        return
+
+    get_status_code(record.status)
+
+    markups_node.SetAttribute(name, json.dumps(record._asdict()))
+
+
+def remove_review(markups_node, control_point_id):
+    write_review(markups_node, control_point_id, EMPTY_REVIEW)
+
+
+def parse_description(description):
+    """
+    Parses a description in the "Status; comment" format (the comment may contain ';')
+    return: (status, comment) or None if the description is empty or does not start with a status
+    """
+    status, _, comment = description.partition(';')
+    status = status.strip()
+
+    if not description.strip() or status not in REVIEW_STATUSES:
+        return None
+
+    return status, comment.strip()
+
+
+def format_description(record):
+    """
+    return: The "Status; comment" description of a review record
+    """
+    if record.comment:
+        return f"{record.status}; {record.comment}"
+
+    return record.status
+
+
+def review_from_description(description):
+    """
+    return: The ReviewRecord stored in a "Status; comment" description (without reviewer and time) or None
+    """
+    parsed = parse_description(description)
+
+    return ReviewRecord(*parsed, "", 0.0) if parsed is not None else None
+
+
+def migrate_descriptions(markups_node):
+    """
+    Creates review records for the control points of a landmark list whose descriptions are in the "Status; comment"
+    format and that do not have a record yet (e.g. lists of older versions or lists loaded from markups files). The
+    descriptions are kept, other descriptions are not touched.
+    return: The number of migrated control points
+    """
+    migrated = 0
+
+    wasModified = markups_node.StartModify()
+
+    for idx in range(markups_node.GetNumberOfControlPoints()):
+        record = review_from_description(markups_node.GetNthControlPointDescription(idx))
+        control_point_id = markups_node.GetNthControlPointID(idx)
+
+        if record is None or read_review(markups_node, control_point_id) != EMPTY_REVIEW:
+            continue
+
+        write_review(markups_node, control_point_id, record)
+
+        migrated += 1
+
+    markups_node.EndModify(wasModified)
+
+    if migrated:
+        logging.info(f"Migrated the descriptions of {migrated} control points of {markups_node.GetName()} to review "
+                     f"records.")
+
+    return migrated
+
+
+def create_review(old_record, status=None, comment=None):
+    """
+    return: A copy of a review record with a new status and/or comment, reviewed by the current user now
+    """
+    return ReviewRecord(old_record.status if status is None else status,
+                        old_record.comment if comment is None else comment,
+                        get_reviewer(), time.time())
@@ -1,7 +1,167 @@
+import re
+import time
+
+import numpy as np
+import vtk
 import slicer
+import MRUSLandmarkingLib.utils_landmark_index
+import MRUSLandmarkingLib.utils_landmark_review
 import MRUSLandmarkingLib.utils_views
 
 
+def volume_matches_tag(volume_name, tag):
+    """
+    Checks if a volume belongs to a volume tag of a landmark label ('us1' does not match 'us10'; 'pre-op' and 'intra-op'
+    match volumes that contain 'pre'/'intra' and 'op')
+    """
+    volume_name = volume_name.lower()
+
+    if "pre" in volume_name and "op" in volume_name and "pre-op" in tag:
+        volume_name = "pre-op"
+    elif "intra" in volume_name and "op" in volume_name and "intra-op" in tag:
+        volume_name = "intra-op"
+
+    return re.search(re.escape(tag) + r"(?!\d)", volume_name) is not None
+
+
+class LandmarkVolumeMap:
+    """
+    Maps the volume tags of landmark labels (parsed once by the LandmarkIndex of the list) to the chosen volumes, so
+    jumping to a landmark can display its volume directly. The map is reset when the chosen volumes or their names
+    change; changed labels are picked up through the index.
+    """
+
+    def __init__(self):
+        self._volumes = None  # the chosen (volume ID, volume name) tuples the map was built for
+        self._volume_ids_by_tag = {}
+
+    def cleanup(self):
+        self._volumes = None
+        self._volume_ids_by_tag = {}
+
+    def get_volume_id(self, landmark_index, control_point_idx, volume_ids):
+        """
+        Returns the volume of a control point
+        :param landmark_index: The LandmarkIndex of the landmark list
+        :param control_point_idx: The index of the control point
+        :param volume_ids: The chosen volume IDs (the first matching volume is used)
+        return: The volume ID or None if no chosen volume matches the label of the control point
+        """
+        volumes = tuple((volume.GetID(), volume.GetName())
+                        for volume in (slicer.mrmlScene.GetNodeByID(volume_id) for volume_id in volume_ids) if volume)
+
+        if volumes != self._volumes:
+            self._volumes = volumes
+            self._volume_ids_by_tag = {}
+
+        tag = landmark_index.tags[control_point_idx]
+        if tag is None:
+            return None
+
+        if tag not in self._volume_ids_by_tag:
+            self._volume_ids_by_tag[tag] = next((volume_id for volume_id, volume_name in self._volumes
+                                                 if volume_matches_tag(volume_name, tag)), None)
+
+        return self._volume_ids_by_tag[tag]
+
+
+class ControlPointVisibility:
+    """
+    Keeps track of which control points of a landmark list are visible, so that showing other control points only
+    changes the visibility of the points that differ - in one StartModify/EndModify batch. The visible points are read
+    from the list once and then kept up to date from its point events.
+    """
+
+    def __init__(self):
+        self._markups_node = None
+        self._observations = []
+        self._visible = None  # indices of the visible control points (None: not read yet)
+        self._applying = False  # True while our own batch is sent (its events are already accounted for)
+
+    def cleanup(self):
+        for tag in self._observations:
+            self._markups_node.RemoveObserver(tag)
+        self._observations = []
+
+        self._markups_node = None
+        self._visible = None
+
+    def _reset(self, *args):
+        self._visible = None
+
+    def _observe(self, markups_node):
+        self.cleanup()
+
+        self._markups_node = markups_node
+        self._observations = [
+            markups_node.AddObserver(slicer.vtkMRMLMarkupsNode.PointAddedEvent, self._reset),
+            markups_node.AddObserver(slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self._reset),
+            markups_node.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self._on_point_modified)]
+
+    @vtk.calldata_type(vtk.VTK_INT)
+    def _on_point_modified(self, caller, event, control_point_idx):
+        if self._visible is None or self._applying:
+            return
+
+        if control_point_idx is None or not 0 <= control_point_idx < caller.GetNumberOfControlPoints():
+            self._reset()
+        elif caller.GetNthControlPointVisibility(control_point_idx):
+            self._visible.add(control_point_idx)
+        else:
+            self._visible.discard(control_point_idx)
+
+    def _get_visible(self, markups_node):
+        if markups_node is not self._markups_node:
+            self._observe(markups_node)
+
+        if self._visible is None:
+            self._visible = {idx for idx in range(markups_node.GetNumberOfControlPoints())
+                             if markups_node.GetNthControlPointVisibility(idx)}
+
+        return self._visible
+
+    def _apply(self, markups_node, show, hide):
+        if not show and not hide:
+            return
+
+        wasModified = markups_node.StartModify()
+
+        for idx in show:
+            markups_node.SetNthControlPointVisibility(idx, True)
+        for idx in hide:
+            markups_node.SetNthControlPointVisibility(idx, False)
+
+        self._visible |= show
+        self._visible -= hide
+
+        # EndModify sends the batched PointModifiedEvent without a control point index
+        self._applying = True
+        try:
+            markups_node.EndModify(wasModified)
+        finally:
+            self._applying = False
+
+    def show_only(self, markups_node, control_point_indices):
+        """
+        Makes the given control points visible and all others invisible
+        """
+        visible = self._get_visible(markups_node)
+        target = set(control_point_indices)
+
+        self._apply(markups_node, target - visible, visible - target)
+
+    def set_all(self, markups_node, visibility):
+        """
+        Makes all control points visible or invisible
+        """
+        visible = self._get_visible(markups_node)
+
+        if visibility:
+            self._apply(markups_node, set(range(markups_node.GetNumberOfControlPoints())) - visible, set())
+        else:
+            self._apply(markups_node, set(), set(visible))
+
+
 def turn_off_placement_mode():
     interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
     interactionNode.SwitchToViewTransformMode()
@@ -9,19 +169,23 @@ def turn_off_placement_mode():
 
 
 def print_landmark_inspection_results(widget):
-    check_if_landmark_list_is_selected(widget)
+    landmark_index = get_landmark_index(widget)
 
-    for i in range(widget.current_landmarks_list.GetNumberOfControlPoints()):
+    for idx, label in enumerate(landmark_index.labels):
+        review = landmark_index.get_review(idx)
 
-        status = widget.current_landmarks_list.GetNthControlPointDescription(i)
+        status = "; ".join(part for part in (review.status, review.comment) if part)
 
         if status == '':
             status = "Not checked"
 
-        if status[0] == ';':
-            status = status[2:]
+        if review.reviewer:
+            status += f" ({review.reviewer}, {time.strftime('%Y-%m-%d %H:%M', time.localtime(review.timestamp))})"
+
+        print(f"{label.ljust(12)}: {status}")
 
-        print(f"{widget.current_landmarks_list.GetNthControlPointLabel(i).ljust(12)}: {status}")
+    counts = landmark_index.get_status_counts()
+    print(", ".join(f"{status or 'Not checked'}: {count}" for status, count in counts.items()))
 
     turn_off_placement_mode()
 
@@ -33,154 +197,97 @@ def check_if_landmark_list_is_selected(widget):
         raise ValueError("Please select a landmark list.")
 
 
-def sort_landmarks(widget):
+def get_landmark_index(widget):
+    """
+    return: The LandmarkIndex of the current landmark list
+    """
     check_if_landmark_list_is_selected(widget)
 
-    # create a list to sort
-    sort_list = []
-
-    for i in range(widget.current_landmarks_list.GetNumberOfControlPoints()):
-        sort_list.append([widget.current_landmarks_list.GetNthControlPointLabel(i),
-                          widget.current_landmarks_list.GetNthControlPointID(i), -1])
+    return widget.landmark_indices.get(widget.current_landmarks_list)
 
-    sort_list = sorted(sort_list, key=lambda x: x[0][0].split(' ')[0][1:])
 
-    # create sublists for each landmark
-    sublists = {}
-    for packet in sort_list:
-        prefix = packet[0].split(' ')[0]
-        if prefix in sublists:
-            sublists[prefix].append(packet)
-        else:
-            sublists[prefix] = [packet]
-
-    sublists = list(sublists.items())
+def get_landmark_sort_order(landmark_index):
+    """
+    Returns the order of the landmarks sorted by label prefix and landmark number, and within each landmark by volume
+    (pre-op, us1, us2, ..., intra-op). Labels without a landmark number come last, ties keep their original order.
+    :param landmark_index: The LandmarkIndex of the landmark list
+    return: A numpy array with the control point indices in sorted order
+    """
+    tag_keys = [MRUSLandmarkingLib.utils_landmark_index.tag_sort_key(tag) for tag in landmark_index.tags]
 
-    # move intra to the last position of each sublist and sort each sublist
-    for i in range(len(sublists)):
-        sub = sublists[i][1]
-        new_list = sorted(sub, key=lambda x: x[0].split(' ')[1])
+    order = sorted(range(len(landmark_index)),
+                   key=lambda i: (landmark_index.numbers[i] < 0, landmark_index.prefixes[i], landmark_index.numbers[i],
+                                  tag_keys[i]))
 
-        if "intra" in new_list[0][0].lower():
-            temp = new_list.pop(0)
-            new_list.append(temp)
+    return np.asarray(order, dtype=np.int64)
 
-        sublists[i] = (sublists[i][0], new_list)
 
-    # create final sorted list
-    final_list = []
-    for _, packet in sublists:
-        for sub in packet:
-            final_list.append(sub)
+def sort_landmarks(widget):
+    """
+    Creates a sorted copy ("<name>_sorted") of the current landmark list (with the review records), built in one batch
+    from the landmark index
+    return: The sorted markups node
+    """
+    landmark_index = get_landmark_index(widget)
+    order = get_landmark_sort_order(landmark_index)
 
-    # create new markups list
     sorted_markups = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode",
                                                         widget.current_landmarks_list.GetName() + "_sorted")
 
-    for idx, landmark in enumerate(final_list):
-        index = widget.current_landmarks_list.GetNthControlPointIndexByID(landmark[1])
+    wasModified = sorted_markups.StartModify()
 
-        sorted_markups.AddControlPoint(widget.current_landmarks_list.GetNthControlPointPosition(index),
-                                       widget.current_landmarks_list.GetNthControlPointLabel(index))
+    slicer.util.updateMarkupsControlPointsFromArray(sorted_markups, landmark_index.positions[order])
 
-        sorted_markups.SetNthControlPointDescription(idx,
-                                                     widget.current_landmarks_list.GetNthControlPointDescription(index))
+    for new_idx, idx in enumerate(order):
+        sorted_markups.SetNthControlPointLabel(new_idx, landmark_index.labels[idx])
+        sorted_markups.SetNthControlPointDescription(new_idx, landmark_index.descriptions[idx])
+        MRUSLandmarkingLib.utils_landmark_review.write_review(sorted_markups,
+                                                              sorted_markups.GetNthControlPointID(new_idx),
+                                                              landmark_index.get_review(idx))
 
+    sorted_markups.EndModify(wasModified)
 
-def remove_landmark_comment(widget):
-    check_if_landmark_list_is_selected(widget)
+    return sorted_markups
 
-    # get old description
-    description = widget.current_landmarks_list.GetNthControlPointDescription(widget.current_control_point_idx)
-    description = description.split(";")
 
-    if description[0] != '':
-        new_description = description[0]
-    else:
-        new_description = ''
+def remove_landmark_comment(widget):
+    landmark_index = get_landmark_index(widget)
 
-    widget.current_landmarks_list.SetNthControlPointDescription(widget.current_control_point_idx, new_description)
+    landmark_index.set_review(widget.current_control_point_idx, comment="")
 
 
 def set_landmark_comment(widget, new_comment):
-    check_if_landmark_list_is_selected(widget)
-
-    # get old description
-    description = widget.current_landmarks_list.GetNthControlPointDescription(widget.current_control_point_idx)
-    description = description.split(";")
-
-    if description == ['']:  # meaning there was no description
-        new_description = "; " + new_comment
-    elif description[0] != '':
-        new_description = description[0] + "; " + new_comment
-    else:
-        new_description = "; " + new_comment
+    landmark_index = get_landmark_index(widget)
 
-    widget.current_landmarks_list.SetNthControlPointDescription(widget.current_control_point_idx, new_description)
+    landmark_index.set_review(widget.current_control_point_idx, comment=new_comment)
 
 
 def set_landmark_status(widget, new_status):
-    check_if_landmark_list_is_selected(widget)
-
-    # get old description
-    description = widget.current_landmarks_list.GetNthControlPointDescription(widget.current_control_point_idx)
-    description = description.split(";")
-
-    # get old comment
-    if len(description) == 2:
-        old_comment = description[1]  # it's the second part of the description
-        new_description = new_status + ";" + old_comment
-
-    else:  # if len is 1 this means that there is only a status
-        new_description = new_status
+    landmark_index = get_landmark_index(widget)
 
-    widget.current_landmarks_list.SetNthControlPointDescription(widget.current_control_point_idx, new_description)
+    landmark_index.set_review(widget.current_control_point_idx, status=new_status)
 
 
 def divide_landmarks_by_volume(widget):
-    check_if_landmark_list_is_selected(widget)
-
-    fiducial_node = widget.current_landmarks_list
-
-    num_control_points = fiducial_node.GetNumberOfControlPoints()
-
-    preop = []
-    us1 = []
-    us2 = []
-    us3 = []
-    intraop = []
-
-    for i in range(num_control_points):
-        label = fiducial_node.GetNthControlPointLabel(i)
-        vector = fiducial_node.GetNthControlPointPosition(i)
-
-        if "pre-op" in label.lower():
-            preop.append([vector, label])
-        elif "us1" in label.lower():
-            us1.append([vector, label])
-        elif "us2" in label.lower():
-            us2.append([vector, label])
-        elif "us3" in label.lower():
-            us3.append([vector, label])
-        elif "intra-op" in label.lower():
-            intraop.append([vector, label])
-
-    preop.sort(key=lambda y: y[1])
-    us1.sort(key=lambda y: y[1])
-    us2.sort(key=lambda y: y[1])
-    us3.sort(key=lambda y: y[1])
-    intraop.sort(key=lambda y: y[1])
+    """
+    Groups the landmarks by the volume tag of their labels
+    return: A list with one list of [position, label] pairs per volume tag - ordered pre-op, us1, us2, ..., intra-op and
+            sorted by landmark number within each group
+    """
+    landmark_index = get_landmark_index(widget)
 
-    all_nodes = [preop, us1, us2, us3, intraop]
+    groups = {}
+    for idx, tag in enumerate(landmark_index.tags):
+        if tag is not None:
+            groups.setdefault(tag, []).append(idx)
 
-    max_len = max([len(i) for i in all_nodes])
+    all_nodes = []
+    for tag in sorted(groups, key=MRUSLandmarkingLib.utils_landmark_index.tag_sort_key):
+        indices = sorted(groups[tag], key=lambda i: (landmark_index.numbers[i], landmark_index.labels[i]))
+        all_nodes.append([[landmark_index.get_position(i), landmark_index.labels[i]] for i in indices])
 
-    assert len(preop) == max_len or len(preop) == 0, "All volumes must have the same amount of landmarks (or none)"
-    assert len(us1) == max_len or len(us1) == 0, "All volumes must have the same amount of landmarks (or none)"
-    assert len(us2) == max_len or len(us2) == 0, "All volumes must have the same amount of landmarks (or none)"
-    assert len(us3) == max_len or len(us3) == 0, "All volumes must have the same amount of landmarks (or none)"
-    assert len(intraop) == max_len or len(
-        intraop) == 0, "All volumes must have the same amount of landmarks (or none)"
+    if len({len(group) for group in all_nodes}) > 1:
+        raise ValueError("All volumes must have the same amount of landmarks (or none)")
 
     return all_nodes
 
@@ -201,6 +308,18 @@ def activate_fiducial_placement():
         slicer.util.errorDisplay("Could not activate fiducial placement.\n" + str(e))
 
 
+def show_landmark_volume(widget, control_point_idx):
+    """
+    Shows the volume a control point was placed in as the background of the current views (with its predecessor in the
+    volume ring as the foreground)
+    """
+    volume_id = widget.landmark_volume_map.get_volume_id(get_landmark_index(widget), control_point_idx,
+                                                         widget.volumes_ids)
+
+    if volume_id is not None:
+        MRUSLandmarkingLib.utils_views.show_background_volume(widget, volume_id)
+
+
 def jump_to_next_landmark(widget, direction="forward"):
     """
     (This function is used as a shortcut)
@@ -209,9 +328,12 @@ def jump_to_next_landmark(widget, direction="forward"):
     """
     try:
 
-        if widget.nodes_circle is None:
+        if len(widget.volume_ring) == 0:
             raise Exception("Pick the corresponding volumes first (or re-pick any existing one)")
 
+        # a volume switch that is still shown from cached slices must not overwrite the volumes of the landmark
+        widget.slice_cache.apply_pending()
+
         # set new landmark comment (if it is not empty)
         # set landmark comments
         new_comment = widget.ui.markupsCommentText.toPlainText()
@@ -220,10 +342,10 @@ def jump_to_next_landmark(widget, direction="forward"):
         elif new_comment != "":
             set_landmark_comment(widget, new_comment=new_comment)
 
-        check_if_landmark_list_is_selected(widget)
+        landmark_index = get_landmark_index(widget)
 
         # get amount of control points
-        control_points_amount = widget.current_landmarks_list.GetNumberOfControlPoints()
+        control_points_amount = len(landmark_index)
 
         # if there are 0 control points
         if control_points_amount == 0:
@@ -250,65 +372,38 @@ def jump_to_next_landmark(widget, direction="forward"):
             return
 
         # update label
-        widget.ui.landmarkNameLabel.setText(
-            widget.current_landmarks_list.GetNthControlPointLabel(widget.current_control_point_idx))
-        current_description = widget.current_landmarks_list.GetNthControlPointDescription(
-            widget.current_control_point_idx)
-        current_description = current_description.split(';')[0]
+        widget.ui.landmarkNameLabel.setText(landmark_index.labels[widget.current_control_point_idx])
+        current_status = landmark_index.statuses[widget.current_control_point_idx]
 
-        if current_description == "Accepted":
+        if current_status == "Accepted":
             widget.ui.acceptedLandmarkCheck.checked = True
         else:
             widget.ui.acceptedLandmarkCheck.checked = False
 
-        if current_description == "Modify":
+        if current_status == "Modify":
             widget.ui.modifyLandmarkCheck.checked = True
         else:
             widget.ui.modifyLandmarkCheck.checked = False
 
-        if current_description == "Rejected":
+        if current_status == "Rejected":
             widget.ui.rejectedLandmarkCheck.checked = True
         else:
             widget.ui.rejectedLandmarkCheck.checked = False
 
         # display comment
-        description = widget.current_landmarks_list.GetNthControlPointDescription(
-            widget.current_control_point_idx).split(';')
-        if len(description) == 1:  # this means there is only a status
-            comment = ''
-        else:
-            comment = description[1][1:]
-
-        widget.ui.markupsCommentText.setPlainText(comment)
+        widget.ui.markupsCommentText.setPlainText(landmark_index.comments[widget.current_control_point_idx])
 
         # uncheck label vis
         widget.ui.labelVisCheck.checked = False
 
         # update volumes according to the current control point label
         if widget.view == "normal":
-            current_label = widget.current_landmarks_list.GetNthControlPointLabel(widget.current_control_point_idx)
-            for i in range(5):  # because we have 5 possible volumes
-
-                # we need this reversal because jumping landmarks and volumes are reversed
-                if direction == "forward":
-                    new_direction = "backward"
-                else:
-                    new_direction = "forward"
-
-                utils_views.change_view(widget, direction=new_direction)
-
-                current_id = widget.compositeNode.GetBackgroundVolumeID()
-                current_name = slicer.mrmlScene.GetNodeByID(current_id).GetName()
-
-                if current_label.split(' ')[1].lower() in current_name.lower():
-                    break
+            show_landmark_volume(widget, widget.current_control_point_idx)
 
             # make all other fiducials not visible
-            for i in range(control_points_amount):
-                if i != widget.current_control_point_idx:
-                    widget.current_landmarks_list.SetNthControlPointVisibility(i, False)
-                else:
-                    widget.current_landmarks_list.SetNthControlPointVisibility(i, True)
+            with landmark_index.unchanged():
+                widget.control_point_visibility.show_only(widget.current_landmarks_list,
+                                                          [widget.current_control_point_idx])
 
         else:
 
@@ -316,43 +411,20 @@ def jump_to_next_landmark(widget, direction="forward"):
             if second_control_point_idx == control_points_amount:
                 second_control_point_idx = 0
 
-            label_bottom = widget.current_landmarks_list.GetNthControlPointLabel(widget.current_control_point_idx)
-
             # change view groups of the normal views to 0
             for i in range(3):
-                slicer.app.layoutManager().sliceWidget(widget.views_normal[i]).mrmlSliceNode().SetViewGroup(
-                    0)
-                slicer.app.layoutManager().sliceWidget(widget.views_plus[i]).mrmlSliceNode().SetViewGroup(1)
+                widget.view_registry.slice_node(widget.views_normal[i]).SetViewGroup(0)
+                widget.view_registry.slice_node(widget.views_plus[i]).SetViewGroup(1)
 
             storage_top_row = widget.topRowActive
             storage_bottom_row = widget.bottomRowActive
             widget.topRowActive = False
             widget.bottomRowActive = True
 
-            for i in range(5):  # because we have 5 possible volumes
-
-                # we need this reversal because jumping landmarks and volumes are reversed
-                if direction == "forward":
-                    new_direction = "backward"
-                else:
-                    new_direction = "forward"
-
-                utils_views.change_view(widget, direction=new_direction)
-
-                current_id = widget.compositeNode.GetBackgroundVolumeID()
-                current_name = slicer.mrmlScene.GetNodeByID(current_id).GetName()
-
-                if "pre" in current_name.lower() and "op" in current_name.lower() and "pre-op" in label_bottom.lower():
-                    current_name = "pre-op"
-                elif "intra" in current_name.lower() and "op" in current_name.lower() and "intra-op" in label_bottom.lower():
-                    current_name = "intra-op"
-
-                if label_bottom.split(' ')[1].lower() in current_name.lower():
-                    break
+            show_landmark_volume(widget, widget.current_control_point_idx)
 
             # get n-th control point vector
-            pos = widget.current_landmarks_list.GetNthControlPointPositionVector(
-                widget.current_control_point_idx)
+            pos = landmark_index.get_position(widget.current_control_point_idx)
 
             # center views on current control point
             slicer.modules.markups.logic().JumpSlicesToLocation(pos[0], pos[1], pos[2], True, 1)
@@ -362,34 +434,13 @@ def jump_to_next_landmark(widget, direction="forward"):
             crosshairNode.SetCrosshairRAS(pos)
             crosshairNode.SetCrosshairMode(slicer.vtkMRMLCrosshairNode.ShowBasic)  # make it visible
 
-            label_top = widget.current_landmarks_list.GetNthControlPointLabel(second_control_point_idx)
-
             widget.topRowActive = True
             widget.bottomRowActive = False
 
-            for i in range(5):  # because we have 5 possible volumes
-
-                # we need this reversal because jumping landmarks and volumes are reversed
-                if direction == "forward":
-                    new_direction = "backward"
-                else:
-                    new_direction = "forward"
-
-                utils_views.change_view(widget, direction=new_direction)
-
-                current_id = widget.compositeNode.GetBackgroundVolumeID()
-                current_name = slicer.mrmlScene.GetNodeByID(current_id).GetName()
-
-                if "pre" in current_name.lower() and "op" in current_name.lower() and "pre-op" in label_top.lower():
-                    current_name = "pre-op"
-                elif "intra" in current_name.lower() and "op" in current_name.lower() and "intra-op" in label_top.lower():
-                    current_name = "intra-op"
-
-                if label_top.split(' ')[1].lower() in current_name.lower():
-                    break
+            show_landmark_volume(widget, second_control_point_idx)
 
             # get n-th control point vector
-            pos = widget.current_landmarks_list.GetNthControlPointPositionVector(second_control_point_idx)
+            pos = landmark_index.get_position(second_control_point_idx)
 
             # center views on current control point
             slicer.modules.markups.logic().JumpSlicesToLocation(pos[0], pos[1], pos[2], True, 0)
@@ -402,15 +453,12 @@ def jump_to_next_landmark(widget, direction="forward"):
             widget.topRowActive = storage_top_row
             widget.bottomRowActive = storage_bottom_row
 
-            utils_views.active_rows_update(widget)
+            MRUSLandmarkingLib.utils_views.active_rows_update(widget)
 
             # make all other fiducials not visible
-
-            for i in range(control_points_amount):
-                if i == widget.current_control_point_idx or i == second_control_point_idx:
-                    widget.current_landmarks_list.SetNthControlPointVisibility(i, True)
-                else:
-                    widget.current_landmarks_list.SetNthControlPointVisibility(i, False)
+            with landmark_index.unchanged():
+                widget.control_point_visibility.show_only(widget.current_landmarks_list,
+                                                          [widget.current_control_point_idx, second_control_point_idx])
 
         turn_off_placement_mode()
 
@@ -0,0 +1,206 @@
+import collections
+import csv
+import json
+import time
+
+import numpy as np
+import vtk
+import slicer
+
+
+class ShortcutLatencyRecorder:
+    """
+    Opt-in latency measurement of the keyboard shortcuts. Every wrapped shortcut records the time of its activation,
+    the end of its handler and the end of the renders of the slice views it changed (EndEvent of their render windows),
+    grouped by shortcut and layout. A view counts as changed if its slice or composite node was modified or it was
+    rendered during the handler. An activation whose renders are still pending when the next shortcut is activated is
+    dropped, as the following renders show both. Nothing is recorded and no observers are installed while the recorder
+    is disabled.
+    """
+
+    def __init__(self, max_samples=1000, max_render_wait_s=1.0):
+        """
+        :param max_samples: The number of latest samples that are kept per shortcut and layout
+        :param max_render_wait_s: Activations whose views are not all rendered within this time get no render latency
+        """
+        self.enabled = False
+        self.max_render_wait_s = max_render_wait_s
+
+        # (shortcut, layout) -> deque of (handler latency, render latency or None) in ms
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=max_samples))
+        self.dropped = 0  # activations that overlapped with the next one
+
+        # the activation waiting for renders: (shortcut, layout, activation time, handler end time, views not rendered yet)
+        self._pending = None
+        self._observations = []  # (render window, observer tag)
+        self._render_counts = collections.Counter()  # view name -> number of renders
+
+    def wrap(self, shortcut, callback):
+        """
+        Returns a callback that runs the given one and measures it when the recorder is enabled
+        :param shortcut: The key of the shortcut (e.g. 'a')
+        :param callback: The shortcut handler
+        """
+        def measured_callback():
+            if not self.enabled:
+                return callback()
+
+            if self._pending is not None:
+                self._pending = None
+                self.dropped += 1
+
+            views_before = self._view_states()
+            activation = time.perf_counter()
+            try:
+                return callback()
+            finally:
+                handler_end = time.perf_counter()
+                self._start_sample(shortcut, activation, handler_end, views_before)
+
+        return measured_callback
+
+    def enable(self):
+        if self.enabled:
+            return
+
+        self.enabled = True
+
+        slicer.app.layoutManager().connect('layoutChanged(int)', self._observe_render_windows)
+        self._observe_render_windows()
+
+    def disable(self):
+        if not self.enabled:
+            return
+
+        self.enabled = False
+
+        slicer.app.layoutManager().disconnect('layoutChanged(int)', self._observe_render_windows)
+        self._remove_observers()
+        self._finish_pending(None)
+
+    def clear(self):
+        self.samples.clear()
+        self.dropped = 0
+        self._pending = None
+
+    def _remove_observers(self):
+        for render_window, tag in self._observations:
+            render_window.RemoveObserver(tag)
+        self._observations = []
+
+    def _observe_render_windows(self, *args):
+        self._remove_observers()
+
+        layout_manager = slicer.app.layoutManager()
+        for view_name in layout_manager.sliceViewNames():
+            render_window = layout_manager.sliceWidget(view_name).sliceView().renderWindow()
+            tag = render_window.AddObserver(vtk.vtkCommand.EndEvent,
+                                            lambda caller, event, name=view_name: self._on_render_end(name))
+            self._observations.append((render_window, tag))
+
+    def _view_states(self):
+        """
+        return: view name -> (modification times of its slice and composite node, number of renders)
+        """
+        layout_manager = slicer.app.layoutManager()
+
+        states = {}
+        for view_name in layout_manager.sliceViewNames():
+            slice_widget = layout_manager.sliceWidget(view_name)
+            states[view_name] = ((slice_widget.mrmlSliceNode().GetMTime(),
+                                  slice_widget.mrmlSliceCompositeNode().GetMTime()),
+                                 self._render_counts[view_name])
+
+        return states
+
+    def _start_sample(self, shortcut, activation, handler_end, views_before):
+        modified = set()
+        rendered = set()
+        for view_name, (node_times, render_count) in self._view_states().items():
+            if view_name not in views_before:
+                continue
+            if node_times != views_before[view_name][0]:
+                modified.add(view_name)
+            if render_count != views_before[view_name][1]:
+                rendered.add(view_name)
+
+        self._pending = (shortcut, slicer.app.layoutManager().layout, activation, handler_end, modified)
+
+        # views that were only rendered by the handler itself (e.g. overlays) are already up to date
+        if not modified:
+            self._finish_pending(handler_end if rendered else None)
+
+    def _on_render_end(self, view_name):
+        self._render_counts[view_name] += 1
+
+        if self._pending is None or view_name not in self._pending[4]:
+            return
+
+        render_end = time.perf_counter()
+        activation, waiting = self._pending[2], self._pending[4]
+        waiting.discard(view_name)
+
+        if not waiting or render_end - activation > self.max_render_wait_s:
+            self._finish_pending(render_end)
+
+    def _finish_pending(self, render_end):
+        if self._pending is None:
+            return
+
+        shortcut, layout, activation, handler_end, _ = self._pending
+        self._pending = None
+
+        render_latency = None
+        if render_end is not None and render_end - activation <= self.max_render_wait_s:
+            render_latency = (render_end - activation) * 1000
+
+        self.samples[(shortcut, layout)].append(((handler_end - activation) * 1000, render_latency))
+
+    def summary(self):
+        """
+        Returns the latency statistics per shortcut and layout
+        return: A list of dicts with the shortcut, the layout, the number of samples and p50/p95/max of the handler and
+                the render latency in ms (None if there are no values)
+        """
+        rows = []
+
+        for (shortcut, layout), samples in sorted(self.samples.items(), key=lambda item: (item[0][0], item[0][1])):
+            row = {"shortcut": shortcut, "layout": layout, "count": len(samples)}
+
+            for column, values in (("handler", [s[0] for s in samples]),
+                                   ("render", [s[1] for s in samples if s[1] is not None])):
+                if values:
+                    row[f"{column}_p50_ms"] = round(float(np.percentile(values, 50)), 3)
+                    row[f"{column}_p95_ms"] = round(float(np.percentile(values, 95)), 3)
+                    row[f"{column}_max_ms"] = round(float(np.max(values)), 3)
+                else:
+                    row[f"{column}_p50_ms"] = row[f"{column}_p95_ms"] = row[f"{column}_max_ms"] = None
+
+            rows.append(row)
+
+        return rows
+
+    def export_csv(self, path):
+        """
+        Writes summary() as CSV
+        """
+        columns = ["shortcut", "layout", "count", "handler_p50_ms", "handler_p95_ms", "handler_max_ms",
+                   "render_p50_ms", "render_p95_ms", "render_max_ms"]
+
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+    def export_json(self, path):
+        """
+        Writes summary() and all samples as JSON
+        """
+        data = {"summary": self.summary(),
+                "dropped": self.dropped,
+                "samples": [{"shortcut": shortcut, "layout": layout, "handler_ms": handler, "render_ms": render}
+                            for (shortcut, layout), samples in self.samples.items()
+                            for handler, render in samples]}
+
+        with open(path, "w") as file:
+            json.dump(data, file, indent=2)
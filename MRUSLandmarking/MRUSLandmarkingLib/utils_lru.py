@@ -0,0 +1,68 @@
+"""
+Least recently used cache with a memory budget, shared by the caches of the module (intersections, slices and
+outlines). Nothing in here touches the MRML scene.
+"""
+import collections
+
+
+class LRUCache:
+    """
+    Least recently used cache with a memory budget - the least recently used entries are evicted as soon as the summed
+    size of all entries exceeds the budget
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: The budget in bytes
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        # key -> (value, size in bytes); the last entry is the most recently used one
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+
+        self._entries.move_to_end(key)
+
+        return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """
+        Stores a value (values larger than the whole budget are not stored)
+        :param key: Any hashable
+        :param value: The value
+        :param nbytes: The memory used by the value
+        """
+        self.pop(key)
+
+        if nbytes > self.max_bytes:
+            return
+
+        self._entries[key] = (value, nbytes)
+        self.current_bytes += nbytes
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_bytes
+
+    def pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+
+        value, nbytes = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
@@ -0,0 +1,238 @@
+"""
+On-disk store for computed FOV intersection masks. Masks are written as gzip-compressed NRRD files (so they can also be
+loaded into Slicer directly) named after a content hash of the US volumes they were computed from. Nothing in here
+touches the MRML scene, so the store can be used from worker threads.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+from MRUSLandmarkingLib.utils_masks import PackedMask
+
+
+def volume_digest(array, ijk_to_ras):
+    """
+    Hashes the header (shape, type and geometry) and the voxel data of a volume
+    :param array: The (k, j, i) array of the volume
+    :param ijk_to_ras: The IJK-to-RAS matrix of the volume
+    return: The hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(ijk_to_ras, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(array).data)
+
+    return digest.hexdigest()
+
+
+def content_key(digests, threshold_range=(1, 255), min_coverage=0):
+    """
+    Builds the key of an intersection from the digests of its volumes
+    :param digests: The volume digests - the first one is the reference volume (it defines the grid of the mask)
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param min_coverage: The number of volumes that have to cover a voxel (0 means all of them)
+    return: The hex key
+    """
+    if min_coverage <= 0 or min_coverage >= len(digests):
+        min_coverage = 0
+
+    # the order of all but the reference volume does not change the mask
+    description = [digests[0]] + sorted(digests[1:]) + [repr(tuple(float(t) for t in threshold_range)),
+                                                        str(min_coverage)]
+
+    return hashlib.sha256("\n".join(description).encode()).hexdigest()
+
+
+def write_mask_nrrd(path, mask, ijk_to_ras, fields=None):
+    """
+    Writes a boolean mask as a gzip-compressed NRRD file
+    :param path: The file path
+    :param mask: The PackedMask
+    :param ijk_to_ras: The IJK-to-RAS matrix of the mask
+    :param fields: Optional dict of additional key-value pairs for the header
+    """
+    data = mask.to_labelmap()
+
+    directions = " ".join("({0!r},{1!r},{2!r})".format(*(float(x) for x in ijk_to_ras[:3, axis])) for axis in range(3))
+    origin = "({0!r},{1!r},{2!r})".format(*(float(x) for x in ijk_to_ras[:3, 3]))
+
+    header = ["NRRD0004",
+              "# Complete NRRD file format specification at:",
+              "# http://teem.sourceforge.net/nrrd/format.html",
+              "type: unsigned char",
+              "dimension: 3",
+              "space: right-anterior-superior",
+              f"sizes: {data.shape[2]} {data.shape[1]} {data.shape[0]}",
+              f"space directions: {directions}",
+              "kinds: domain domain domain",
+              "endian: little",
+              "encoding: gzip",
+              f"space origin: {origin}",
+              f"mrus_sha256:={hashlib.sha256(data.data).hexdigest()}"]
+    for key, value in (fields or {}).items():
+        header.append(f"{key}:={value}")
+
+    # write to a temporary file first, so that readers never see half-written files
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(("\n".join(header) + "\n\n").encode("ascii"))
+            file.write(gzip.compress(data.tobytes(), compresslevel=6))
+        os.replace(temporary_path, path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def read_mask_nrrd(path):
+    """
+    Reads a mask written by write_mask_nrrd() and checks its integrity
+    :param path: The file path
+    return: The PackedMask, its IJK-to-RAS matrix and a dict of the additional header fields
+    """
+    with open(path, "rb") as file:
+        content = file.read()
+
+    header, separator, payload = content.partition(b"\n\n")
+    if not separator or not header.startswith(b"NRRD"):
+        raise ValueError(f"{path} is not a NRRD file.")
+
+    fields = {}
+    key_values = {}
+    for line in header.decode("ascii").splitlines()[1:]:
+        if line.startswith("#"):
+            continue
+        if ":=" in line:
+            key, value = line.split(":=", 1)
+            key_values[key] = value
+        else:
+            key, value = line.split(": ", 1)
+            fields[key] = value
+
+    if fields.get("type") != "unsigned char" or fields.get("encoding") != "gzip" or fields.get("dimension") != "3":
+        raise ValueError(f"{path} is not a mask written by the MRUSLandmarking mask store.")
+
+    sizes = [int(size) for size in fields["sizes"].split()]
+    vectors = [[float(x) for x in vector.split(",")] for vector in re.findall(r"\(([^)]*)\)", fields["space directions"])]
+    origin = [float(x) for x in re.findall(r"\(([^)]*)\)", fields["space origin"])[0].split(",")]
+
+    data = gzip.decompress(payload)
+    if hashlib.sha256(data).hexdigest() != key_values.pop("mrus_sha256", None):
+        raise ValueError(f"{path} is corrupted (checksum mismatch).")
+
+    mask = PackedMask.from_labelmap(np.frombuffer(data, dtype=np.uint8).reshape(sizes[2], sizes[1], sizes[0]))
+
+    ijk_to_ras = np.eye(4)
+    ijk_to_ras[:3, :3] = np.array(vectors).T
+    ijk_to_ras[:3, 3] = origin
+
+    return mask, ijk_to_ras, key_values
+
+
+class MaskStore:
+    """
+    Directory of intersection masks keyed by content_key(). Loading a mask marks it as recently used, and cleanup()
+    removes the least recently used masks once the directory grows beyond its size cap. Temporary files of writes that
+    never finished (e.g. Slicer was killed while saving) are removed once they are older than partial_grace_s.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, partial_grace_s=3600):
+        """
+        :param directory: The cache directory (created if it does not exist)
+        :param max_bytes: The size cap of all stored masks
+        :param partial_grace_s: The age after which a temporary (.part) file counts as left behind
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.partial_grace_s = partial_grace_s
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}-intersection.nrrd")
+
+    def load(self, key):
+        """
+        Loads a stored mask - corrupted files are removed
+        :param key: The key returned by content_key()
+        return: The mask and its IJK-to-RAS matrix or None if nothing valid is stored under the key
+        """
+        path = self.path(key)
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            mask, ijk_to_ras, fields = read_mask_nrrd(path)
+            if fields.get("mrus_key") != key:
+                raise ValueError(f"{path} belongs to a different key.")
+        except (OSError, ValueError, EOFError, zlib.error) as e:
+            logging.warning(f"Removing invalid stored intersection: {e}")
+            os.remove(path)
+            return None
+
+        os.utime(path)  # mark as recently used
+
+        return mask, ijk_to_ras
+
+    def save(self, key, mask, ijk_to_ras):
+        """
+        Stores a mask and enforces the size cap
+        :param key: The key returned by content_key()
+        :param mask: The PackedMask
+        :param ijk_to_ras: The IJK-to-RAS matrix of the mask
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        write_mask_nrrd(self.path(key), mask, ijk_to_ras, fields={"mrus_key": key})
+
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        Removes left behind temporary files and the least recently used masks until the store is within its size cap
+        (temporary files of writes that may still be running count towards the cap, but are not removed)
+        """
+        if not os.path.isdir(self.directory):
+            return
+
+        now = time.time()
+
+        entries = []
+        partial_bytes = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            try:
+                if name.endswith("-intersection.nrrd"):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, name))
+
+                elif name.endswith(".part"):
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.partial_grace_s:
+                        os.remove(path)
+                    else:
+                        partial_bytes += stat.st_size
+
+            except FileNotFoundError:  # finished or removed by another writer in the meantime
+                continue
+
+        total_bytes = partial_bytes + sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
@@ -0,0 +1,186 @@
+"""
+Compact binary masks for the FOV intersection pipeline. A PackedMask stores 8 voxels per byte (np.packbits) slice by
+slice, so that large intermediate masks take an eighth of the memory of a boolean array, and single slices can be
+unpacked lazily. Nothing in here touches the MRML scene.
+"""
+import numpy as np
+
+# number of set bits of every possible byte value
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+class PackedMask:
+    """
+    Bit-packed 3D binary mask in (k, j, i) order. Every k-slice is packed into its own row of bytes, the padding bits at
+    the end of a row are always 0.
+    """
+
+    def __init__(self, shape, bits):
+        """
+        :param shape: The (k, j, i) shape of the mask
+        :param bits: The packed (k, ceil(j * i / 8)) uint8 array
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.bits = bits
+
+    @classmethod
+    def full(cls, shape, value=False):
+        """
+        Returns a mask in which all voxels are set to value
+        """
+        mask = cls(shape, np.zeros((shape[0], (shape[1] * shape[2] + 7) // 8), dtype=np.uint8))
+
+        if value:
+            mask.bits[:] = np.packbits(np.ones(shape[1] * shape[2], dtype=bool))
+
+        return mask
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Packs a (k, j, i) array - all non-zero voxels are set
+        """
+        array = np.asarray(array)
+
+        return cls(array.shape, np.packbits(array.reshape(array.shape[0], -1) != 0, axis=1))
+
+    @classmethod
+    def from_labelmap(cls, labelmap, label=None):
+        """
+        Packs a labelmap array
+        :param labelmap: The (k, j, i) labelmap array
+        :param label: The label that is set in the mask (all non-zero labels if None)
+        """
+        if label is None:
+            return cls.from_array(labelmap)
+
+        return cls.from_array(np.asarray(labelmap) == label)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def copy(self):
+        return PackedMask(self.shape, self.bits.copy())
+
+    def unpack(self, slices=None):
+        """
+        Unpacks a range of k-slices
+        :param slices: A range of k-indices (all slices if None)
+        return: The boolean (len(slices), j, i) array
+        """
+        if slices is None:
+            slices = range(self.shape[0])
+
+        voxels_per_slice = self.shape[1] * self.shape[2]
+        rows = np.unpackbits(self.bits[slices.start:slices.stop], axis=1, count=voxels_per_slice)
+
+        return rows.reshape(len(slices), self.shape[1], self.shape[2]).view(bool)
+
+    def pack(self, slices, values):
+        """
+        Overwrites a range of k-slices
+        :param slices: A range of k-indices
+        :param values: A (len(slices), j, i) array
+        """
+        self.bits[slices.start:slices.stop] = np.packbits(np.asarray(values).reshape(len(slices), -1) != 0, axis=1)
+
+    def __getitem__(self, k):
+        """
+        Unpacks a single k-slice
+        return: The boolean (j, i) array
+        """
+        return self.unpack(range(k, k + 1))[0]
+
+    def sample(self, kk, jj, ii):
+        """
+        Reads single voxels straight from the packed bits (without unpacking their slices)
+        :param kk: Array of k-indices
+        :param jj: Array of j-indices (same shape as kk)
+        :param ii: Array of i-indices (same shape as kk)
+        return: The boolean array of the voxel values
+        """
+        flat = np.asarray(jj, dtype=np.intp) * self.shape[2] + np.asarray(ii, dtype=np.intp)
+        byte = self.bits[np.asarray(kk, dtype=np.intp), flat >> 3]
+
+        return ((byte >> (7 - (flat & 7)).astype(np.uint8)) & 1).astype(bool)
+
+    def iter_slices(self):
+        for k in range(self.shape[0]):
+            yield self[k]
+
+    def to_array(self):
+        return self.unpack()
+
+    def to_labelmap(self, label=1):
+        """
+        Returns a uint8 labelmap array (for displaying the mask)
+        """
+        return self.unpack().astype(np.uint8) * np.uint8(label)
+
+    def slice_any(self):
+        """
+        Returns for every k-slice whether any voxel in it is set
+        """
+        return self.bits.any(axis=1)
+
+    def any(self):
+        return bool(self.bits.any())
+
+    def count(self):
+        """
+        Returns the number of set voxels
+        """
+        return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def _check_shape(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f"Mask shapes do not match: {self.shape} and {other.shape}")
+
+    def __and__(self, other):
+        self._check_shape(other)
+        return PackedMask(self.shape, self.bits & other.bits)
+
+    def __or__(self, other):
+        self._check_shape(other)
+        return PackedMask(self.shape, self.bits | other.bits)
+
+    def __iand__(self, other):
+        self._check_shape(other)
+        self.bits &= other.bits
+        return self
+
+    def __ior__(self, other):
+        self._check_shape(other)
+        self.bits |= other.bits
+        return self
+
+    def bounding_box(self):
+        """
+        Returns the (k, j, i) slices of the bounding box of the set voxels or None if the mask is empty
+        """
+        k_indices = np.flatnonzero(self.slice_any())
+        if len(k_indices) == 0:
+            return None
+
+        # project the non-empty slices onto the (j, i) plane one at a time
+        projection = np.zeros(self.shape[1:], dtype=bool)
+        for k in k_indices:
+            projection |= self[k]
+
+        j_indices = np.flatnonzero(projection.any(axis=1))
+        i_indices = np.flatnonzero(projection.any(axis=0))
+
+        return tuple(slice(int(indices[0]), int(indices[-1]) + 1) for indices in (k_indices, j_indices, i_indices))
+
+    def crop(self, bounds):
+        """
+        Returns the part of the mask inside of the given (k, j, i) slices
+        """
+        shape = tuple(s.stop - s.start for s in bounds)
+        cropped = PackedMask.full(shape)
+
+        for k in range(shape[0]):
+            cropped.pack(range(k, k + 1), self[bounds[0].start + k][bounds[1], bounds[2]][np.newaxis])
+
+        return cropped
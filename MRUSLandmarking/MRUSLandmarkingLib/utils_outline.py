@@ -0,0 +1,236 @@
+import numpy as np
+import qt
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+import MRUSLandmarkingLib.utils_lru
+
+
+class SliceOutlineDisplay:
+    """
+    Shows the outline of a 3D mask in the slice views without building a segmentation. The outline is only computed for
+    the slice that is currently shown in a view - lazily, after the slice node changed - and cached per
+    (view, orientation, offset), so scrolling back to a slice or panning and zooming does not recompute it.
+    Each view gets a model node with a thin ribbon along the outline that is only visible in that view.
+    """
+
+    def __init__(self, color=(1.0, 1.0, 0.0), cache_bytes=64 * 1024 ** 2):
+        """
+        :param color: The color of the outline
+        :param cache_bytes: The memory budget of the cached outlines
+        """
+        self.color = color
+
+        self.mask = None
+        self.ijk_to_ras = None
+        self.ras_to_ijk = None
+
+        self._cache = MRUSLandmarkingLib.utils_lru.LRUCache(cache_bytes)
+        self._observations = []  # (slice node, observer tag)
+        self._models = {}  # view name -> model node
+        self._pending_views = set()
+
+        # coalesces all slice node changes of one event loop iteration
+        self._timer = qt.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(0)
+        self._timer.connect('timeout()', self._update_pending_views)
+
+        self._layout_connected = False
+
+    def set_mask(self, mask, ijk_to_ras):
+        """
+        Shows the outline of a new mask
+        :param mask: The PackedMask
+        :param ijk_to_ras: The IJK-to-RAS matrix of the mask
+        """
+        self.mask = mask
+        self.ijk_to_ras = ijk_to_ras
+        self.ras_to_ijk = np.linalg.inv(ijk_to_ras)
+
+        self._cache.clear()
+
+        if not self._layout_connected:
+            slicer.app.layoutManager().connect('layoutChanged(int)', self._on_layout_changed)
+            self._layout_connected = True
+
+        self._attach()
+
+    def clear(self):
+        """
+        Removes the outline from all views and stops observing them
+        """
+        self._detach()
+
+        for model_node in self._models.values():
+            if slicer.mrmlScene.IsNodePresent(model_node):
+                slicer.mrmlScene.RemoveNode(model_node)
+        self._models = {}
+
+        if self._layout_connected:
+            slicer.app.layoutManager().disconnect('layoutChanged(int)', self._on_layout_changed)
+            self._layout_connected = False
+
+        self.mask = None
+        self._cache.clear()
+
+    def _attach(self):
+        self._detach()
+
+        layout_manager = slicer.app.layoutManager()
+
+        for view_name in layout_manager.sliceViewNames():
+            slice_node = layout_manager.sliceWidget(view_name).mrmlSliceNode()
+            tag = slice_node.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                         lambda caller, event, name=view_name: self._request_update(name))
+            self._observations.append((slice_node, tag))
+            self._pending_views.add(view_name)
+
+        self._timer.start()
+
+    def _detach(self):
+        for slice_node, tag in self._observations:
+            slice_node.RemoveObserver(tag)
+        self._observations = []
+        self._pending_views = set()
+
+    def _on_layout_changed(self, layout):
+        if self.mask is not None:
+            self._attach()
+
+    def _request_update(self, view_name):
+        self._pending_views.add(view_name)
+        self._timer.start()
+
+    def _update_pending_views(self):
+        pending_views, self._pending_views = self._pending_views, set()
+
+        for view_name in pending_views:
+            self.update_view(view_name)
+
+    def update_view(self, view_name):
+        """
+        Shows the outline of the slice that is currently displayed in a view
+        :param view_name: The name of the slice view (e.g. 'Red')
+        """
+        if self.mask is None:
+            return
+
+        slice_widget = slicer.app.layoutManager().sliceWidget(view_name)
+        if slice_widget is None:
+            return
+        slice_node = slice_widget.mrmlSliceNode()
+
+        slice_to_ras = slicer.util.arrayFromVTKMatrix(slice_node.GetSliceToRAS())
+        normal = slice_to_ras[:3, 2] / np.linalg.norm(slice_to_ras[:3, 2])
+        offset = normal @ slice_to_ras[:3, 3]
+
+        # panning and zooming move the slice origin within the plane, which does not change the outline
+        key = (view_name, tuple(np.round(slice_to_ras[:3, :3], 4).ravel()), round(float(offset), 3))
+
+        polydata = self._cache.get(key)
+        if polydata is None:
+            polydata = self.compute_outline(slice_to_ras)
+            self._cache.put(key, polydata, polydata.GetActualMemorySize() * 1024)
+
+        self._get_model(view_name, slice_node).SetAndObservePolyData(polydata)
+
+    def _get_model(self, view_name, slice_node):
+        model_node = self._models.get(view_name)
+
+        if model_node is None or not slicer.mrmlScene.IsNodePresent(model_node):
+            model_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", f"US intersection outline {view_name}")
+            model_node.CreateDefaultDisplayNodes()
+
+            display_node = model_node.GetDisplayNode()
+            display_node.SetColor(*self.color)
+            display_node.SetVisibility3D(False)
+            display_node.SetVisibility2D(True)
+            display_node.SetSliceIntersectionThickness(2)
+            display_node.AddViewNodeID(slice_node.GetID())
+
+            self._models[view_name] = model_node
+
+        return model_node
+
+    def compute_outline(self, slice_to_ras):
+        """
+        Computes the outline of the mask in a slice plane
+        :param slice_to_ras: The 4x4 slice-to-RAS matrix of the plane
+        return: vtkPolyData of a thin ribbon along the outline (crossing the plane, so the slice view shows it as a line)
+        """
+        u = slice_to_ras[:3, 0] / np.linalg.norm(slice_to_ras[:3, 0])
+        v = slice_to_ras[:3, 1] / np.linalg.norm(slice_to_ras[:3, 1])
+        normal = slice_to_ras[:3, 2] / np.linalg.norm(slice_to_ras[:3, 2])
+        origin = slice_to_ras[:3, 3]
+
+        shape = self.mask.shape
+        corners = np.array([[i, j, k, 1] for i in (0, shape[2] - 1) for j in (0, shape[1] - 1) for k in (0, shape[0] - 1)])
+        corners = (self.ijk_to_ras @ corners.T)[:3].T - origin
+
+        spacing = float(np.linalg.norm(self.ijk_to_ras[:3, :3], axis=0).min())
+
+        # the plane does not cut the mask
+        distances = corners @ normal
+        if distances.min() > spacing or distances.max() < -spacing:
+            return vtk.vtkPolyData()
+
+        # sample the mask on a grid in the plane that covers the projection of the mask (plus an empty border)
+        a_range = corners @ u
+        b_range = corners @ v
+        a = np.arange(a_range.min() - spacing, a_range.max() + 2 * spacing, spacing)
+        b = np.arange(b_range.min() - spacing, b_range.max() + 2 * spacing, spacing)
+        grid_b, grid_a = np.meshgrid(b, a, indexing='ij')
+
+        points = origin + grid_a[..., np.newaxis] * u + grid_b[..., np.newaxis] * v
+        ijk = np.rint(points @ self.ras_to_ijk[:3, :3].T + self.ras_to_ijk[:3, 3]).astype(np.intp)
+        ii, jj, kk = ijk[..., 0], ijk[..., 1], ijk[..., 2]
+
+        inside = (ii >= 0) & (ii < shape[2]) & (jj >= 0) & (jj < shape[1]) & (kk >= 0) & (kk < shape[0])
+        inside[0, :] = inside[-1, :] = inside[:, 0] = inside[:, -1] = False
+
+        # gather all in-bounds samples in one pass, whatever number of k-slices the plane crosses
+        sampled = np.zeros(inside.shape, dtype=np.uint8)
+        sampled[inside] = self.mask.sample(kk[inside], jj[inside], ii[inside])
+
+        if not sampled.any():
+            return vtk.vtkPolyData()
+
+        image = vtk.vtkImageData()
+        image.SetDimensions(len(a), len(b), 1)
+        image.SetOrigin(a[0], b[0], 0)
+        image.SetSpacing(spacing, spacing, 1)
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(sampled.ravel(), deep=True))
+
+        contour = vtk.vtkMarchingSquares()
+        contour.SetInputData(image)
+        contour.SetValue(0, 0.5)
+
+        # move the contour from plane coordinates to RAS, half a voxel below the plane ...
+        plane_to_ras = vtk.vtkMatrix4x4()
+        for row in range(3):
+            plane_to_ras.SetElement(row, 0, u[row])
+            plane_to_ras.SetElement(row, 1, v[row])
+            plane_to_ras.SetElement(row, 2, normal[row])
+            plane_to_ras.SetElement(row, 3, origin[row] - normal[row] * spacing / 2)
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(plane_to_ras)
+
+        transform_filter = vtk.vtkTransformPolyDataFilter()
+        transform_filter.SetInputConnection(contour.GetOutputPort())
+        transform_filter.SetTransform(transform)
+
+        # ... and extrude it through the plane
+        extrusion = vtk.vtkLinearExtrusionFilter()
+        extrusion.SetInputConnection(transform_filter.GetOutputPort())
+        extrusion.SetExtrusionTypeToVectorExtrusion()
+        extrusion.SetVector(*normal)
+        extrusion.SetScaleFactor(spacing)
+        extrusion.CappingOff()
+        extrusion.Update()
+
+        polydata = vtk.vtkPolyData()
+        polydata.DeepCopy(extrusion.GetOutput())
+
+        return polydata
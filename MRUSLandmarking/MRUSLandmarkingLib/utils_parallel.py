@@ -0,0 +1,239 @@
+"""
+Thresholds US volumes in a pool of worker processes. The volume arrays are copied once into shared memory blocks that
+the workers read without pickling them, and every worker writes its bit-packed mask into a shared output block. Only
+combining the masks (e.g. the AND of the intersection) is done in the calling process.
+
+Inside Slicer, sys.executable is the Slicer application, so the workers are started with the PythonSlicer interpreter
+that is installed next to it. Scripts that use the pool must guard their entry point with
+if __name__ == "__main__", as the workers are spawned (not forked) and import the main module again.
+"""
+import contextlib
+import logging
+import multiprocessing
+import multiprocessing.context
+import multiprocessing.spawn
+import os
+import sys
+from concurrent.futures import CancelledError, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from MRUSLandmarkingLib.utils_intersection import intersection_mask
+from MRUSLandmarkingLib.utils_masks import PackedMask
+
+# importlib.reload() re-runs this module, the pool of the previous version must not be left running
+if globals().get("_executor") is not None:
+    globals()["_executor"].shutdown(wait=False, cancel_futures=True)
+
+_executor = None
+_executor_workers = None
+
+
+def python_executable():
+    """
+    Returns the Python interpreter for the worker processes - PythonSlicer if it is installed next to sys.executable
+    """
+    directory = os.path.dirname(sys.executable)
+
+    for name in ("PythonSlicer", "PythonSlicer.exe"):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+
+    return sys.executable
+
+
+def _get_executor(max_workers=None):
+    """
+    Returns the process pool (it is reused between calls, as starting the workers takes a while) - jobs have to be
+    submitted with submit(), so the workers are started with the right interpreter
+    :param max_workers: The number of worker processes (defaults to the number of CPUs)
+    """
+    global _executor, _executor_workers
+
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if _executor is None or _executor_workers != max_workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+
+        # a private context, so the default spawn context of other code is not used for the pool
+        _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.context.SpawnContext())
+        _executor_workers = max_workers
+
+    return _executor
+
+
+@contextlib.contextmanager
+def _worker_executable():
+    """
+    Starts spawned processes with python_executable() inside the block. The executable of spawned processes is global
+    in multiprocessing (a context cannot have its own), so it is only changed while the pool starts its workers (on
+    submit) and restored afterwards.
+    """
+    previous = multiprocessing.spawn.get_executable()
+    multiprocessing.spawn.set_executable(python_executable())
+
+    try:
+        yield
+    finally:
+        multiprocessing.spawn.set_executable(previous)
+
+
+def submit(fn, *args, max_workers=None):
+    """
+    Submits a job to the process pool - the only way to use the pool, as the workers that it starts on submit have to
+    run python_executable() (inside Slicer, sys.executable is the Slicer application)
+    :param fn: The function to run in a worker process (it has to be importable by the worker)
+    :param args: The arguments of the function
+    :param max_workers: The number of worker processes (defaults to the number of CPUs)
+    return: The concurrent.futures.Future of the job
+    """
+    executor = _get_executor(max_workers)
+
+    with _worker_executable():
+        return executor.submit(fn, *args)
+
+
+def shutdown_executor():
+    global _executor, _executor_workers
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+    _executor = None
+    _executor_workers = None
+
+
+def _threshold_job(input_name, shape, dtype, ijk_to_ras, grid_shape, grid_ijk_to_ras, threshold_range, output_name,
+                   offset):
+    # runs in a worker process
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+
+    try:
+        array = np.ndarray(shape, dtype=dtype, buffer=input_memory.buf)
+        mask = intersection_mask([(array, ijk_to_ras)], grid_shape, grid_ijk_to_ras, threshold_range)
+
+        output = np.ndarray(mask.bits.shape, dtype=np.uint8, buffer=output_memory.buf, offset=offset)
+        output[:] = mask.bits
+
+        # the views have to be released before the blocks can be closed
+        del array, output
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+
+def _packed_shape(grid_shape):
+    return grid_shape[0], (grid_shape[1] * grid_shape[2] + 7) // 8
+
+
+def threshold_volumes(jobs, threshold_range=(1, 255), max_workers=None, progress_callback=None, cancel_event=None):
+    """
+    Thresholds every volume on its own grid in parallel (falls back to the calling process if the pool cannot be used)
+    :param jobs: A list of (array, ijk_to_ras, grid_shape, grid_ijk_to_ras) tuples
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param max_workers: The number of worker processes (defaults to the number of CPUs)
+    :param progress_callback: Optional function called with (finished volumes, all volumes)
+    :param cancel_event: Optional threading.Event - when it is set the computation stops with a CancelledError
+    return: A list with the PackedMask of every job
+    """
+    if max_workers is None:
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+
+    if len(jobs) > 1 and max_workers > 1:
+        try:
+            return _threshold_volumes_in_pool(jobs, threshold_range, max_workers, progress_callback, cancel_event)
+        except (BrokenProcessPool, OSError) as e:
+            logging.warning(f"Thresholding in worker processes failed, thresholding serially instead: {e}")
+            shutdown_executor()
+
+    masks = []
+    for idx, (array, ijk_to_ras, grid_shape, grid_ijk_to_ras) in enumerate(jobs):
+        masks.append(intersection_mask([(array, ijk_to_ras)], grid_shape, grid_ijk_to_ras, threshold_range,
+                                       cancel_event=cancel_event))
+
+        if progress_callback is not None:
+            progress_callback(idx + 1, len(jobs))
+
+    return masks
+
+
+def _threshold_volumes_in_pool(jobs, threshold_range, max_workers, progress_callback, cancel_event):
+    offsets = np.cumsum([0] + [np.prod(_packed_shape(job[2])) for job in jobs]).tolist()
+
+    blocks = []
+    futures = set()
+    try:
+        output_memory = shared_memory.SharedMemory(create=True, size=max(offsets[-1], 1))
+        blocks.append(output_memory)
+
+        for idx, (array, ijk_to_ras, grid_shape, grid_ijk_to_ras) in enumerate(jobs):
+            input_memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(input_memory)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=input_memory.buf)[:] = array
+
+            futures.add(submit(_threshold_job, input_memory.name, array.shape, array.dtype.str, np.asarray(ijk_to_ras),
+                               tuple(grid_shape), np.asarray(grid_ijk_to_ras), tuple(threshold_range),
+                               output_memory.name, offsets[idx], max_workers=max_workers))
+
+        pending = futures
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                for future in pending:
+                    future.cancel()
+                raise CancelledError("The intersection computation was cancelled.")
+
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                future.result()  # raises the exception of the worker
+
+            if done and progress_callback is not None:
+                progress_callback(len(futures) - len(pending), len(futures))
+
+        masks = []
+        for idx, job in enumerate(jobs):
+            packed_shape = _packed_shape(job[2])
+            bits = np.ndarray(packed_shape, dtype=np.uint8, buffer=output_memory.buf, offset=offsets[idx]).copy()
+            masks.append(PackedMask(job[2], bits))
+
+        return masks
+
+    finally:
+        # cancel() does not stop jobs that are already running - they still read and write the blocks
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def parallel_intersection_mask(volumes, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255), max_workers=None,
+                               progress_callback=None, cancel_event=None):
+    """
+    Same as utils_intersection.intersection_mask(), but every volume is thresholded in its own worker process and only
+    the AND of the masks is computed here
+    :param volumes: A list of (array, ijk_to_ras) tuples
+    :param grid_shape: The (k, j, i) shape of the grid
+    :param grid_ijk_to_ras: The IJK-to-RAS matrix of the grid
+    :param threshold_range: (minimum, maximum) intensity that counts as 'inside the FOV'
+    :param max_workers: The number of worker processes (defaults to the number of CPUs)
+    :param progress_callback: Optional function called with (finished volumes, all volumes)
+    :param cancel_event: Optional threading.Event - when it is set the computation stops with a CancelledError
+    return: The intersection mask on the grid as a PackedMask
+    """
+    jobs = [(array, ijk_to_ras, grid_shape, grid_ijk_to_ras) for array, ijk_to_ras in volumes]
+
+    masks = threshold_volumes(jobs, threshold_range, max_workers, progress_callback, cancel_event)
+
+    mask = PackedMask.full(grid_shape, True)
+    for volume_mask in masks:
+        mask &= volume_mask
+
+    return mask
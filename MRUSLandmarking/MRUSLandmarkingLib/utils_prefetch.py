@@ -0,0 +1,97 @@
+import collections
+import logging
+import time
+
+import qt
+import slicer
+
+
+class VolumePrefetcher:
+    """
+    Reslices the slices of the volumes that the next volume switch will display into a SliceImageCache, so that the
+    switch is shown from the cache. The work is split into one job per (volume, view) and runs in idle time of the Qt
+    event loop: every idle slot runs jobs for at most tick_budget_ms, and jobs that have not run max_total_ms after they
+    were scheduled are dropped. Scheduling new volumes replaces the jobs that have not run yet.
+
+    Slicer's own reslice of a slice layer cannot be run ahead of time, so prefetching depends on the slice cache: while
+    the cache is disabled, nothing is scheduled.
+    """
+
+    def __init__(self, slice_cache, tick_budget_ms=10, max_total_ms=500):
+        """
+        :param slice_cache: The SliceImageCache that is filled with the resliced slices
+        :param tick_budget_ms: The time jobs may run in one idle slot
+        :param max_total_ms: Jobs that have not run this long after scheduling are dropped
+        """
+        self.slice_cache = slice_cache
+        self.tick_budget_ms = tick_budget_ms
+        self.max_total_ms = max_total_ms
+
+        self._jobs = collections.deque()
+        self._deadline = 0
+
+        self._timer = qt.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(0)  # fires once the event loop has no other events to process
+        self._timer.connect('timeout()', self._run_jobs)
+
+    def schedule(self, volume_ids, view_names):
+        """
+        Replaces the pending jobs with caching the slices of the given volumes in the given views (only cancels the
+        pending jobs if the slice cache is disabled)
+        :param volume_ids: The IDs of the volumes (None entries are ignored)
+        :param view_names: The names of the slice views
+        """
+        if not self.slice_cache.enabled:
+            self.cancel()
+            return
+
+        self._jobs = collections.deque((volume_id, view_name)
+                                       for volume_id in dict.fromkeys(volume_ids) if volume_id is not None
+                                       for view_name in view_names)
+        self._deadline = time.perf_counter() + self.max_total_ms / 1000
+
+        if self._jobs:
+            self._timer.start()
+
+    def cancel(self):
+        self._timer.stop()
+        self._jobs.clear()
+
+    def _run_jobs(self):
+        start = time.perf_counter()
+
+        if start > self._deadline:
+            self._jobs.clear()
+            return
+
+        while self._jobs and self.slice_cache.enabled and (time.perf_counter() - start) * 1000 < self.tick_budget_ms:
+            volume_id, view_name = self._jobs.popleft()
+
+            try:
+                self.warm(volume_id, view_name)
+            except Exception as e:  # warming is only an optimisation, a failed job must not disturb the user
+                logging.debug(f"Could not prefetch {volume_id} in {view_name}: {e}")
+
+        if self._jobs and self.slice_cache.enabled:
+            self._timer.start()
+
+    def warm(self, volume_id, view_name):
+        """
+        Caches the slice of one volume in one view (does nothing if it is already cached at the current pose or the
+        slice cache is disabled)
+        return: True if the slice was resliced
+        """
+        volume = slicer.mrmlScene.GetNodeByID(volume_id)
+
+        if not self.slice_cache.enabled or volume is None or volume.GetImageData() is None:
+            return False
+
+        # the slice is cached with the display settings of the volume, which a volume that was never shown lacks
+        if volume.GetDisplayNode() is None:
+            volume.CreateDefaultDisplayNodes()
+
+        if self.slice_cache.get_slice(view_name, volume_id, reslice=False) is not None:
+            return False
+
+        return self.slice_cache.get_slice(view_name, volume_id) is not None
@@ -0,0 +1,147 @@
+import qt
+import vtk
+import slicer
+
+import MRUSLandmarkingLib.utils_views
+
+SYNC_PROPERTIES = ("volumes", "opacity", "offset")
+
+
+class RowSynchronizer:
+    """
+    Live synchronisation of the bottom row of the 3-over-3 layout with the top row. The composite and slice nodes of
+    the top row are observed, the views whose nodes were modified are collected and synchronised at most every
+    interval_ms, and only the properties that differ (and whose synchronisation is switched on) are set in the
+    corresponding bottom row views.
+    """
+
+    def __init__(self, views_normal, views_plus, registry=None, interval_ms=30):
+        """
+        :param views_normal: The names of the top row views (e.g. ["Red", "Green", "Yellow"])
+        :param views_plus: The names of the corresponding bottom row views (e.g. ["Red+", "Green+", "Yellow+"])
+        :param registry: An optional ViewRegistry used to look up the views
+        :param interval_ms: The minimal time between two synchronisations
+        """
+        self.views_normal = views_normal
+        self.views_plus = views_plus
+        self.registry = registry
+
+        self.properties = {name: True for name in SYNC_PROPERTIES}
+        self.active = False
+
+        self._observations = []  # (node, observer tag)
+        self._dirty = set()  # indices of the top row views that were modified
+
+        self._timer = qt.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval_ms)
+        self._timer.connect('timeout()', self._sync_dirty)
+
+    def set_property(self, name, enabled):
+        """
+        Switches the synchronisation of one property ("volumes", "opacity" or "offset") on or off
+        """
+        if name not in self.properties:
+            raise ValueError(f"Unknown property {name} - choose one of {', '.join(SYNC_PROPERTIES)}.")
+
+        self.properties[name] = enabled
+
+        if enabled and self.active:
+            self.sync_all()
+
+    def start(self):
+        if self.active:
+            return
+
+        self.active = True
+
+        slicer.app.layoutManager().connect('layoutChanged(int)', self._observe_views)
+        self._observe_views()
+
+    def stop(self):
+        if not self.active:
+            return
+
+        self.active = False
+
+        slicer.app.layoutManager().disconnect('layoutChanged(int)', self._observe_views)
+        self._remove_observers()
+        self._timer.stop()
+        self._dirty.clear()
+
+    def _get_view(self, view_name):
+        if self.registry is not None:
+            return self.registry.get(view_name)
+
+        return MRUSLandmarkingLib.utils_views.resolve_view(view_name)
+
+    def _remove_observers(self):
+        for node, tag in self._observations:
+            node.RemoveObserver(tag)
+        self._observations = []
+
+    def _observe_views(self, *args):
+        self._remove_observers()
+
+        for idx, view_name in enumerate(self.views_normal):
+            entry = self._get_view(view_name)
+            if entry is None:
+                continue
+
+            for node in (entry.composite_node, entry.slice_node):
+                tag = node.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                       lambda caller, event, idx=idx: self._on_view_modified(idx))
+                self._observations.append((node, tag))
+
+        self.sync_all()
+
+    def _on_view_modified(self, idx):
+        self._dirty.add(idx)
+
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _sync_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        self.sync(sorted(dirty))
+
+    def sync_all(self):
+        self._timer.stop()
+        self._dirty.clear()
+        self.sync(range(len(self.views_normal)))
+
+    def sync(self, indices):
+        """
+        Sets the changed properties of the given top row views in their bottom row counterparts
+        :param indices: Indices into views_normal
+        """
+        pairs = []
+        for idx in indices:
+            entry_normal = self._get_view(self.views_normal[idx])
+            entry_plus = self._get_view(self.views_plus[idx])
+            if entry_normal is not None and entry_plus is not None:
+                pairs.append((entry_normal, entry_plus))
+
+        if not pairs:
+            return
+
+        with MRUSLandmarkingLib.utils_views.view_transaction([self.views_plus[idx] for idx in indices],
+                                                             self.registry):
+            for entry_normal, entry_plus in pairs:
+                composite_normal = entry_normal.composite_node
+                composite_plus = entry_plus.composite_node
+
+                if self.properties["volumes"]:
+                    if composite_plus.GetBackgroundVolumeID() != composite_normal.GetBackgroundVolumeID():
+                        composite_plus.SetBackgroundVolumeID(composite_normal.GetBackgroundVolumeID())
+                    if composite_plus.GetForegroundVolumeID() != composite_normal.GetForegroundVolumeID():
+                        composite_plus.SetForegroundVolumeID(composite_normal.GetForegroundVolumeID())
+
+                if self.properties["opacity"] and \
+                        composite_plus.GetForegroundOpacity() != composite_normal.GetForegroundOpacity():
+                    composite_plus.SetForegroundOpacity(composite_normal.GetForegroundOpacity())
+
+                if self.properties["offset"]:
+                    offset = entry_normal.slice_logic.GetSliceOffset()
+                    if entry_plus.slice_logic.GetSliceOffset() != offset:
+                        entry_plus.slice_logic.SetSliceOffset(offset)
@@ -0,0 +1,351 @@
+import numpy as np
+import qt
+import vtk
+import vtk.util.numpy_support
+import slicer
+
+import MRUSLandmarkingLib.utils_lru
+import MRUSLandmarkingLib.utils_views
+
+
+def reslice_volume(volume, slice_node, interpolate=True):
+    """
+    Reslices a volume at the current pose of a slice view (the same plane that the view displays)
+    :param volume: The scalar volume node
+    :param slice_node: The slice node of the view
+    :param interpolate: Linear (True) or nearest neighbour (False) interpolation
+    return: The resliced vtkImageData in XY (pixel) coordinates of the view or None if the volume is transformed
+            non-linearly
+    """
+    # XY (slice) -> world -> RAS of the volume (if it is transformed) -> IJK
+    ras_to_ijk = vtk.vtkMatrix4x4()
+    volume.GetRASToIJKMatrix(ras_to_ijk)
+
+    reslice_axes = vtk.vtkMatrix4x4()
+    if volume.GetParentTransformNode() is not None:
+        world_to_volume = vtk.vtkMatrix4x4()
+        if not slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(None, volume.GetParentTransformNode(),
+                                                                           world_to_volume):
+            return None
+        vtk.vtkMatrix4x4.Multiply4x4(world_to_volume, slice_node.GetXYToRAS(), reslice_axes)
+        vtk.vtkMatrix4x4.Multiply4x4(ras_to_ijk, reslice_axes, reslice_axes)
+    else:
+        vtk.vtkMatrix4x4.Multiply4x4(ras_to_ijk, slice_node.GetXYToRAS(), reslice_axes)
+
+    dimensions = slice_node.GetDimensions()
+
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(volume.GetImageData())
+    reslice.SetResliceAxes(reslice_axes)
+    reslice.SetOutputExtent(0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, 0)
+    reslice.SetOutputOrigin(0, 0, 0)
+    reslice.SetOutputSpacing(1, 1, 1)
+    if interpolate:
+        reslice.SetInterpolationModeToLinear()
+    else:
+        reslice.SetInterpolationModeToNearestNeighbor()
+    reslice.Update()
+
+    return reslice.GetOutput()
+
+
+def display_colors(display_node, count=256):
+    """
+    Samples the colours that a scalar volume display node maps its window to (the lookup table of its colour node)
+    :param display_node: The scalar volume display node
+    :param count: The number of sampled colours
+    return: A (count, 3) uint8 array of RGB colours from the lower to the upper end of the window
+    """
+    color_node = display_node.GetColorNode()
+    scalars_to_colors = None
+    if color_node is not None:
+        scalars_to_colors = color_node.GetLookupTable() or color_node.GetScalarsToColors()
+
+    if scalars_to_colors is None:
+        return np.repeat(np.linspace(0, 255, count).round().astype(np.uint8)[:, np.newaxis], 3, axis=1)
+
+    # the slice layers stretch the whole range of the lookup table over the window
+    lower, upper = scalars_to_colors.GetRange()
+    values = vtk.util.numpy_support.numpy_to_vtk(np.linspace(lower, upper, count), deep=True)
+    colors = scalars_to_colors.MapScalars(values, vtk.VTK_COLOR_MODE_MAP_SCALARS, -1)
+
+    return vtk.util.numpy_support.vtk_to_numpy(colors).reshape(count, -1)[:, :3].copy()
+
+
+class SliceImageCache:
+    """
+    Optional cache of resliced slices for flicking between the same volume pairs at a fixed slice. The slices are
+    stored window/levelled and mapped through the colour lookup table of the volume as 8-bit RGB images in an LRU cache
+    with a memory budget, keyed by the view, its slice-to-RAS (XY-to-RAS) matrix, the volume and its window/level,
+    threshold and colour node.
+
+    Slicer's slice layers cannot be fed with external images, so a volume switch whose slices are all cached is shown
+    as a blended overlay in the views instead, and the volumes of the views (which makes Slicer reslice them) are only
+    changed once no further switch was shown for settle_ms - flicking back and forth between cached volumes never
+    waits for Slicer's reslice. Anything that needs the real volumes (other volume, opacity or landmark shortcuts,
+    moving a switched slice) calls or triggers apply_pending(), which changes the volumes and removes the overlay. The
+    overlay covers the whole view, so switches are not shown from the cache in views that display anything other than
+    the background and foreground volume (a label volume, segmentations, models such as the intersection outline or
+    landmarks).
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, registry=None, settle_ms=400):
+        """
+        :param max_bytes: The memory budget of the cached slices
+        :param registry: An optional ViewRegistry used to look up the views
+        :param settle_ms: The time without further switches after which the volumes of the views are changed
+        """
+        self.enabled = False
+        self.registry = registry
+
+        self.cache = MRUSLandmarkingLib.utils_lru.LRUCache(max_bytes)
+
+        self._overlays = {}  # view name -> (renderer, actor)
+        self._pending_apply = None
+        self._pending_views = None
+        self.pending_volumes = None  # (background ID, foreground ID) of the switch that is shown but not applied yet
+        self._slice_observations = []  # (slice node, observer tag) of the views with a pending switch
+
+        self._timer = qt.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(settle_ms)
+        self._timer.connect('timeout()', self.apply_pending)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.apply_pending()
+        self.enabled = False
+        self.cache.clear()
+
+    def _get_view(self, view_name):
+        if self.registry is not None:
+            return self.registry.get(view_name)
+
+        return MRUSLandmarkingLib.utils_views.resolve_view(view_name)
+
+    @staticmethod
+    def _display_key(volume):
+        display_node = volume.GetDisplayNode()
+        if display_node is None:
+            return None
+
+        color_node = display_node.GetColorNode()
+
+        return (round(display_node.GetWindow(), 3), round(display_node.GetLevel(), 3),
+                bool(display_node.GetApplyThreshold()), round(display_node.GetLowerThreshold(), 3),
+                round(display_node.GetUpperThreshold(), 3), bool(display_node.GetInterpolate()),
+                display_node.GetColorNodeID(), color_node.GetMTime() if color_node is not None else None)
+
+    def get_key(self, view_name, slice_node, volume):
+        """
+        return: The cache key of a volume in a view at its current pose or None if the volume is not displayable
+        """
+        display_key = self._display_key(volume)
+        if display_key is None or volume.GetImageData() is None:
+            return None
+
+        xy_to_ras = slice_node.GetXYToRAS()
+
+        return (view_name, tuple(round(xy_to_ras.GetElement(i, j), 4) for i in range(4) for j in range(4)),
+                tuple(slice_node.GetDimensions()), volume.GetID(), display_key, volume.GetImageData().GetMTime())
+
+    def get_slice(self, view_name, volume_id, reslice=True):
+        """
+        Returns the cached slice of a volume in a view (reslices and caches it if reslice is True)
+        return: A (colours, opacity) tuple of a uint8 (y, x, 3) and a bool (y, x) array or None
+        """
+        entry = self._get_view(view_name)
+        volume = slicer.mrmlScene.GetNodeByID(volume_id) if volume_id else None
+        if entry is None or volume is None:
+            return None
+
+        key = self.get_key(view_name, entry.slice_node, volume)
+        if key is None:
+            return None
+
+        cached = self.cache.get(key)
+        if cached is not None or not reslice:
+            return cached
+
+        display_node = volume.GetDisplayNode()
+        image = reslice_volume(volume, entry.slice_node, display_node.GetInterpolate())
+        if image is None or image.GetPointData().GetScalars() is None:
+            return None
+
+        values = vtk.util.numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+        if values.ndim > 1:  # only the first component is shown for multi-component volumes
+            values = values[:, 0]
+        values = values.reshape(image.GetDimensions()[1], image.GetDimensions()[0]).astype(np.float32)
+
+        window = max(display_node.GetWindow(), 1e-6)
+        lower = display_node.GetLevel() - window / 2
+        colors = display_colors(display_node)
+        rgb = colors[np.clip((values - lower) / window * (len(colors) - 1), 0, len(colors) - 1).astype(np.intp)]
+
+        if display_node.GetApplyThreshold():
+            opacity = (values >= display_node.GetLowerThreshold()) & (values <= display_node.GetUpperThreshold())
+        else:
+            opacity = np.ones(values.shape, dtype=bool)
+
+        cached = (rgb, opacity)
+        self.cache.put(key, cached, rgb.nbytes + opacity.nbytes)
+
+        return cached
+
+    def blend(self, view_name, background_id, foreground_id, foreground_opacity, reslice=False):
+        """
+        Blends the cached slices of a background and a foreground volume like the slice view does
+        return: An RGB uint8 (y, x, 3) array or None if a slice is not cached (and reslice is False)
+        """
+        background = self.get_slice(view_name, background_id, reslice)
+        foreground = self.get_slice(view_name, foreground_id, reslice)
+        if background is None or foreground is None or background[0].shape != foreground[0].shape:
+            return None
+
+        background_rgb = np.where(background[1][:, :, np.newaxis], background[0], 0).astype(np.float32)
+        alpha = (foreground[1] * float(foreground_opacity))[:, :, np.newaxis]
+
+        return (background_rgb * (1 - alpha) + foreground[0] * alpha).astype(np.uint8)
+
+    @staticmethod
+    def _shows_other_layers(entry):
+        """
+        return: True if a view displays anything that the overlay of a switch would hide
+        """
+        composite_node = entry.composite_node
+        if composite_node.GetLabelVolumeID() and composite_node.GetLabelOpacity() > 0:
+            return True
+
+        view_node_id = entry.slice_node.GetID()
+        for class_name in ("vtkMRMLSegmentationDisplayNode", "vtkMRMLModelDisplayNode", "vtkMRMLMarkupsDisplayNode"):
+            for display_node in slicer.util.getNodesByClass(class_name):
+                if not (display_node.GetVisibility() and display_node.GetVisibility2D()
+                        and display_node.IsDisplayableInView(view_node_id)):
+                    continue
+
+                node = display_node.GetDisplayableNode()
+                if node is None:
+                    continue
+                if node.IsA("vtkMRMLModelNode"):
+                    if node.GetPolyData() is not None and node.GetPolyData().GetNumberOfPoints() > 0:
+                        return True
+                elif node.IsA("vtkMRMLMarkupsNode"):
+                    if node.GetNumberOfControlPoints() > 0:
+                        return True
+                else:
+                    return True
+
+        return False
+
+    def show_switch(self, view_names, background_id, foreground_id, apply_function):
+        """
+        Shows a volume switch from the cached slices and defers the actual switch until the switching settled (unless
+        a view shows other layers than the volumes, see _shows_other_layers()). A pending switch of the same views is
+        replaced (apply_function has to set the volumes, not change them relative
+        to the displayed ones).
+        :param view_names: The views that are switched
+        :param background_id: The new background volume
+        :param foreground_id: The new foreground volume
+        :param apply_function: Switches the volumes of the views (called without arguments)
+        return: False if a slice is not cached - apply_function was called right away then
+        """
+        if self._pending_views != tuple(view_names):
+            self.apply_pending()
+
+        images = {}
+        if self.enabled:
+            for view_name in view_names:
+                entry = self._get_view(view_name)
+                if entry is None:
+                    continue
+
+                if self._shows_other_layers(entry):
+                    images[view_name] = None
+                    break
+
+                images[view_name] = self.blend(view_name, background_id, foreground_id,
+                                               entry.composite_node.GetForegroundOpacity())
+                if images[view_name] is None:
+                    break
+
+        if not images or any(image is None for image in images.values()):
+            self.apply_pending()
+            apply_function()
+            return False
+
+        for view_name, image in images.items():
+            self._show_overlay(view_name, image)
+
+        if self._pending_apply is None:
+            self._observe_slices(view_names)
+
+        self._pending_apply = apply_function
+        self._pending_views = tuple(view_names)
+        self.pending_volumes = (background_id, foreground_id)
+        self._timer.start()  # restarts the settle time
+
+        return True
+
+    def apply_pending(self, *args):
+        """
+        Applies a deferred volume switch and removes the overlays
+        """
+        self._timer.stop()
+        self._remove_slice_observers()
+
+        apply_function, self._pending_apply = self._pending_apply, None
+        self._pending_views = None
+        self.pending_volumes = None
+        if apply_function is not None:
+            apply_function()
+
+        self._hide_overlays()
+
+    def _observe_slices(self, view_names):
+        # the overlay only matches the slice it was blended for
+        for view_name in view_names:
+            entry = self._get_view(view_name)
+            if entry is not None:
+                self._slice_observations.append(
+                    (entry.slice_node, entry.slice_node.AddObserver(vtk.vtkCommand.ModifiedEvent, self.apply_pending)))
+
+    def _remove_slice_observers(self):
+        for node, tag in self._slice_observations:
+            node.RemoveObserver(tag)
+        self._slice_observations = []
+
+    def _show_overlay(self, view_name, image):
+        vtk_image = vtk.vtkImageData()
+        vtk_image.SetDimensions(image.shape[1], image.shape[0], 1)
+        vtk_image.GetPointData().SetScalars(
+            vtk.util.numpy_support.numpy_to_vtk(image.reshape(-1, 3), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+
+        entry = self._get_view(view_name)
+        renderer = entry.slice_view.renderWindow().GetRenderers().GetFirstRenderer()
+
+        if view_name not in self._overlays:
+            mapper = vtk.vtkImageMapper()
+            mapper.SetColorWindow(255)
+            mapper.SetColorLevel(127.5)
+
+            actor = vtk.vtkActor2D()
+            actor.SetMapper(mapper)
+            self._overlays[view_name] = (renderer, actor)
+
+        overlay_renderer, actor = self._overlays[view_name]
+        if overlay_renderer is not renderer:  # the layout changed
+            overlay_renderer.RemoveActor2D(actor)
+            self._overlays[view_name] = (renderer, actor)
+
+        actor.GetMapper().SetInputData(vtk_image)
+        renderer.AddActor2D(actor)
+
+        entry.slice_view.forceRender()
+
+    def _hide_overlays(self):
+        for renderer, actor in self._overlays.values():
+            renderer.RemoveActor2D(actor)
+
+        self._overlays = {}
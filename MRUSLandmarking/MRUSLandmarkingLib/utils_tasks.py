@@ -0,0 +1,146 @@
+import queue
+import threading
+from concurrent.futures import CancelledError
+
+import qt
+
+
+class BackgroundTask:
+    """
+    Runs a function in a worker thread. Progress, the result, errors and cancellation are passed through a queue that is
+    polled by a QTimer, so all callbacks are executed on the Qt main thread (where it is safe to modify the scene).
+    The function is called as function(progress_callback, cancel_event) and must not access the MRML scene.
+    """
+
+    def __init__(self, function, on_progress=None, on_done=None, on_error=None, on_cancelled=None,
+                 poll_interval_ms=50):
+        """
+        :param function: The function to run in the worker thread
+        :param on_progress: Called with (finished steps, all steps) whenever the function reports progress
+        :param on_done: Called with the return value of the function
+        :param on_error: Called with the exception raised by the function
+        :param on_cancelled: Called without arguments when the task was cancelled
+        :param poll_interval_ms: How often the main thread checks for messages from the worker
+        """
+        self.function = function
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancelled = on_cancelled
+
+        self.cancel_event = threading.Event()
+
+        self._messages = queue.Queue()
+        self._thread = None
+        self._running = False
+
+        self._timer = qt.QTimer()
+        self._timer.setInterval(poll_interval_ms)
+        self._timer.connect('timeout()', self._poll)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._timer.start()
+
+    def cancel(self):
+        """
+        Asks the function to stop - on_cancelled is called once the worker has actually stopped
+        """
+        self.cancel_event.set()
+
+    def is_running(self):
+        return self._running
+
+    def _report_progress(self, done, total):
+        self._messages.put(("progress", (done, total)))
+
+    def _run(self):
+        try:
+            result = self.function(self._report_progress, self.cancel_event)
+            self._messages.put(("done", result))
+        except CancelledError:
+            self._messages.put(("cancelled", None))
+        except Exception as e:
+            self._messages.put(("error", e))
+
+    def _poll(self):
+        while True:
+            try:
+                message, value = self._messages.get_nowait()
+            except queue.Empty:
+                return
+
+            if message == "progress":
+                if self.on_progress is not None:
+                    self.on_progress(*value)
+                continue
+
+            # all other messages end the task
+            self._timer.stop()
+            self._running = False
+
+            # a result that arrives after cancelling is discarded
+            if message == "done" and self.cancel_event.is_set():
+                message = "cancelled"
+
+            if message == "done" and self.on_done is not None:
+                self.on_done(value)
+            elif message == "error" and self.on_error is not None:
+                self.on_error(value)
+            elif message == "cancelled" and self.on_cancelled is not None:
+                self.on_cancelled()
+
+            return
+
+
+class FrameAccumulator:
+    """
+    Coalesces repeated changes (e.g. of a shortcut that is auto-repeated while its key is held) into at most one update
+    per display frame. The first change is applied right away, the changes that arrive within the next frame are summed
+    up and applied together when the frame ends, so the updates never fall behind the key events.
+    """
+
+    def __init__(self, apply_function, interval_ms=16):
+        """
+        :param apply_function: Called with the summed up change
+        :param interval_ms: The minimal time between two updates (16 ms is one frame at 60 Hz)
+        """
+        self.apply_function = apply_function
+
+        self._pending = 0
+
+        self._timer = qt.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval_ms)
+        self._timer.connect('timeout()', self._apply_pending)
+
+    def add(self, change):
+        self._pending += change
+
+        if not self._timer.isActive():
+            self._apply_pending()
+
+    def flush(self):
+        """
+        Applies the pending change right away
+        """
+        self._timer.stop()
+        self._apply_pending()
+
+    def cancel(self):
+        """
+        Discards the pending change
+        """
+        self._timer.stop()
+        self._pending = 0
+
+    def _apply_pending(self):
+        if not self._pending:
+            return
+
+        change, self._pending = self._pending, 0
+
+        self._timer.start()  # no further update within this frame
+        self.apply_function(change)
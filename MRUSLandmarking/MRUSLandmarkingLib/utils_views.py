@@ -1,5 +1,138 @@
+import collections
+import contextlib
+
+import vtk
 import slicer
 
+SliceViewEntry = collections.namedtuple("SliceViewEntry",
+                                        ["slice_widget", "slice_logic", "composite_node", "slice_node", "slice_view"])
+
+
+def resolve_view(view_name):
+    """
+    Looks up the objects of a slice view in the layout manager
+    return: A SliceViewEntry or None if the view does not exist in the current layout
+    """
+    slice_widget = slicer.app.layoutManager().sliceWidget(view_name)
+    if slice_widget is None:
+        return None
+
+    slice_logic = slice_widget.sliceLogic()
+
+    return SliceViewEntry(slice_widget, slice_logic, slice_logic.GetSliceCompositeNode(), slice_widget.mrmlSliceNode(),
+                          slice_widget.sliceView())
+
+
+class ViewRegistry:
+    """
+    Caches the SliceViewEntry of every slice view that was asked for, so the shortcuts do not have to look up the slice
+    widget, logic and nodes in the layout manager on every key press. The cache is cleared when the layout changes,
+    when slice (composite) nodes are removed and when the scene is closed or imported.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+        slicer.app.layoutManager().connect('layoutChanged(int)', self.invalidate)
+
+        self._observations = [
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self._on_node_removed),
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.invalidate),
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndImportEvent, self.invalidate)]
+
+    def cleanup(self):
+        slicer.app.layoutManager().disconnect('layoutChanged(int)', self.invalidate)
+
+        for tag in self._observations:
+            slicer.mrmlScene.RemoveObserver(tag)
+        self._observations = []
+
+        self.invalidate()
+
+    def invalidate(self, *args):
+        self._entries = {}
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def _on_node_removed(self, caller, event, node):
+        if node is not None and (node.IsA("vtkMRMLSliceNode") or node.IsA("vtkMRMLSliceCompositeNode")):
+            self.invalidate()
+
+    def get(self, view_name):
+        """
+        return: The SliceViewEntry of a view or None if the view does not exist in the current layout
+        """
+        entry = self._entries.get(view_name)
+
+        if entry is None:
+            entry = resolve_view(view_name)
+            if entry is not None:
+                self._entries[view_name] = entry
+
+        return entry
+
+    def composite_node(self, view_name):
+        return self.get(view_name).composite_node
+
+    def slice_node(self, view_name):
+        return self.get(view_name).slice_node
+
+    def slice_logic(self, view_name):
+        return self.get(view_name).slice_logic
+
+
+@contextlib.contextmanager
+def view_transaction(view_names, registry=None):
+    """
+    Batches changes of slice views: the composite and slice nodes of the views are modified in one StartModify/EndModify
+    block (so observers are notified once per node) and rendering of all slice views of the layout is paused until the
+    block ends, after which the changed views are rendered once. All views are paused, as views linked to the changed
+    ones (e.g. by the view group) are changed as well.
+    :param view_names: The names of the slice views (e.g. widget.views_normal)
+    :param registry: An optional ViewRegistry used to look up the views
+    return (as the context value): A list of (view name, composite node, slice node) tuples of the given existing views
+    """
+    views = []
+    modified_nodes = []
+    slice_views = []
+    changed_views = []
+
+    def get_entry(view_name):
+        return registry.get(view_name) if registry is not None else resolve_view(view_name)
+
+    try:
+        for view_name in view_names:
+            entry = get_entry(view_name)
+            if entry is None:
+                continue
+
+            views.append((view_name, entry.composite_node, entry.slice_node))
+            changed_views.append(entry.slice_view)
+
+            for node in (entry.composite_node, entry.slice_node):
+                modified_nodes.append((node, node.StartModify()))
+
+        for view_name in slicer.app.layoutManager().sliceViewNames():
+            entry = get_entry(view_name)
+            if entry is None or entry.slice_view in slice_views:
+                continue
+
+            if hasattr(entry.slice_view, "pauseRender"):  # older Slicer versions cannot pause rendering
+                entry.slice_view.pauseRender()
+            slice_views.append(entry.slice_view)
+
+        yield views
+
+    finally:
+        for node, was_modifying in reversed(modified_nodes):
+            node.EndModify(was_modifying)
+
+        # the other views resume with the render they requested while they were paused, if any
+        for slice_view in slice_views:
+            if hasattr(slice_view, "resumeRender"):
+                slice_view.resumeRender()
+            if slice_view in changed_views:
+                slice_view.scheduleRender()
+
 
 def change_view(widget, direction='forward'):
     """
@@ -21,34 +154,69 @@ def change_view(widget, direction='forward'):
 
         # get the next volumes
         if direction == 'forward':
-            update_circle_node(widget, "forward")  # updates current node to background
+            update_ring_position(widget, "forward")  # the current volume is the background
 
-            volume_foreground = slicer.mrmlScene.GetNodeByID(widget.nodes_circle.get_current_node())
-            volume_background = slicer.mrmlScene.GetNodeByID(widget.nodes_circle.get_next_node())
+            volume_foreground = slicer.mrmlScene.GetNodeByID(widget.volume_ring.get_current_id())
+            volume_background = slicer.mrmlScene.GetNodeByID(widget.volume_ring.get_next_id())
         else:
-            update_circle_node(widget, "backward")  # updates current node to foreground
+            update_ring_position(widget, "backward")  # the current volume is the foreground
 
-            volume_background = slicer.mrmlScene.GetNodeByID(widget.nodes_circle.get_current_node())
-            volume_foreground = slicer.mrmlScene.GetNodeByID(widget.nodes_circle.get_previous_node())
+            volume_background = slicer.mrmlScene.GetNodeByID(widget.volume_ring.get_current_id())
+            volume_foreground = slicer.mrmlScene.GetNodeByID(widget.volume_ring.get_previous_id())
+
+        if not (volume_foreground and volume_background):
+            raise Exception("No volumes to set for foreground and background")
 
         # set the next volumes in all the views
-        for view in current_views:
-            layoutManager = slicer.app.layoutManager()
-            view_logic = layoutManager.sliceWidget(view)
-            view_logic = view_logic.sliceLogic()
-            widget.compositeNode = view_logic.GetSliceCompositeNode()
-
-            # update volumes (if they both exist)
-            if volume_foreground and volume_background:
-                widget.compositeNode.SetBackgroundVolumeID(volume_background.GetID())
-                widget.compositeNode.SetForegroundVolumeID(volume_foreground.GetID())
-            else:
-                raise Exception("No volumes to set for foreground and background")
+        def switch_volumes():
+            with view_transaction(current_views, widget.view_registry) as views:
+                for _, widget.compositeNode, _ in views:
+                    widget.compositeNode.SetBackgroundVolumeID(volume_background.GetID())
+                    widget.compositeNode.SetForegroundVolumeID(volume_foreground.GetID())
+
+        # with the slice cache enabled, cached slices are shown right away and the volumes are switched once the
+        # switching settled
+        widget.slice_cache.show_switch(current_views, volume_background.GetID(), volume_foreground.GetID(),
+                                       switch_volumes)
+
+        prefetch_neighbour_volumes(widget, volume_background.GetID(), volume_foreground.GetID(), current_views)
 
     except Exception as e:
         slicer.util.errorDisplay("Could not change view.\n" + str(e))
 
 
+def show_background_volume(widget, volume_id):
+    """
+    Shows a volume as the background of the current views and its predecessor in the volume ring as the foreground
+    (the same pair that switching through the volumes displays)
+    :param volume_id: The ID of the background volume
+    """
+    if not widget.volume_ring.seek(volume_id):
+        raise Exception("The volume is not one of the chosen volumes")
+
+    foreground_id = widget.volume_ring.peek(-1)
+    current_views = get_current_views(widget)
+
+    with view_transaction(current_views, widget.view_registry) as views:
+        for _, widget.compositeNode, _ in views:
+            widget.compositeNode.SetBackgroundVolumeID(volume_id)
+            widget.compositeNode.SetForegroundVolumeID(foreground_id)
+
+    prefetch_neighbour_volumes(widget, volume_id, foreground_id, current_views)
+
+
+def prefetch_neighbour_volumes(widget, background_id, foreground_id, view_names):
+    """
+    Caches the slices of the volumes that the next switch in either direction displays: the one after the background
+    (forward) and the one before the foreground (backward), and of the displayed volumes, for switching back. Does
+    nothing while the slice cache is disabled.
+    """
+    neighbour_ids = [widget.volume_ring.peek(1, background_id), widget.volume_ring.peek(-1, foreground_id),
+                     background_id, foreground_id]
+
+    widget.volume_prefetcher.schedule(neighbour_ids, view_names)
+
+
 def active_rows_update(widget):
     if widget.topRowActive and not widget.bottomRowActive:
         group_normal = 0
@@ -68,9 +236,9 @@ def active_rows_update(widget):
         widget.ui.bottomRowCheck.checked = True
 
     # set groups
-    for i in range(3):
-        slicer.app.layoutManager().sliceWidget(widget.views_normal[i]).mrmlSliceNode().SetViewGroup(group_normal)
-        slicer.app.layoutManager().sliceWidget(widget.views_plus[i]).mrmlSliceNode().SetViewGroup(group_plus)
+    with view_transaction(widget.views_normal + widget.views_plus, widget.view_registry) as views:
+        for view_name, _, slice_node in views:
+            slice_node.SetViewGroup(group_normal if view_name in widget.views_normal else group_plus)
 
 
 def get_current_views(widget):
@@ -107,56 +275,59 @@ def initialise_views(widget):
 
     update = False
 
-    layout_manager = slicer.app.layoutManager()
-
-    for view in current_views:
+    with view_transaction(current_views, widget.view_registry) as views:
+        for _, widget.compositeNode, _ in views:
 
-        view_logic = layout_manager.sliceWidget(view).sliceLogic()
-        widget.compositeNode = view_logic.GetSliceCompositeNode()
+            current_background_id = widget.compositeNode.GetBackgroundVolumeID()
+            current_foreground_id = widget.compositeNode.GetForegroundVolumeID()
 
-        current_background_id = widget.compositeNode.GetBackgroundVolumeID()
-        current_foreground_id = widget.compositeNode.GetForegroundVolumeID()
+            if current_background_id not in widget.volumes_ids and current_foreground_id not in widget.volumes_ids:
+                update = True
 
-        if current_background_id not in widget.volumes_ids and current_foreground_id not in widget.volumes_ids:
-            update = True
+            if update is True:
+                widget.compositeNode.SetBackgroundVolumeID(widget.volumes_ids[1])
+                widget.compositeNode.SetForegroundVolumeID(widget.volumes_ids[0])
 
-        if update is True:
-            widget.compositeNode.SetBackgroundVolumeID(widget.volumes_ids[1])
-            widget.compositeNode.SetForegroundVolumeID(widget.volumes_ids[0])
 
-
-def update_circle_node(widget, direction):
-
-    if widget.nodes_circle is None:
+def update_ring_position(widget, direction):
+    """
+    Moves the volume ring to the displayed background (forward) or foreground (backward) volume. If that volume is not
+    one of the chosen volumes, the ring keeps its position. A switch that is only shown from cached slices counts as
+    displayed.
+    """
+    if len(widget.volume_ring) == 0:
         raise Exception("Pick a volume first - or re-pick any existing one")
 
+    if widget.slice_cache.pending_volumes is not None:
+        background_id, foreground_id = widget.slice_cache.pending_volumes
+    else:
+        background_id = widget.compositeNode.GetBackgroundVolumeID()
+        foreground_id = widget.compositeNode.GetForegroundVolumeID()
+
     if direction == "forward":
-        while widget.nodes_circle.current_volume_node.volume_id != widget.compositeNode.GetBackgroundVolumeID():
-            widget.nodes_circle.get_next_node()
+        widget.volume_ring.seek(background_id)
 
     elif direction == "backward":
-        while widget.nodes_circle.current_volume_node.volume_id != widget.compositeNode.GetForegroundVolumeID():
-            widget.nodes_circle.get_next_node()
+        widget.volume_ring.seek(foreground_id)
 
 
 def change_foreground_opacity_discrete(widget, new_opacity=0.5):
     """
     (This function is used as a shortcut)
-    Changes the foreground opacity to a given value.
+    Changes the foreground opacity to a given value (discarding 'q'/'w' changes that were not applied yet, so that they
+    do not overwrite it).
     :param new_opacity: The new foreground opacity
     """
     try:
-        layoutManager = slicer.app.layoutManager()
+        widget.opacity_accumulator.cancel()
+        widget.slice_cache.apply_pending()
 
         current_views = get_current_views(widget)
 
         # iterate through all views and set opacity to
-        for sliceViewName in current_views:
-            view = layoutManager.sliceWidget(sliceViewName).sliceView()
-            sliceNode = view.mrmlSliceNode()
-            sliceLogic = slicer.app.applicationLogic().GetSliceLogic(sliceNode)
-            compositeNode = sliceLogic.GetSliceCompositeNode()
-            compositeNode.SetForegroundOpacity(new_opacity)
+        with view_transaction(current_views, widget.view_registry) as views:
+            for _, compositeNode, _ in views:
+                compositeNode.SetForegroundOpacity(new_opacity)
 
     except Exception as e:
         slicer.util.errorDisplay("Could not change foreground opacity discretely.\n" + str(e))
@@ -165,21 +336,28 @@ def change_foreground_opacity_discrete(widget, new_opacity=0.5):
 def change_foreground_opacity_continuous(widget, opacity_change=0.01):
     """
     (This function is used as a shortcut)
-    Increases or decreases the foreground opacity by a given value
+    Increases or decreases the foreground opacity by a given value. The changes of an auto-repeated key are collected
+    by widget.opacity_accumulator and applied at most once per frame.
+    :param opacity_change: The change in foreground opacity
+    """
+    widget.opacity_accumulator.add(opacity_change)
+
+
+def apply_foreground_opacity_change(widget, opacity_change):
+    """
+    Changes the foreground opacity of the current views by a given value (the opacity stays within [0, 1])
     :param opacity_change: The change in foreground opacity
     """
     try:
-        layoutManager = slicer.app.layoutManager()
+        widget.slice_cache.apply_pending()
 
         current_views = get_current_views(widget)
 
-        # iterate through all views and set opacity to
-        for sliceViewName in current_views:
-            view = layoutManager.sliceWidget(sliceViewName).sliceView()
-            sliceNode = view.mrmlSliceNode()
-            sliceLogic = slicer.app.applicationLogic().GetSliceLogic(sliceNode)
-            compositeNode = sliceLogic.GetSliceCompositeNode()
-            compositeNode.SetForegroundOpacity(compositeNode.GetForegroundOpacity() + opacity_change)
+        # iterate through all views and change their opacity
+        with view_transaction(current_views, widget.view_registry) as views:
+            for _, compositeNode, _ in views:
+                compositeNode.SetForegroundOpacity(
+                    min(max(compositeNode.GetForegroundOpacity() + opacity_change, 0.0), 1.0))
 
     except Exception as e:
         slicer.util.errorDisplay("Could not change foreground opacity continuously.\n" + str(e))
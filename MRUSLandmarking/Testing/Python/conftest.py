@@ -0,0 +1,5 @@
+import os
+import sys
+
+# MRUSLandmarkingLib is imported from the module directory, like Slicer does
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
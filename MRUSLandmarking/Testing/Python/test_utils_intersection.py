@@ -0,0 +1,191 @@
+import threading
+from concurrent.futures import CancelledError
+
+import numpy as np
+import pytest
+
+from MRUSLandmarkingLib.utils_intersection import (CoverageAccumulator, crop_bounds, crop_to_mask, downsample_grid,
+                                                   intersection_mask, oriented_box, oriented_boxes_overlap,
+                                                   refine_mask, threshold_mask)
+from MRUSLandmarkingLib.utils_masks import PackedMask
+
+
+def rotation(angle_z, angle_x=0.0):
+    cz, sz, cx, sx = np.cos(angle_z), np.sin(angle_z), np.cos(angle_x), np.sin(angle_x)
+
+    return np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]) @ np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+
+
+def ijk_to_ras(spacing, rotation_matrix=np.eye(3), origin=(0, 0, 0)):
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation_matrix * np.asarray(spacing, dtype=float)
+    matrix[:3, 3] = origin
+
+    return matrix
+
+
+def ball_volume(shape, matrix, centre, radius):
+    """
+    A volume with a ball of intensity 100 (the 'FOV') and zeros around it
+    """
+    k, j, i = np.indices(shape)
+    ras = np.tensordot(matrix[:3, :3], np.stack([i, j, k]), axes=1) + matrix[:3, 3].reshape(3, 1, 1, 1)
+    inside = np.linalg.norm(ras - np.reshape(centre, (3, 1, 1, 1)), axis=0) <= radius
+
+    return np.where(inside, 100, 0).astype(np.uint8)
+
+
+@pytest.fixture
+def volumes():
+    matrix_a = ijk_to_ras((1.0, 1.0, 1.2), origin=(-12, -12, -14))
+    matrix_b = ijk_to_ras((0.9, 1.1, 1.0), rotation(0.3, 0.2), origin=(-10, -14, -10))
+    matrix_c = ijk_to_ras((1.3, 1.3, 1.3), rotation(-0.5), origin=(-8, -18, -16))
+
+    return [(ball_volume((24, 26, 25), matrix_a, (0, 0, 0), 11), matrix_a),
+            (ball_volume((27, 25, 28), matrix_b, (3, 1, -1), 10), matrix_b),
+            (ball_volume((22, 24, 26), matrix_c, (-1, -2, 1), 12), matrix_c)]
+
+
+@pytest.fixture
+def grid():
+    return (30, 28, 29), ijk_to_ras((0.8, 0.9, 1.0), rotation(0.1), origin=(-13, -13, -15))
+
+
+def reference_intersection(volumes, grid_shape, grid_ijk_to_ras, threshold_range=(1, 255)):
+    """
+    The intersection sampled voxel by voxel on the whole grid at once (no chunks, no packing)
+    """
+    k, j, i = np.indices(grid_shape)
+    grid_ijk = np.stack([i.ravel(), j.ravel(), k.ravel(), np.ones(i.size)])
+
+    result = np.ones(i.size, dtype=bool)
+    for array, array_ijk_to_ras in volumes:
+        ai, aj, ak = np.rint((np.linalg.inv(array_ijk_to_ras) @ grid_ijk_to_ras @ grid_ijk)[:3]).astype(np.intp)
+        inside = (ai >= 0) & (ai < array.shape[2]) & (aj >= 0) & (aj < array.shape[1]) & (ak >= 0) & \
+                 (ak < array.shape[0])
+
+        values = np.zeros(i.size, dtype=array.dtype)
+        values[inside] = array[ak[inside], aj[inside], ai[inside]]
+        result &= inside & threshold_mask(values, threshold_range)
+
+    return result.reshape(grid_shape)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 100])
+def test_chunked_intersection_matches_reference(volumes, grid, chunk_size):
+    grid_shape, grid_ijk_to_ras = grid
+    expected = reference_intersection(volumes, grid_shape, grid_ijk_to_ras)
+
+    mask = intersection_mask(volumes, grid_shape, grid_ijk_to_ras, chunk_size=chunk_size)
+
+    assert expected.any() and not expected.all()
+    np.testing.assert_array_equal(mask.to_array(), expected)
+
+
+def test_intersection_on_own_grid(volumes):
+    array, matrix = volumes[0]
+
+    mask = intersection_mask([(array, matrix)], array.shape, matrix, threshold_range=(50, 150), chunk_size=5)
+
+    np.testing.assert_array_equal(mask.to_array(), (array >= 50) & (array <= 150))
+
+
+def test_intersection_progress_and_cancel(volumes, grid):
+    progress = []
+    intersection_mask(volumes, *grid, progress_callback=lambda done, total: progress.append((done, total)))
+
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(CancelledError):
+        intersection_mask(volumes, *grid, cancel_event=cancel_event)
+
+
+@pytest.mark.parametrize("factor", [2, 3, 4])
+def test_refine_mask_matches_full_resolution(volumes, grid, factor):
+    grid_shape, grid_ijk_to_ras = grid
+    coarse_shape, coarse_ijk_to_ras = downsample_grid(grid_shape, grid_ijk_to_ras, factor)
+    coarse = intersection_mask(volumes, coarse_shape, coarse_ijk_to_ras)
+
+    mask = refine_mask(coarse, factor, volumes, grid_shape, grid_ijk_to_ras)
+
+    np.testing.assert_array_equal(mask.to_array(), reference_intersection(volumes, grid_shape, grid_ijk_to_ras))
+
+
+def test_refine_mask_of_empty_coarse_mask(volumes, grid):
+    grid_shape, grid_ijk_to_ras = grid
+    coarse_shape, _ = downsample_grid(grid_shape, grid_ijk_to_ras)
+
+    assert not refine_mask(PackedMask.full(coarse_shape), 4, volumes, grid_shape, grid_ijk_to_ras).any()
+
+
+def test_crop_to_mask():
+    array = np.zeros((10, 12, 14), dtype=bool)
+    array[3:6, 2:9, 5:7] = True
+    array[7, 4, 11] = True
+    matrix = ijk_to_ras((0.5, 0.7, 1.1), rotation(0.4), origin=(3, -2, 8))
+
+    cropped, cropped_ijk_to_ras = crop_to_mask(PackedMask.from_array(array), matrix)
+
+    np.testing.assert_array_equal(cropped.to_array(), array[3:8, 2:9, 5:12])
+    # voxel (i, j, k) of the crop is voxel (i + 5, j + 2, k + 3) of the mask
+    np.testing.assert_allclose(cropped_ijk_to_ras @ [1, 2, 3, 1], matrix @ [6, 4, 6, 1])
+
+    assert crop_to_mask(PackedMask.full(array.shape), matrix) == (None, None)
+
+
+def box(centre, rotation_matrix, half_extents):
+    return np.asarray(centre, dtype=float), rotation_matrix.T, np.asarray(half_extents, dtype=float)
+
+
+def test_oriented_box():
+    matrix = ijk_to_ras((2.0, 1.0, 0.5), rotation(0.7), origin=(1, 2, 3))
+
+    centre, axes, half_extents = oriented_box((4, 6, 8), matrix)
+
+    np.testing.assert_allclose(centre, (matrix @ [3.5, 2.5, 1.5, 1])[:3])
+    np.testing.assert_allclose(axes, rotation(0.7).T, atol=1e-12)
+    np.testing.assert_allclose(half_extents, [8.0, 3.0, 1.0])
+
+
+def test_oriented_boxes_overlap():
+    unit = box((0, 0, 0), np.eye(3), (1, 1, 1))
+
+    assert oriented_boxes_overlap(unit, unit)
+    assert oriented_boxes_overlap(unit, box((1.5, 0, 0), np.eye(3), (1, 1, 1)))
+    assert oriented_boxes_overlap(unit, box((2, 0, 0), np.eye(3), (1, 1, 1)))  # touching faces
+    assert not oriented_boxes_overlap(unit, box((2.1, 0, 0), np.eye(3), (1, 1, 1)))
+    assert oriented_boxes_overlap(box((0, 0, 0), np.eye(3), (5, 5, 5)), box((1, 1, 1), rotation(0.4, 0.3), (1, 2, 1)))
+
+    # the axis-aligned bounding boxes of these overlap, but the rotated box lies beyond the corner of the unit cube
+    rotated = box((2.3, 2.3, 0), rotation(np.pi / 4), (1, 1, 1))
+    assert not oriented_boxes_overlap(unit, rotated)
+    assert not oriented_boxes_overlap(rotated, unit)
+    assert oriented_boxes_overlap(unit, box((1.6, 1.6, 0), rotation(np.pi / 4), (1, 1, 1)))
+
+
+@pytest.mark.parametrize("min_boxes", [1, 2, 3])
+def test_crop_bounds_contain_the_covered_voxels(volumes, min_boxes):
+    grid_shape, grid_ijk_to_ras = volumes[0][0].shape, volumes[0][1]
+    boxes = [(array.shape, matrix) for array, matrix in volumes]
+
+    coverage = CoverageAccumulator(grid_shape, grid_ijk_to_ras)
+    for idx, (array, matrix) in enumerate(volumes):
+        coverage.add(idx, array, matrix)
+    covered = coverage.at_least(min_boxes).bounding_box()
+
+    bounds = crop_bounds(grid_shape, grid_ijk_to_ras, boxes, min_boxes)
+
+    assert all(b.start <= c.start and c.stop <= b.stop for b, c in zip(bounds, covered))
+    if min_boxes == len(boxes):
+        assert bounds == crop_bounds(grid_shape, grid_ijk_to_ras, boxes)
+
+
+def test_crop_bounds_of_partly_overlapping_boxes():
+    grid_shape, grid_ijk_to_ras = (10, 10, 40), np.eye(4)
+    boxes = [((10, 10, 10), ijk_to_ras((1, 1, 1), origin=(offset, 0, 0))) for offset in (0, 8, 30)]
+
+    assert crop_bounds(grid_shape, grid_ijk_to_ras, boxes) is None
+    assert crop_bounds(grid_shape, grid_ijk_to_ras, boxes, 2) == (slice(0, 10), slice(0, 10), slice(8, 10))
+    assert crop_bounds(grid_shape, grid_ijk_to_ras, boxes, 1) == (slice(0, 10), slice(0, 10), slice(0, 40))
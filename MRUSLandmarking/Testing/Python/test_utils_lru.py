@@ -0,0 +1,52 @@
+from MRUSLandmarkingLib.utils_lru import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", 1, 10)
+    cache.put("b", 2, 10)
+    cache.put("c", 3, 10)
+
+    assert cache.get("a") == 1  # "b" is the least recently used entry now
+
+    cache.put("d", 4, 10)
+
+    assert "b" not in cache
+    assert [cache.get(key) for key in ("a", "c", "d")] == [1, 3, 4]
+    assert len(cache) == 3
+    assert cache.current_bytes == 30
+
+
+def test_put_replaces_and_skips_oversized_values():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", 1, 10)
+    cache.put("a", 2, 20)
+
+    assert cache.get("a") == 2
+    assert cache.current_bytes == 20
+
+    cache.put("b", 3, 31)
+
+    assert "b" not in cache
+    assert cache.get("b", "missing") == "missing"
+    assert cache.current_bytes == 20
+
+    cache.put("c", 4, 15)
+
+    assert "a" not in cache
+    assert cache.current_bytes == 15
+
+
+def test_pop_and_clear():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", 1, 10)
+    cache.put("b", 2, 10)
+
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    assert cache.current_bytes == 10
+
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.current_bytes == 0
@@ -0,0 +1,113 @@
+import gzip
+import os
+import time
+
+import numpy as np
+import pytest
+
+from MRUSLandmarkingLib.utils_mask_store import MaskStore, content_key, read_mask_nrrd, volume_digest, write_mask_nrrd
+from MRUSLandmarkingLib.utils_masks import PackedMask
+
+
+@pytest.fixture
+def mask():
+    return PackedMask.from_array(np.random.default_rng(0).random((5, 6, 7)) > 0.5)
+
+
+@pytest.fixture
+def ijk_to_ras():
+    return np.array([[0.0, -0.8, 0.1, 12.5],
+                     [0.9, 0.0, 0.0, -3.25],
+                     [0.0, 0.1, 1.2, 40.0],
+                     [0.0, 0.0, 0.0, 1.0]])
+
+
+def test_nrrd_round_trip(tmp_path, mask, ijk_to_ras):
+    path = str(tmp_path / "mask.nrrd")
+
+    write_mask_nrrd(path, mask, ijk_to_ras, fields={"mrus_key": "abc"})
+    loaded, loaded_ijk_to_ras, fields = read_mask_nrrd(path)
+
+    np.testing.assert_array_equal(loaded.to_array(), mask.to_array())
+    np.testing.assert_array_equal(loaded_ijk_to_ras, ijk_to_ras)
+    assert fields == {"mrus_key": "abc"}
+    assert os.listdir(tmp_path) == ["mask.nrrd"]  # no temporary file is left behind
+
+
+def test_nrrd_checksum(tmp_path, mask, ijk_to_ras):
+    path = str(tmp_path / "mask.nrrd")
+    write_mask_nrrd(path, mask, ijk_to_ras)
+
+    with open(path, "rb") as file:
+        header, _, payload = file.read().partition(b"\n\n")
+
+    data = bytearray(gzip.decompress(payload))
+    data[3] ^= 1
+    with open(path, "wb") as file:
+        file.write(header + b"\n\n" + gzip.compress(bytes(data)))
+
+    with pytest.raises(ValueError, match="checksum"):
+        read_mask_nrrd(path)
+
+
+def test_keys(mask, ijk_to_ras):
+    array = mask.to_labelmap()
+    digest = volume_digest(array, ijk_to_ras)
+
+    assert digest == volume_digest(array.copy(), ijk_to_ras.copy())
+    assert digest != volume_digest(array, ijk_to_ras + 0.5)
+    assert digest != volume_digest(array.reshape(6, 5, 7), ijk_to_ras)
+
+    # only the order of the non-reference volumes does not matter
+    assert content_key(["a", "b", "c"]) == content_key(["a", "c", "b"])
+    assert content_key(["a", "b", "c"]) != content_key(["b", "a", "c"])
+    assert content_key(["a", "b", "c"], min_coverage=3) == content_key(["a", "b", "c"])
+    assert content_key(["a", "b", "c"], min_coverage=2) != content_key(["a", "b", "c"])
+
+
+def test_store_load(tmp_path, mask, ijk_to_ras):
+    store = MaskStore(str(tmp_path / "store"))
+
+    assert store.load("a") is None
+
+    store.save("a", mask, ijk_to_ras)
+    loaded, loaded_ijk_to_ras = store.load("a")
+    np.testing.assert_array_equal(loaded.to_array(), mask.to_array())
+    np.testing.assert_array_equal(loaded_ijk_to_ras, ijk_to_ras)
+
+    # a file stored under the wrong name is removed
+    os.replace(store.path("a"), store.path("b"))
+    assert store.load("b") is None
+    assert not os.path.exists(store.path("b"))
+
+
+def test_store_eviction(tmp_path, mask, ijk_to_ras):
+    store = MaskStore(str(tmp_path), max_bytes=10 ** 9)
+    for age, key in enumerate(["c", "b", "a"]):
+        store.save(key, mask, ijk_to_ras)
+        os.utime(store.path(key), (time.time() - 100 + age, time.time() - 100 + age))
+
+    store.load("c")  # now the most recently used one
+
+    store.max_bytes = 2 * os.path.getsize(store.path("a"))
+    store.cleanup()
+
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(store.path(key)) for key in ("a", "c"))
+
+
+def test_store_removes_stale_partial_files(tmp_path, mask, ijk_to_ras):
+    store = MaskStore(str(tmp_path), partial_grace_s=60)
+    stale, running = tmp_path / "tmp1.part", tmp_path / "tmp2.part"
+    stale.write_bytes(b"x" * 100)
+    running.write_bytes(b"x" * 100)
+    os.utime(stale, (time.time() - 120, time.time() - 120))
+
+    store.save("a", mask, ijk_to_ras)
+    assert not stale.exists()
+    assert running.exists()
+
+    # partial files of running writes count towards the size cap
+    store.max_bytes = os.path.getsize(store.path("a")) + 50
+    store.cleanup()
+    assert running.exists()
+    assert store.load("a") is None
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from MRUSLandmarkingLib.utils_masks import PackedMask
+
+
+@pytest.fixture
+def array():
+    # j * i = 35 is not a multiple of 8, so every packed row has padding bits
+    return np.random.default_rng(0).random((4, 5, 7)) > 0.5
+
+
+def test_round_trip(array):
+    mask = PackedMask.from_array(array)
+
+    assert mask.shape == array.shape
+    assert mask.bits.shape == (4, 5)
+    np.testing.assert_array_equal(mask.to_array(), array)
+    np.testing.assert_array_equal(mask.to_labelmap(3), array.astype(np.uint8) * 3)
+    np.testing.assert_array_equal(PackedMask.from_labelmap(array.astype(np.uint8) * 2, label=2).to_array(), array)
+
+
+def test_full_keeps_padding_bits_empty():
+    mask = PackedMask.full((2, 5, 7), True)
+
+    assert mask.count() == 2 * 5 * 7
+    assert mask.to_array().all()
+
+
+def test_slices(array):
+    mask = PackedMask.from_array(array)
+
+    np.testing.assert_array_equal(mask.unpack(range(1, 3)), array[1:3])
+    np.testing.assert_array_equal(mask[2], array[2])
+    for k, mask_slice in enumerate(mask.iter_slices()):
+        np.testing.assert_array_equal(mask_slice, array[k])
+
+    mask.pack(range(1, 3), np.zeros((2, 5, 7)))
+    expected = array.copy()
+    expected[1:3] = False
+    np.testing.assert_array_equal(mask.to_array(), expected)
+
+
+def test_counts(array):
+    mask = PackedMask.from_array(array)
+
+    assert mask.count() == array.sum()
+    assert mask.any()
+    assert not PackedMask.full(array.shape).any()
+
+    array[1] = False
+    np.testing.assert_array_equal(PackedMask.from_array(array).slice_any(), array.any(axis=(1, 2)))
+
+
+def test_operators(array):
+    other = np.random.default_rng(1).random(array.shape) > 0.5
+    mask, other_mask = PackedMask.from_array(array), PackedMask.from_array(other)
+
+    np.testing.assert_array_equal((mask & other_mask).to_array(), array & other)
+    np.testing.assert_array_equal((mask | other_mask).to_array(), array | other)
+
+    mask |= other_mask
+    np.testing.assert_array_equal(mask.to_array(), array | other)
+    mask &= other_mask
+    np.testing.assert_array_equal(mask.to_array(), other)
+
+    with pytest.raises(ValueError):
+        mask & PackedMask.full((4, 7, 5))
+
+
+def test_sample(array):
+    mask = PackedMask.from_array(array)
+    rng = np.random.default_rng(2)
+    kk, jj, ii = (rng.integers(0, n, (10, 10)) for n in array.shape)
+
+    np.testing.assert_array_equal(mask.sample(kk, jj, ii), array[kk, jj, ii])
+
+
+def test_bounding_box_and_crop():
+    array = np.zeros((6, 9, 11), dtype=bool)
+    array[2, 3, 4] = array[4, 6, 8] = array[3, 5, 5] = True
+    mask = PackedMask.from_array(array)
+
+    bounds = mask.bounding_box()
+
+    assert bounds == (slice(2, 5), slice(3, 7), slice(4, 9))
+    np.testing.assert_array_equal(mask.crop(bounds).to_array(), array[bounds])
+    assert PackedMask.full(array.shape).bounding_box() is None